@@ -1,10 +1,22 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence
+import anomaly
+import database
+import snapshot
 from models import ConsumptionRecord
-from utils import in_range
+from utils import in_range, money, money_mean
 
 class DataAnalyzer:
+    # 各分析方法用到的列：从数据库加载时只查询这些列 (投影下推)
+    REQUIRED_COLUMNS = {
+        "generate_report": ("student_id", "timestamp", "amount", "merchant_type"),
+        "detect_poverty_students": ("student_id", "name", "major", "grade", "balance", "timestamp", "amount", "tx_type"),
+        "get_suspicious_records": ("student_id", "name", "major", "timestamp", "amount", "tx_type", "location"),
+        "get_deep_insights": ("student_id", "timestamp", "amount", "location", "tx_type"),
+    }
+
     def __init__(self, records: List[ConsumptionRecord]):
         # 将记录转换为 DataFrame，方便后续分析
         if not records:
@@ -31,6 +43,30 @@ class DataAnalyzer:
             ]
             self.df = pd.DataFrame(data)
 
+    @classmethod
+    def columns_for(cls, *analyses: str) -> List[str]:
+        """若干分析方法所需列的并集 (保持声明顺序)"""
+        cols = []
+        for name in analyses:
+            cols.extend(cls.REQUIRED_COLUMNS[name])
+        return list(dict.fromkeys(cols))
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray]) -> "DataAnalyzer":
+        """由列式数组 (database.fetch_columns 的结果) 构造，不经过 ConsumptionRecord"""
+        analyzer = cls([])
+        analyzer.df = pd.DataFrame(columns)
+        return analyzer
+
+    @classmethod
+    def from_database(cls, analyses: Sequence[str], conn=None, **filters) -> "DataAnalyzer":
+        """
+        按过滤条件从数据库加载，只查询 analyses 中各方法需要的列
+        filters 与 database.fetch_records 的过滤参数相同；conn 为调用方持有的连接 (可选)
+        有当前写版本的分析快照时直接从快照映射，否则查询数据库
+        """
+        return cls.from_columns(snapshot.fetch_columns(cls.columns_for(*analyses), conn=conn, **filters))
+
     def generate_report(
         self,
         single_threshold: float,
@@ -52,9 +88,9 @@ class DataAnalyzer:
 
         # 1. 消费汇总 (Resample)
         df_ts = df.set_index('timestamp')
-        daily = df_ts.resample('D')['amount'].sum().fillna(0)
-        weekly = df_ts.resample('W')['amount'].sum().fillna(0)
-        monthly = df_ts.resample('ME')['amount'].sum().fillna(0) # pandas 2.0+ use 'ME' for Month End
+        daily = df_ts.resample('D')['amount'].sum().fillna(0).map(money)
+        weekly = df_ts.resample('W')['amount'].sum().fillna(0).map(money)
+        monthly = df_ts.resample('ME')['amount'].sum().fillna(0).map(money) # pandas 2.0+ use 'ME' for Month End
 
         # 转换 key 为字符串格式
         daily_dict = {k.strftime('%Y-%m-%d'): v for k, v in daily.items() if v > 0}
@@ -62,15 +98,15 @@ class DataAnalyzer:
         monthly_dict = {k.strftime('%Y-%m'): v for k, v in monthly.items() if v > 0}
 
         # 2. 习惯分析
-        total = df['amount'].sum()
+        total = money(df['amount'].sum())
         count = len(df)
-        avg = df['amount'].mean()
-        max_amt = df['amount'].max()
+        avg = money_mean(total, count)
+        max_amt = float(df['amount'].max())
         
         # 商户分布
         merchant_stats = df.groupby('merchant_type')['amount'].agg(['sum', 'count'])
         merchant_breakdown = {
-            k: {"total": v['sum'], "count": v['count']} 
+            k: {"total": money(v['sum']), "count": int(v['count'])}
             for k, v in merchant_stats.iterrows()
         }
 
@@ -171,67 +207,13 @@ class DataAnalyzer:
     def get_suspicious_records(self, single_threshold: float, freq_window_min: int, freq_count: int) -> List[Dict[str, Any]]:
         """
         获取异常交易记录：大额消费 或 高频消费
+        两条规则由 anomaly.RuleEngine 在一次排序后向量化执行
         """
         if self.df.empty:
             return []
-            
-        suspicious = []
-        
-        # 1. 大额消费
-        # 只统计 '消费' 类型
-        large_df = self.df[(self.df['amount'] > single_threshold) & (self.df['tx_type'] == '消费')].copy()
-        for _, row in large_df.iterrows():
-            suspicious.append({
-                "type": "大额消费",
-                "student_id": row['student_id'],
-                "name": row['name'],
-                "major": row['major'],
-                "timestamp": row['timestamp'],
-                "amount": row['amount'],
-                "tx_type": row['tx_type'],
-                "location": row['location'],
-                "desc": f"单笔 > {single_threshold}"
-            })
-            
-        # 2. 高频消费
-        if not self.df.empty:
-            # 确保按时间排序，且只看消费记录
-            df_sorted = self.df[self.df['tx_type'] == '消费'].sort_values('timestamp')
-            grouped = df_sorted.groupby('student_id')
-            
-            for _, group in grouped:
-                if group.empty: continue
-                
-                # 设置时间索引
-                g_ts = group.set_index('timestamp')
-                
-                # 统计窗口内的交易次数
-                # min_periods=1 确保有数据就计算
-                counts = g_ts.rolling(f'{freq_window_min}min')['amount'].count()
-                
-                # 找到异常的时间点
-                anomalies = counts[counts >= freq_count]
-                
-                for ts, count in anomalies.items():
-                    # 找到触发阈值的这条记录
-                    matches = group[group['timestamp'] == ts]
-                    if not matches.empty:
-                        record = matches.iloc[0]
-                        
-                        suspicious.append({
-                            "type": "高频消费",
-                            "student_id": record['student_id'],
-                            "name": record['name'],
-                            "major": record['major'],
-                            "timestamp": record['timestamp'],
-                            "amount": record['amount'],
-                            "tx_type": record['tx_type'],
-                            "location": record['location'],
-                            "desc": f"{freq_window_min}分内 {int(count)} 次"
-                        })
-        
-        # 按时间倒序
-        suspicious.sort(key=lambda x: x['timestamp'], reverse=True)
+        engine = anomaly.RuleEngine.from_specs(
+            anomaly.threshold_rules(single_threshold, freq_window_min, freq_count))
+        suspicious, _ = engine.run(self.df)
         return suspicious
 
     def get_deep_insights(self) -> Dict[str, Any]:
@@ -291,18 +273,18 @@ class DataAnalyzer:
             # 2. 工作日 vs 周末 消费对比
             if 'timestamp' in df.columns and 'amount' in df.columns:
                 df['is_weekend'] = df['timestamp'].dt.dayofweek >= 5
-                weekend_avg = df[df['is_weekend']]['amount'].mean()
-                weekday_avg = df[~df['is_weekend']]['amount'].mean()
-                insights['weekend_avg'] = float(weekend_avg) if not pd.isna(weekend_avg) else 0.0
-                insights['weekday_avg'] = float(weekday_avg) if not pd.isna(weekday_avg) else 0.0
+                weekend = df.loc[df['is_weekend'], 'amount']
+                weekday = df.loc[~df['is_weekend'], 'amount']
+                insights['weekend_avg'] = money_mean(weekend.sum(), len(weekend))
+                insights['weekday_avg'] = money_mean(weekday.sum(), len(weekday))
                 
-                insights['avg_meal_cost'] = float(df['amount'].mean())
+                insights['avg_meal_cost'] = money_mean(df['amount'].sum(), len(df))
                 insights['most_expensive_meal'] = float(df['amount'].max())
             
-            # 3. 最受欢迎的地点 (Top 5)
+            # 3. 最受欢迎的地点 (Top 5)：次数降序，次数相同按地点名
             if 'location' in df.columns:
-                top_locations = df['location'].value_counts().nlargest(5)
-                insights['top_locations'] = top_locations.to_dict()
+                top_locations = df['location'].value_counts().sort_index().sort_values(ascending=False, kind='stable')
+                insights['top_locations'] = {loc: int(c) for loc, c in top_locations.head(5).items()}
                 
         except Exception as e:
             print(f"Analysis error: {e}")
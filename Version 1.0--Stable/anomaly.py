@@ -0,0 +1,704 @@
+"""
+按学生的统计基线异常检测
+
+全局的单笔阈值对一直消费较高的学生会产生大量误报，这里为每个学生维护滚动基线：
+- 金额的 EWMA 均值/方差 -> z 分数
+- 各小时的消费次数 -> 非常规时段 (按 3 小时一段判断)
+- 去过的地点 -> 新地点
+
+BaselineDetector.score 对整段历史一次性向量化计算 (每笔交易只与它之前的基线比较)；
+student_baselines 表保存每个学生的当前基线，写入时由变更监听器增量更新，
+同时把新交易与更新前的基线比较，命中的记入 baseline_alerts。
+
+RuleEngine 是声明式的规则检测 (大额、窗口内次数、地点跳变、夜间、重复金额)：
+所有规则共用一次排序，各自编译为向量化的掩码或 searchsorted 窗口计算。
+"""
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import database
+import snapshot
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+# EWMA 平滑系数：约等于最近 2/alpha - 1 = 19 笔的均值
+EWMA_ALPHA = 0.1
+# 金额超过基线均值多少个标准差视为异常
+Z_THRESHOLD = 3.0
+# 标准差下限 (元)：避免每次金额几乎相同的学生 z 分数无穷大
+STD_FLOOR = 1.0
+# 至少有这么多笔历史交易才做 z 分数判断
+MIN_HISTORY = 20
+# 时段/地点的新颖性需要更长的历史，否则正常的作息也会被当成"没见过"
+NOVELTY_HISTORY = 50
+# 时段长度 (小时)，该时段在历史中的占比低于 HOUR_NOVELTY 视为非常规时段
+HOUR_BUCKET = 3
+HOUR_NOVELTY = 0.02
+
+# 检测需要的列
+SCORE_COLUMNS = ("id", "student_id", "name", "major", "timestamp", "amount", "tx_type", "location")
+
+
+@dataclass
+class Baseline:
+    """单个学生的滚动基线，与 BaselineDetector.score 的逐笔计算一致"""
+    tx_count: int = 0
+    mean: float = 0.0
+    var: float = 0.0
+    last_ts: str = ""
+    hours: np.ndarray = field(default_factory=lambda: np.zeros(24, dtype=np.int64))
+    locations: Dict[str, int] = field(default_factory=dict)
+
+    def check(self, detector: "BaselineDetector", timestamp: str, amount: float, location: str) -> List[tuple]:
+        """与更新前的基线比较，返回 [(类型, 分数, 说明)]"""
+        hits = []
+        if self.tx_count >= detector.min_history:
+            z = (amount - self.mean) / max(math.sqrt(self.var), STD_FLOOR)
+            if z > detector.z_threshold:
+                hits.append(("偏离基线", z, f"z={z:.1f} (基线 {self.mean:.2f} 元)"))
+        if self.tx_count >= detector.novelty_history:
+            hour = int(timestamp[11:13])
+            start = hour // HOUR_BUCKET * HOUR_BUCKET
+            freq = self.hours[start:start + HOUR_BUCKET].sum() / self.tx_count
+            if freq < detector.hour_novelty:
+                hits.append(("非常规时段", 1 - freq, _hour_desc(hour, freq)))
+            if location not in self.locations:
+                hits.append(("新地点", 1.0, f"首次在 {location} 消费"))
+        return hits
+
+    def update(self, alpha: float, timestamp: str, amount: float, location: str):
+        if self.tx_count == 0:
+            self.mean, self.var = amount, 0.0
+        else:
+            diff = amount - self.mean
+            self.mean += alpha * diff
+            self.var = (1 - alpha) * (self.var + alpha * diff * diff)
+        self.tx_count += 1
+        self.last_ts = max(self.last_ts, timestamp)
+        self.hours[int(timestamp[11:13])] += 1
+        self.locations[location] = self.locations.get(location, 0) + 1
+
+
+def _hour_desc(hour: int, freq: float) -> str:
+    start = hour // HOUR_BUCKET * HOUR_BUCKET
+    return f"{hour} 时 ({start:02d}-{start + HOUR_BUCKET:02d} 时历史占比 {freq:.1%})"
+
+
+class BaselineDetector:
+    def __init__(
+        self,
+        alpha: float = EWMA_ALPHA,
+        z_threshold: float = Z_THRESHOLD,
+        min_history: int = MIN_HISTORY,
+        novelty_history: int = NOVELTY_HISTORY,
+        hour_novelty: float = HOUR_NOVELTY,
+    ):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_history = min_history
+        self.novelty_history = novelty_history
+        self.hour_novelty = hour_novelty
+
+    @staticmethod
+    def _prepare(df: pd.DataFrame) -> Tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        只保留消费记录，计算按 (学生, 时间, id) 的排列，不移动 df 本身的行
+        返回 (df, 排列 order, 排列后的学生编码, 每个学生在排列中的起始位置)
+        """
+        if "tx_type" in df:
+            df = df[df["tx_type"] == "消费"]
+        if "id" in df and len(df) and not (np.diff(df["id"].to_numpy()) > 0).all():
+            df = df.iloc[np.argsort(df["id"].to_numpy(), kind="stable")]
+        df = df.reset_index(drop=True)
+        codes = pd.factorize(df["student_id"])[0]
+        seconds = df["timestamp"].to_numpy().astype("datetime64[s]").astype(np.int64)
+        if len(df) and (np.diff(seconds) >= 0).all():
+            # 按入库顺序读出的数据通常已按时间排好，只需按学生稳定排序 (小整数走基数排序)
+            small = np.uint16 if codes.max() < 65536 else np.int64
+            order = np.argsort(codes.astype(small), kind="stable")
+        else:
+            seconds = seconds - (seconds.min() if len(df) else 0)
+            # 时间跨度不超过 2^40 秒，学生编码放在高位
+            order = np.argsort((codes.astype(np.int64) << 40) | seconds, kind="stable")
+        codes = codes[order].astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.empty(0, dtype=np.int64)
+        return df, order, codes, starts
+
+    def _ewm(self, amounts: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        分段 EWMA 均值/方差 (adjust=False，有偏方差，与 pandas ewm 一致)
+        m_t = (1-α)·m_{t-1} + α·x_t，v_t = (1-α)·(v_{t-1} + α·(x_t - m_{t-1})²)
+        都是 y_t = a_t·y_{t-1} + b_t 形式的递推，每个学生第一行 a=0 即可分段；
+        用前缀扫描在 log2(最长历史) 轮 numpy 运算内算完，不逐行循环
+        """
+        n = len(amounts)
+        longest = int(np.diff(np.r_[starts, n]).max()) if n else 0
+        a = np.full(n, 1 - self.alpha)
+        a[starts] = 0.0
+        b = self.alpha * amounts
+        b[starts] = amounts[starts]
+        mean = _affine_scan(a, b, longest)
+
+        prev = np.roll(mean, 1)
+        b = (1 - self.alpha) * self.alpha * (amounts - prev) ** 2
+        b[starts] = 0.0
+        var = _affine_scan(a, b, longest)
+        return mean, var
+
+    def score(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        向量化计算每笔消费相对于其之前基线的各项指标，所有学生一次完成
+        返回只含消费记录的 df (保持原行序)，附加列: n_prior, base_mean, base_std, z,
+        hour_freq, new_location，以及命中标志 z_flag, hour_flag, location_flag
+        """
+        df, order, codes, starts = self._prepare(df)
+        n = len(df)
+        if n == 0:
+            return df.assign(n_prior=0, base_mean=0.0, base_std=0.0, z=0.0, hour_freq=0.0,
+                             new_location=False, z_flag=False, hour_flag=False, location_flag=False)
+
+        # 以下数组都按 order 排列 (同一学生连续且按时间先后)
+        lengths = np.diff(np.r_[starts, n])
+        n_prior = np.arange(n) - np.repeat(starts, lengths)
+
+        amounts = df["amount"].to_numpy(dtype=np.float64)[order]
+        mean, var = self._ewm(amounts, starts)
+        # 每笔只与前一笔之后的基线比较
+        base_mean = np.roll(mean, 1)
+        base_var = np.roll(var, 1)
+        base_mean[starts] = np.nan
+        base_var[starts] = np.nan
+        base_std = np.sqrt(base_var)
+        z = (amounts - base_mean) / np.maximum(base_std, STD_FLOOR)
+
+        hours = df["timestamp"].dt.hour.to_numpy()[order]
+        hour_prior = _cumcount(codes, hours // HOUR_BUCKET, 24 // HOUR_BUCKET)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            hour_freq = np.where(n_prior > 0, hour_prior / np.maximum(n_prior, 1), np.nan)
+
+        loc_codes, loc_uniques = pd.factorize(df["location"])
+        new_location = _cumcount(codes, loc_codes[order], len(loc_uniques)) == 0
+
+        enough = n_prior >= self.min_history
+        familiar = n_prior >= self.novelty_history
+        columns = dict(
+            n_prior=n_prior, base_mean=base_mean, base_std=base_std, z=z,
+            hour_freq=hour_freq, new_location=new_location,
+            z_flag=enough & (z > self.z_threshold),
+            hour_flag=familiar & (hour_freq < self.hour_novelty),
+            location_flag=familiar & new_location,
+        )
+        # 还原为 df 的行序
+        for name, values in columns.items():
+            restored = np.empty_like(values)
+            restored[order] = values
+            columns[name] = restored
+        return df.assign(**columns)
+
+    def detect(
+        self,
+        df: pd.DataFrame,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        返回与 DataAnalyzer.get_suspicious_records 相同格式的列表 (按时间倒序)
+        start_date/end_date 只限制输出范围，基线仍使用 df 中更早的历史
+        """
+        scored = self.score(df)
+        if start_date is not None:
+            scored = scored[scored["timestamp"] >= start_date]
+        if end_date is not None:
+            scored = scored[scored["timestamp"] <= end_date]
+
+        suspicious = []
+        for flag, kind in (("z_flag", "偏离基线"), ("hour_flag", "非常规时段"), ("location_flag", "新地点")):
+            hits = scored[scored[flag]]
+            for row in hits.itertuples(index=False):
+                if kind == "偏离基线":
+                    desc = f"z={row.z:.1f} (基线 {row.base_mean:.2f} 元)"
+                elif kind == "非常规时段":
+                    desc = _hour_desc(row.timestamp.hour, row.hour_freq)
+                else:
+                    desc = f"首次在 {row.location} 消费"
+                suspicious.append({
+                    "type": kind,
+                    "student_id": row.student_id,
+                    "name": row.name,
+                    "major": row.major,
+                    "timestamp": row.timestamp,
+                    "amount": row.amount,
+                    "tx_type": row.tx_type,
+                    "location": row.location,
+                    "desc": desc,
+                })
+        suspicious.sort(key=lambda x: x["timestamp"], reverse=True)
+        return suspicious
+
+    def detect_from_database(self, **filters) -> List[Dict[str, Any]]:
+        """
+        按过滤条件检测；日期条件只用于限制输出，基线使用所选学生的完整历史
+        """
+        start_date = filters.pop("start_date", None)
+        end_date = filters.pop("end_date", None)
+        df = pd.DataFrame(snapshot.fetch_columns(SCORE_COLUMNS, **filters))
+        return self.detect(df, start_date, end_date)
+
+    def build_baselines(self, df: pd.DataFrame) -> Dict[str, Baseline]:
+        """由完整历史向量化构建每个学生的当前基线"""
+        df, order, codes, starts = self._prepare(df)
+        if df.empty:
+            return {}
+        mean, var = self._ewm(df["amount"].to_numpy(dtype=np.float64)[order], starts)
+        last = np.r_[starts[1:], len(df)] - 1
+        counts = last - starts + 1
+        students = df["student_id"].to_numpy()[order[starts]]
+        last_ts = df["timestamp"].iloc[order[last]].dt.strftime(DATE_FMT).to_numpy()
+
+        hours = df["timestamp"].dt.hour.to_numpy()[order]
+        hour_counts = np.bincount(codes * 24 + hours, minlength=len(starts) * 24).reshape(len(starts), 24)
+        loc_codes, loc_uniques = pd.factorize(df["location"])
+        loc_counts = np.bincount(codes * len(loc_uniques) + loc_codes[order],
+                                 minlength=len(starts) * len(loc_uniques)).reshape(len(starts), -1)
+
+        baselines = {}
+        for i, s in enumerate(students):
+            nz = np.flatnonzero(loc_counts[i])
+            baselines[s] = Baseline(
+                tx_count=int(counts[i]), mean=float(mean[last[i]]), var=float(var[last[i]]),
+                last_ts=last_ts[i], hours=hour_counts[i].astype(np.int64),
+                locations={loc_uniques[j]: int(loc_counts[i, j]) for j in nz},
+            )
+        return baselines
+
+
+def _affine_scan(a: np.ndarray, b: np.ndarray, steps: int) -> np.ndarray:
+    """y_t = a_t·y_{t-1} + b_t (y_{-1}=0) 的前缀扫描 (Hillis-Steele)，steps 为最长分段长度"""
+    a, b = a.copy(), b.copy()
+    shift = 1
+    while shift < steps:
+        b[shift:] += a[shift:] * b[:-shift]
+        a[shift:] *= a[:-shift].copy()
+        shift *= 2
+    return b
+
+
+def _cumcount(codes: np.ndarray, minor: np.ndarray, n_minor: int) -> np.ndarray:
+    """
+    每行是同一 (学生, minor) 的第几次出现 (按行序，从 0 开始)
+    行已按学生分组排好，只需按 minor 做稳定排序 (小整数走基数排序)
+    """
+    small = np.uint8 if n_minor <= 256 else np.uint16 if n_minor <= 65536 else np.int64
+    order = np.argsort(minor.astype(small), kind="stable")
+    keys = codes * n_minor + minor
+    sorted_keys = keys[order]
+    run_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    run_lengths = np.diff(np.r_[run_starts, len(keys)])
+    result = np.empty(len(keys), dtype=np.int64)
+    result[order] = np.arange(len(keys)) - np.repeat(run_starts, run_lengths)
+    return result
+
+
+def _load_baselines(cursor: sqlite3.Cursor, student_ids) -> Dict[str, Baseline]:
+    student_ids = list(student_ids)
+    baselines = {}
+    for start in range(0, len(student_ids), 500):
+        chunk = student_ids[start:start + 500]
+        for row in cursor.execute(f"""
+            SELECT student_id, tx_count, mean, var, last_ts, hours, locations FROM student_baselines
+            WHERE student_id IN ({', '.join('?' * len(chunk))})
+        """, chunk):
+            baselines[row[0]] = Baseline(row[1], row[2], row[3], row[4],
+                                         np.frombuffer(row[5], dtype=np.int64).copy(), json.loads(row[6]))
+    return baselines
+
+
+def _save_baselines(cursor: sqlite3.Cursor, baselines: Dict[str, Baseline]):
+    cursor.executemany("""
+        INSERT OR REPLACE INTO student_baselines (student_id, tx_count, mean, var, last_ts, hours, locations)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(s, b.tx_count, b.mean, b.var, b.last_ts, b.hours.tobytes(), json.dumps(b.locations, ensure_ascii=False))
+          for s, b in baselines.items()])
+
+
+def _set_watermark(cursor: sqlite3.Cursor, max_id: int):
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES ('baseline_max_id', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (max_id,))
+
+
+def _has_history_before(cursor: sqlite3.Cursor, first_id: int) -> bool:
+    return bool(
+        cursor.execute("SELECT 1 FROM consumption WHERE id < ? LIMIT 1", (first_id,)).fetchone()
+        or cursor.execute("SELECT 1 FROM archive_partitions LIMIT 1").fetchone()
+    )
+
+
+def _update_baselines(cursor: sqlite3.Cursor, inserted, removed):
+    """
+    变更监听器：把水位之后新增的消费记录按时间顺序并入各学生基线，
+    并入前先与旧基线比较，命中的写入 baseline_alerts
+    修改/删除不回退基线 (EWMA 本身是近似的滚动统计)，需要时可调用 rebuild_baselines
+    """
+    row = cursor.execute("SELECT value FROM meta WHERE key = 'baseline_max_id'").fetchone()
+    if row is not None:
+        watermark = row[0]
+    elif inserted and not _has_history_before(cursor, inserted[0]):
+        watermark = inserted[0] - 1  # 空库：从第一批写入开始维护
+    else:
+        _schedule_bootstrap()  # 已有历史但尚未全量构建：后台构建一次，完成前不做检测
+        return
+    max_id = database._max_id(cursor)
+    if max_id <= watermark:
+        return
+
+    rows = cursor.execute("""
+        SELECT id, student_id, timestamp, amount, location FROM consumption
+        WHERE id > ? AND id <= ? AND tx_type = '消费'
+        ORDER BY student_id, timestamp, id
+    """, (watermark, max_id)).fetchall()
+    baselines = _load_baselines(cursor, {r[1] for r in rows})
+    detector = BaselineDetector()
+    alerts = []
+    now = datetime.now().strftime(DATE_FMT)
+    for tx_id, sid, ts, amount, location in rows:
+        b = baselines.setdefault(sid, Baseline())
+        for kind, score, desc in b.check(detector, ts, amount, location):
+            alerts.append((tx_id, kind, sid, ts, score, desc, now))
+        b.update(detector.alpha, ts, amount, location)
+
+    _save_baselines(cursor, baselines)
+    cursor.executemany("""
+        INSERT OR REPLACE INTO baseline_alerts (tx_id, kind, student_id, timestamp, score, desc, detected_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, alerts)
+    _set_watermark(cursor, max_id)
+    if alerts:
+        logger.info("基线检测：新增 %d 条告警", len(alerts))
+
+
+def _replace_baselines(cursor: sqlite3.Cursor, baselines: Dict[str, Baseline], max_id: int):
+    cursor.execute("DELETE FROM student_baselines")
+    _save_baselines(cursor, baselines)
+    _set_watermark(cursor, max_id)
+    _update_baselines(cursor, None, ())
+
+
+_bootstrap_lock = threading.Lock()
+_bootstrapped = set()
+
+
+def _bootstrap(db_path: Path):
+    try:
+        if database.DB_PATH == db_path:
+            logger.info("基线构建完成: %d 名学生", rebuild_baselines())
+            return
+    except Exception:
+        logger.exception("基线构建失败，下次写入时重试 (也可手动调用 rebuild_baselines)")
+    with _bootstrap_lock:
+        _bootstrapped.discard(db_path)
+
+
+def _schedule_bootstrap():
+    """
+    库中已有历史数据却从未构建过基线 (旧库升级、批量导入绕过了监听器)：
+    监听器在写入事务内无法挂载归档做全量构建，每个库只启动一次后台线程调用 rebuild_baselines
+    """
+    db_path = database.DB_PATH
+    with _bootstrap_lock:
+        if db_path in _bootstrapped:
+            return
+        _bootstrapped.add(db_path)
+    logger.warning("%s 尚未构建消费基线，后台全量构建中，完成前新写入的交易不做基线检测", db_path.name)
+    threading.Thread(target=_bootstrap, args=(db_path,), name="baseline-bootstrap", daemon=True).start()
+
+
+def rebuild_baselines() -> int:
+    """由完整历史 (含归档) 重建所有学生的基线，写入经写线程完成，返回学生数"""
+    df = pd.DataFrame(database.fetch_columns(("id", "student_id", "timestamp", "amount", "tx_type", "location")))
+    baselines = BaselineDetector().build_baselines(df)
+    # 水位取实际读到的最大 id，读取之后新写入的行在同一写操作内按增量方式并入，不会被跳过
+    max_id = int(df["id"].max()) if len(df) else 0
+    database.write(_replace_baselines, baselines, max_id).result()
+    return len(baselines)
+
+
+def get_alerts(limit: int = 500) -> List[Dict[str, Any]]:
+    """最近的入库告警 (仍存在的交易)，格式同 get_suspicious_records"""
+    conn = database.get_connection()
+    rows = conn.execute("""
+        SELECT a.kind, c.student_id, c.name, c.major, c.timestamp, c.amount, c.tx_type, c.location, a.desc
+        FROM baseline_alerts a JOIN consumption c ON c.id = a.tx_id
+        ORDER BY a.timestamp DESC LIMIT ?
+    """, (limit,)).fetchall()
+    conn.close()
+    return [{
+        "type": r["kind"], "student_id": r["student_id"], "name": r["name"], "major": r["major"],
+        "timestamp": datetime.strptime(r["timestamp"], DATE_FMT), "amount": r["amount"],
+        "tx_type": r["tx_type"], "location": r["location"], "desc": r["desc"],
+    } for r in rows]
+
+
+# 规则引擎：声明式的异常规则，每条规则编译成排好序的数组上的向量化掩码/窗口计算
+# 规则配置是普通的 dict (可存为 JSON)：{"kind": 类型, "label": 显示名称, ...参数}
+
+# 可选的规则配置文件 (JSON 列表)，存在时替代界面上的附加规则
+RULES_PATH = Path("data/anomaly_rules.json")
+
+
+@dataclass
+class ScanContext:
+    """
+    规则共享的一次扫描：消费记录按 (学生, 时间, id) 排好序后的各列数组
+    key = 学生编码 << 40 | 秒数，同一学生内按时间有序，窗口查询用 searchsorted 完成
+    """
+    df: pd.DataFrame
+    order: np.ndarray
+    codes: np.ndarray
+    starts: np.ndarray
+    seconds: np.ndarray
+    key: np.ndarray
+    amounts: np.ndarray
+    hours: np.ndarray
+    loc_codes: np.ndarray
+    loc_uniques: np.ndarray
+
+    @classmethod
+    def build(cls, df: pd.DataFrame) -> "ScanContext":
+        df, order, codes, starts = BaselineDetector._prepare(df)
+        seconds = df["timestamp"].to_numpy().astype("datetime64[s]").astype(np.int64)[order]
+        if len(seconds):
+            seconds = seconds - seconds.min()
+        loc_codes, loc_uniques = pd.factorize(df["location"])
+        return cls(
+            df=df, order=order, codes=codes, starts=starts, seconds=seconds,
+            key=(codes << 40) | seconds,
+            amounts=df["amount"].to_numpy(dtype=np.float64)[order],
+            hours=df["timestamp"].dt.hour.to_numpy()[order],
+            loc_codes=loc_codes[order], loc_uniques=np.asarray(loc_uniques, dtype=object),
+        )
+
+    def first_of_student(self) -> np.ndarray:
+        first = np.zeros(len(self.key), dtype=bool)
+        first[self.starts] = True
+        return first
+
+
+def _window_counts(key: np.ndarray, window_sec: int) -> np.ndarray:
+    """key 已排序时，每行在 (t - window, t] 内同组的行数 (含自身)"""
+    lo = np.searchsorted(key, key - window_sec, side="right")
+    return np.arange(len(key)) - lo + 1
+
+
+class AnomalyRule:
+    """规则基类：evaluate 返回 (要报告的行在排序后的位置, 对应的说明)"""
+    kind = ""
+
+    def __init__(self, label: str):
+        self.label = label
+
+    def evaluate(self, ctx: ScanContext) -> Tuple[np.ndarray, List[str]]:
+        raise NotImplementedError
+
+
+# 规则类型注册表：kind -> 规则类，新的规则类型用 register_rule_type 注册后即可在配置中使用
+RULE_TYPES: Dict[str, type] = {}
+
+def register_rule_type(cls: type) -> type:
+    RULE_TYPES[cls.kind] = cls
+    return cls
+
+
+@register_rule_type
+class AmountAbove(AnomalyRule):
+    """单笔金额超过阈值"""
+    kind = "amount_above"
+
+    def __init__(self, label: str = "大额消费", threshold: float = 200.0):
+        super().__init__(label)
+        self.threshold = threshold
+
+    def evaluate(self, ctx):
+        rows = np.flatnonzero(ctx.amounts > self.threshold)
+        return rows, [f"单笔 > {self.threshold}"] * len(rows)
+
+
+@register_rule_type
+class WindowCount(AnomalyRule):
+    """同一学生 window_min 分钟内 (左开右闭) 的消费次数达到 count"""
+    kind = "window_count"
+
+    def __init__(self, label: str = "高频消费", window_min: int = 10, count: int = 3):
+        super().__init__(label)
+        self.window_min = window_min
+        self.count = count
+
+    def evaluate(self, ctx):
+        counts = _window_counts(ctx.key, self.window_min * 60)
+        hits = np.flatnonzero(counts >= self.count)
+        # 与原实现一致：报告该学生在同一时刻的第一笔
+        rows = np.searchsorted(ctx.key, ctx.key[hits], side="left")
+        return rows, [f"{self.window_min}分内 {c} 次" for c in counts[hits]]
+
+
+@register_rule_type
+class LocationHop(AnomalyRule):
+    """同一学生相邻两笔在不同地点且间隔不超过 window_min 分钟"""
+    kind = "location_hop"
+
+    def __init__(self, label: str = "地点跳变", window_min: int = 5):
+        super().__init__(label)
+        self.window_min = window_min
+
+    def evaluate(self, ctx):
+        gap = np.diff(ctx.seconds, prepend=0)
+        moved = np.r_[False, ctx.loc_codes[1:] != ctx.loc_codes[:-1]]
+        rows = np.flatnonzero(moved & ~ctx.first_of_student() & (gap <= self.window_min * 60))
+        locs = ctx.loc_uniques
+        return rows, [f"{gap[i] // 60}分钟内 {locs[ctx.loc_codes[i - 1]]} → {locs[ctx.loc_codes[i]]}"
+                      for i in rows]
+
+
+@register_rule_type
+class NightSpending(AnomalyRule):
+    """消费时间在 [start_hour, end_hour) 内，可跨零点 (如 23 -> 5)"""
+    kind = "night"
+
+    def __init__(self, label: str = "夜间消费", start_hour: int = 0, end_hour: int = 5):
+        super().__init__(label)
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+
+    def evaluate(self, ctx):
+        h = ctx.hours
+        if self.start_hour < self.end_hour:
+            mask = (h >= self.start_hour) & (h < self.end_hour)
+        else:
+            mask = (h >= self.start_hour) | (h < self.end_hour)
+        rows = np.flatnonzero(mask)
+        return rows, [f"{h[i]:02d} 时消费" for i in rows]
+
+
+@register_rule_type
+class RepeatAmount(AnomalyRule):
+    """同一学生 window_min 分钟内出现 count 笔金额完全相同的消费"""
+    kind = "repeat_amount"
+
+    def __init__(self, label: str = "重复金额", window_min: int = 60, count: int = 3):
+        super().__init__(label)
+        self.window_min = window_min
+        self.count = count
+
+    def evaluate(self, ctx):
+        if not len(ctx.key):
+            return np.empty(0, dtype=np.int64), []
+        # 按 (学生, 金额) 重新分组，组内仍按时间有序
+        cents = np.round(ctx.amounts * 100).astype(np.int64)
+        pair = pd.factorize((ctx.codes << 24) ^ (cents - cents.min()))[0].astype(np.int64)
+        order = np.argsort(pair, kind="stable")
+        key = (pair[order] << 40) | ctx.seconds[order]
+        counts = _window_counts(key, self.window_min * 60)
+        hits = np.flatnonzero(counts >= self.count)
+        rows = order[hits]
+        return rows, [f"{self.window_min}分内 {c} 笔 {a:.2f} 元" for c, a in zip(counts[hits], ctx.amounts[rows])]
+
+
+@dataclass
+class RuleStats:
+    """单条规则的执行统计"""
+    label: str
+    kind: str
+    hits: int
+    millis: float
+
+
+class RuleEngine:
+    def __init__(self, rules: Sequence[AnomalyRule]):
+        self.rules = list(rules)
+        self.prepare_millis = 0.0
+
+    @classmethod
+    def from_specs(cls, specs: Sequence[Dict[str, Any]]) -> "RuleEngine":
+        """由声明式配置构造，未知的规则类型或参数会抛出 ValueError"""
+        rules = []
+        for spec in specs:
+            params = dict(spec)
+            kind = params.pop("kind", None)
+            if kind not in RULE_TYPES:
+                raise ValueError(f"Unknown rule kind: {kind}")
+            try:
+                rules.append(RULE_TYPES[kind](**params))
+            except TypeError as e:
+                raise ValueError(f"Invalid parameters for rule {kind}: {e}") from e
+        return cls(rules)
+
+    def run(self, df: pd.DataFrame) -> Tuple[List[Dict[str, Any]], List[RuleStats]]:
+        """
+        一次排序后依次执行所有规则
+        返回 (与 get_suspicious_records 相同格式的命中列表 (按时间倒序), 每条规则的统计)
+        """
+        t0 = time.perf_counter()
+        ctx = ScanContext.build(df)
+        self.prepare_millis = (time.perf_counter() - t0) * 1000
+
+        stats = []
+        hits = []
+        for rule in self.rules:
+            t0 = time.perf_counter()
+            rows, descs = rule.evaluate(ctx)
+            stats.append(RuleStats(rule.label, rule.kind, len(rows), (time.perf_counter() - t0) * 1000))
+            hits.append((rule.label, ctx.order[rows], descs))
+
+        cols = {c: ctx.df[c] for c in ("student_id", "name", "major", "timestamp", "amount", "tx_type", "location")
+                if c in ctx.df}
+        suspicious = []
+        for label, idx, descs in hits:
+            picked = {c: s.iloc[idx].tolist() for c, s in cols.items()}
+            for i, desc in enumerate(descs):
+                item = {"type": label}
+                item.update({c: values[i] for c, values in picked.items()})
+                item["desc"] = desc
+                suspicious.append(item)
+        suspicious.sort(key=lambda x: x["timestamp"], reverse=True)
+        return suspicious, stats
+
+
+def threshold_rules(single_threshold: float, freq_window_min: int, freq_count: int) -> List[Dict[str, Any]]:
+    """界面阈值对应的两条基础规则 (大额 + 高频)"""
+    return [
+        {"kind": "amount_above", "label": "大额消费", "threshold": single_threshold},
+        {"kind": "window_count", "label": "高频消费", "window_min": freq_window_min, "count": freq_count},
+    ]
+
+
+# 默认的附加规则
+DEFAULT_EXTRA_RULES = [
+    {"kind": "location_hop", "label": "地点跳变", "window_min": 5},
+    {"kind": "night", "label": "夜间消费", "start_hour": 0, "end_hour": 5},
+    {"kind": "repeat_amount", "label": "重复金额", "window_min": 60, "count": 3},
+]
+
+
+def load_rules(path: Path = RULES_PATH) -> List[Dict[str, Any]]:
+    """读取附加规则配置，文件不存在时使用 DEFAULT_EXTRA_RULES"""
+    if not path.exists():
+        return [dict(r) for r in DEFAULT_EXTRA_RULES]
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def default_rules(single_threshold: float, freq_window_min: int, freq_count: int) -> List[Dict[str, Any]]:
+    return threshold_rules(single_threshold, freq_window_min, freq_count) + load_rules()
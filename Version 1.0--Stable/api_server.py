@@ -0,0 +1,442 @@
+"""
+本地 HTTP/JSON 查询服务：不经过界面，把记录查询、统计报告、贫困筛查和异常检测
+以 JSON 形式提供给其它分析工具。
+
+基于 asyncio 自行解析 HTTP/1.1 (只支持 GET，支持 keep-alive)，不依赖第三方框架。
+SQLite 查询放到线程池执行，事件循环只负责收发；每个工作线程从连接池取一个
+只读连接 (mode=ro)，用完归还，不为每个请求重新打开数据库。
+
+接口 (过滤参数与界面一致：student_id / name / major / grade / location / start / end，
+日期为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS；列过滤 filter=列,运算符,值 可重复)：
+    GET /health
+    GET /records?sort=timestamp&desc=1&limit=500&cursor=...   分页记录，返回 next 游标
+    GET /records.ndjson?...                                    全部匹配记录，逐行 JSON 流式输出
+    GET /count?...                                             条数估计 (database.estimate_count)
+    GET /report?threshold=200&freq_window=10&freq_count=3&approximate=0
+    GET /poverty?threshold=140
+    GET /suspicious?threshold=200&freq_window=10&freq_count=3
+    GET /metrics                                               性能指标 (metrics.snapshot，需开启)
+用法:
+    python api_server.py --port 8765 -j 4 [--storage mmap|memory]
+"""
+import asyncio
+import base64
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict
+from datetime import date, datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import database
+import metrics
+from analyzer import DataAnalyzer
+from report_engine import SqlReportEngine
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# 工作线程数 = 连接池大小
+DEFAULT_WORKERS = 4
+# 单页最多返回的记录数
+MAX_PAGE = 5000
+# 流式输出时每次从数据库取的行数
+STREAM_PAGE = 2000
+# 请求行和请求头的总长度上限
+MAX_HEADER_BYTES = 16 * 1024
+# 请求体长度上限 (请求体只读出丢弃)
+MAX_BODY_BYTES = 1024 * 1024
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+_FILTER_KEYS = ("student_id", "name", "major", "grade", "location")
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """只读连接池：连接按需创建，最多 size 个，归还后由下一个请求复用"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all: List[sqlite3.Connection] = []
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = database.get_readonly_connection() if len(self._all) < self.size else None
+                if conn is not None:
+                    self._all.append(conn)
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FMT)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if hasattr(value, "strftime"):  # pandas Timestamp / Period
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, default=_json_default).encode("utf-8")
+
+
+def _record_dict(record) -> Dict[str, Any]:
+    d = asdict(record)
+    d["timestamp"] = record.timestamp.strftime(DATE_FMT)
+    return d
+
+
+def _encode_cursor(cursor: Optional[tuple]) -> Optional[str]:
+    if cursor is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(list(cursor)).encode()).decode()
+
+
+def _decode_cursor(token: str) -> tuple:
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return value, int(last_id)
+    except Exception:
+        raise HttpError(400, "无效的 cursor")
+
+
+class Query:
+    """查询字符串的读取与校验"""
+
+    def __init__(self, raw: str):
+        self.params = parse_qs(raw, keep_blank_values=False)
+
+    def get(self, key: str, default: str = "") -> str:
+        values = self.params.get(key)
+        return values[-1] if values else default
+
+    def number(self, key: str, default, kind=float):
+        text = self.get(key)
+        if not text:
+            return default
+        try:
+            return kind(text)
+        except ValueError:
+            raise HttpError(400, f"参数 {key} 应为数值")
+
+    def flag(self, key: str, default: bool = False) -> bool:
+        text = self.get(key)
+        return default if not text else text.lower() in ("1", "true", "yes")
+
+    def _date(self, key: str, end: bool) -> Optional[datetime]:
+        """YYYY-MM-DD HH:MM:SS，或 YYYY-MM-DD (起始取当天 0 点，结束取当天 23:59:59)"""
+        text = self.get(key)
+        if not text:
+            return None
+        if len(text) == 10:
+            text += " 23:59:59" if end else " 00:00:00"
+        try:
+            return datetime.strptime(text, DATE_FMT)
+        except ValueError:
+            raise HttpError(400, f"参数 {key} 应为 YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS")
+
+    def filters(self) -> Dict[str, Any]:
+        """与 database.fetch_records 相同的过滤参数"""
+        f = {k: self.get(k) for k in _FILTER_KEYS}
+        f["start_date"] = self._date("start", end=False)
+        f["end_date"] = self._date("end", end=True)
+        return f
+
+    def column_filters(self) -> List[Tuple[str, str, str]]:
+        result = []
+        for spec in self.params.get("filter", []):
+            parts = spec.split(",", 2)
+            if len(parts) != 3:
+                raise HttpError(400, "filter 的格式为 列,运算符,值")
+            result.append(tuple(parts))
+        return result
+
+
+class ApiServer:
+    """路由与请求处理；数据库相关的工作都在线程池中执行"""
+
+    def __init__(self, workers: int = DEFAULT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-db")
+        self.pool = ConnectionPool(workers)
+        self.routes: Dict[str, Callable] = {
+            "/health": self.health,
+            "/records": self.records,
+            "/records.ndjson": self.records_stream,
+            "/count": self.count,
+            "/report": self.report,
+            "/poverty": self.poverty,
+            "/suspicious": self.suspicious,
+            "/metrics": self.metrics,
+        }
+        self.requests = 0
+
+    async def _db(self, fn: Callable, *args, **kwargs):
+        """在线程池中用连接池里的连接执行 fn(conn, ...)"""
+        def run():
+            with self.pool.connection() as conn:
+                return fn(conn, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    # ---- 接口 ----
+
+    async def health(self, q: Query, writer):
+        row = await self._db(lambda conn: conn.execute(
+            "SELECT value FROM meta WHERE key = 'write_version'").fetchone())
+        return {"status": "ok", "write_version": row[0] if row else 0}
+
+    async def records(self, q: Query, writer):
+        sort_by = q.get("sort", "timestamp")
+        descending = q.flag("desc", True)
+        limit = min(q.number("limit", database.PAGE_SIZE, int), MAX_PAGE)
+        if limit <= 0:
+            raise HttpError(400, "limit 应为正数")
+        after = _decode_cursor(q.get("cursor")) if q.get("cursor") else None
+        records, cursor = await self._db(
+            lambda conn: database.fetch_page(sort_by, descending, after, limit, q.column_filters(),
+                                             conn=conn, **q.filters()))
+        return {"records": [_record_dict(r) for r in records], "next": _encode_cursor(cursor)}
+
+    async def records_stream(self, q: Query, writer):
+        """逐页查询并立即写出，内存占用与结果总数无关"""
+        sort_by = q.get("sort", "timestamp")
+        descending = q.flag("desc", True)
+        column_filters, filters = q.column_filters(), q.filters()
+        after = None
+        started = False
+        try:
+            while True:
+                records, after = await self._db(
+                    lambda conn, after=after: database.fetch_page(sort_by, descending, after, STREAM_PAGE,
+                                                                  column_filters, conn=conn, **filters))
+                if not started:
+                    _write_head(writer, 200, "application/x-ndjson; charset=utf-8", chunked=True)
+                    started = True
+                body = b"".join(_dumps(_record_dict(r)) + b"\n" for r in records)
+                if body:
+                    _write_chunk(writer, body)
+                    await writer.drain()
+                if after is None:
+                    break
+        except ConnectionError:
+            # 客户端已断开，没有可写的对象
+            if not started:
+                raise
+            return None
+        except Exception as e:
+            if not started:
+                raise
+            # 响应头已经发出，不能再改成 500：记录日志，以一行 error 记录收尾并正常结束分块
+            logger.exception("流式输出记录失败")
+            _write_chunk(writer, _dumps({"error": str(e)}) + b"\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return None
+
+    async def count(self, q: Query, writer):
+        cap = q.number("cap", database.COUNT_CAP, int)
+        n, exact = await self._db(
+            lambda conn: database.estimate_count(q.column_filters(), cap, conn=conn, **q.filters()))
+        return {"count": n, "exact": exact}
+
+    async def report(self, q: Query, writer):
+        threshold = q.number("threshold", 200.0)
+        window = q.number("freq_window", 10, int)
+        count = q.number("freq_count", 3, int)
+        approximate = q.flag("approximate")
+
+        def run(conn):
+            # 服务只读：不在请求里补齐草图，草图落后时退回精确计算
+            engine = SqlReportEngine(conn=conn, **q.filters())
+            return {"report": engine.generate_report(threshold, window, count),
+                    "insights": engine.get_deep_insights(approximate=approximate, read_only=True)}
+        return await self._db(run)
+
+    async def poverty(self, q: Query, writer):
+        threshold = q.number("threshold", 140.0)
+        return {"students": await self._db(lambda conn: DataAnalyzer.from_database(
+            ("detect_poverty_students",), conn=conn, **q.filters()).detect_poverty_students(threshold))}
+
+    async def suspicious(self, q: Query, writer):
+        threshold = q.number("threshold", 200.0)
+        window = q.number("freq_window", 10, int)
+        count = q.number("freq_count", 3, int)
+        return {"records": await self._db(lambda conn: DataAnalyzer.from_database(
+            ("get_suspicious_records",), conn=conn, **q.filters()).get_suspicious_records(threshold, window, count))}
+
+    async def metrics(self, q: Query, writer):
+        return metrics.snapshot()
+
+    # ---- HTTP ----
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """一个 TCP 连接上依次处理多个请求 (keep-alive)"""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    _write_json(writer, 413, {"error": "请求头过长"}, keep_alive=False)
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    _write_json(writer, 400, {"error": "无效的请求行"}, keep_alive=False)
+                    break
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                # 只支持 GET，忽略请求体
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    _write_json(writer, 400, {"error": "无效的 Content-Length"}, keep_alive=False)
+                    break
+                if length > MAX_BODY_BYTES:
+                    _write_json(writer, 413, {"error": "请求体过长"}, keep_alive=False)
+                    break
+                if length:
+                    await reader.readexactly(length)
+
+                await self._dispatch(method, target, writer, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str, writer, keep_alive: bool):
+        self.requests += 1
+        start = time.perf_counter()
+        url = urlsplit(target)
+        status = 200
+        try:
+            if method != "GET":
+                raise HttpError(405, "只支持 GET")
+            handler = self.routes.get(url.path)
+            if handler is None:
+                raise HttpError(404, f"未知的接口 {url.path}")
+            result = await handler(Query(url.query), writer)
+            if result is not None:
+                _write_json(writer, 200, result, keep_alive)
+        except HttpError as e:
+            status = e.status
+            _write_json(writer, e.status, {"error": str(e)}, keep_alive)
+        except ValueError as e:
+            status = 400
+            _write_json(writer, 400, {"error": str(e)}, keep_alive)
+        except Exception as e:
+            status = 500
+            logger.exception("处理 %s 失败", target)
+            _write_json(writer, 500, {"error": str(e)}, keep_alive)
+        elapsed = time.perf_counter() - start
+        metrics.record(f"api {url.path}", elapsed)
+        logger.debug("%s %s %d %.1fms", method, target, status, elapsed * 1000)
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, ready: Optional[Callable] = None):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+        addr = server.sockets[0].getsockname()
+        logger.info("API 服务已启动: http://%s:%d", addr[0], addr[1])
+        if ready:
+            ready(addr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=True)
+            self.pool.close()
+
+
+def _write_head(writer, status: int, content_type: str, length: Optional[int] = None,
+                keep_alive: bool = True, chunked: bool = False):
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}", f"Content-Type: {content_type}"]
+    if chunked:
+        lines.append("Transfer-Encoding: chunked")
+    else:
+        lines.append(f"Content-Length: {length}")
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+
+def _write_chunk(writer, body: bytes):
+    writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+
+
+def _write_json(writer, status: int, obj, keep_alive: bool = True):
+    body = _dumps(obj)
+    _write_head(writer, status, "application/json; charset=utf-8", len(body), keep_alive)
+    writer.write(body)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地 HTTP/JSON 查询服务")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口")
+    parser.add_argument("-j", "--workers", type=int, default=DEFAULT_WORKERS, help="查询线程数 (连接池大小)")
+    parser.add_argument("--storage", choices=database.STORAGE_MODES, default=None,
+                        help="存储模式 (默认 disk，也可由环境变量 CAMPUS_STORAGE 指定)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    database.init_db()
+    metrics.enable_from_env()
+    if args.storage:
+        database.set_storage_mode(args.storage)
+    else:
+        database.storage_from_env()
+    try:
+        asyncio.run(ApiServer(args.workers).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
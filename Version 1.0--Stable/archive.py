@@ -0,0 +1,167 @@
+"""
+历史数据归档：把早于指定月份的热数据逐月移到只读的年度归档文件
+data/archive/consumption_<年>.db 中，每个月一张表 consumption_<年>_<月>。
+查询时由 database._source_sql 按日期范围只挂载相交的分区，
+热表上的余额重算则以 archive_balances 中的期末余额为起点，不再扫描历史。
+"""
+import logging
+import os
+import stat
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List
+
+import database
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+
+def archive_path(year: str) -> Path:
+    return database.DB_PATH.parent / database.ARCHIVE_DIR_NAME / f"consumption_{year}.db"
+
+
+def _set_readonly(path: Path, readonly: bool):
+    if not path.exists():
+        return
+    if readonly:
+        os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    else:
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+
+
+def hot_months() -> List[str]:
+    """热表中现有数据的月份 (YYYY-MM)，按时间排序"""
+    conn = database.get_connection()
+    rows = conn.execute("SELECT DISTINCT substr(timestamp, 1, 7) FROM consumption ORDER BY 1").fetchall()
+    conn.close()
+    return [r[0] for r in rows]
+
+
+def list_partitions() -> List[Dict[str, Any]]:
+    """已归档的分区"""
+    conn = database.get_connection()
+    rows = database.archived_partitions(conn)
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def _next_month(month: str) -> str:
+    year, mon = (int(x) for x in month.split("-"))
+    return f"{year + mon // 12}-{mon % 12 + 1:02d}"
+
+
+# 比对热表与归档表是否为同一批行：行数、id 之和，以及按分取整的金额和余额之和 (捕捉期间的修改)
+_FINGERPRINT_SQL = """
+    SELECT COUNT(*), COALESCE(SUM(id), 0),
+           COALESCE(SUM(CAST(ROUND(amount * 100) AS INTEGER)), 0),
+           COALESCE(SUM(CAST(ROUND(balance * 100) AS INTEGER)), 0)
+    FROM {source} WHERE timestamp >= ? AND timestamp < ?
+"""
+
+
+def _commit_month(cursor, month: str, path: str, table: str, start: str, end: str,
+                  copied: tuple, stats: tuple):
+    """第二步 (写线程)：确认热表中这个月的数据与归档表一致后登记分区并从热表删除"""
+    hot = tuple(cursor.execute(_FINGERPRINT_SQL.format(source="main.consumption"), (start, end)).fetchone())
+    if hot != copied:
+        raise RuntimeError(f"归档 {month} 期间热表数据有变化 (热表 {hot[0]} 行，归档 {copied[0]} 行)，请重新归档")
+
+    # 记录每个学生截至本月末的余额 (与归档表是同一批行，直接从热表取)
+    cursor.execute("""
+        INSERT INTO main.archive_balances (student_id, balance, timestamp)
+        SELECT student_id, balance, timestamp FROM (
+            SELECT student_id, balance, timestamp,
+                   ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY timestamp DESC, id DESC) AS rn
+            FROM main.consumption
+            WHERE timestamp >= ? AND timestamp < ?
+        ) WHERE rn = 1
+        ON CONFLICT(student_id) DO UPDATE SET
+            balance = excluded.balance,
+            timestamp = excluded.timestamp
+    """, (start, end))
+    cursor.execute("""
+        INSERT OR REPLACE INTO main.archive_partitions
+            (month, path, table_name, row_count, min_ts, max_ts, archived_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (month, path, table, stats[0], stats[1], stats[2], datetime.now().strftime(DATE_FMT)))
+
+    # 归档只是换了存储位置，不触发变更监听器 (汇总表仍包含这些数据)，只递增写版本号
+    cursor.execute("DELETE FROM main.consumption WHERE timestamp >= ? AND timestamp < ?", (start, end))
+    database.bump_write_version(cursor)
+
+
+def _archive_month(month: str) -> Dict[str, Any]:
+    """
+    把一个月的热数据移到归档文件中，分两步：
+    1. 在归档文件中建表、建索引并提交 (只写归档库，单文件事务)
+    2. 经写线程核对热表中这个月的数据与归档表一致，再登记 archive_balances / archive_partitions、
+       从热表删除并递增写版本号 (只写主库)
+    两步之间中断时归档文件里只多一张未登记的表，查询不会读到它，重新归档会先删掉重建
+    """
+    year, mon = month.split("-")
+    path = archive_path(year)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = f"consumption_{year}_{mon}"
+    start = f"{month}-01 00:00:00"
+    end = f"{_next_month(month)}-01 00:00:00"
+    cols = ", ".join(database.RECORD_COLUMNS)
+
+    _set_readonly(path, False)
+    conn = database.get_disk_connection()
+    try:
+        schema = database._attach_archive(conn, str(path), readonly=False)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        # 清理上次中断可能留下的未登记的表
+        cursor.execute(f"DROP TABLE IF EXISTS {schema}.{table}")
+        cursor.execute(f"""
+            CREATE TABLE {schema}.{table} AS
+            SELECT {cols} FROM main.consumption
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp, id
+        """, (start, end))
+        cursor.execute(f"CREATE INDEX {schema}.idx_{table}_student_ts ON {table} (student_id, timestamp)")
+        cursor.execute(f"CREATE INDEX {schema}.idx_{table}_ts ON {table} (timestamp)")
+
+        stats = cursor.execute(
+            f"SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM {schema}.{table}"
+        ).fetchone()
+        copied = tuple(cursor.execute(_FINGERPRINT_SQL.format(source=f"{schema}.{table}"), (start, end)).fetchone())
+        conn.commit()
+        conn.execute(f"DETACH DATABASE {schema}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        _set_readonly(path, True)
+
+    database.write(_commit_month, month, str(path), table, start, end, copied, tuple(stats)).result()
+
+    logger.info("归档 %s: %d 行 -> %s:%s", month, stats[0], path.name, table)
+    return {"month": month, "path": str(path), "table_name": table, "row_count": stats[0]}
+
+
+def archive_before(month: str) -> List[Dict[str, Any]]:
+    """
+    归档所有早于 month (YYYY-MM，不含该月) 的热数据
+    必须按时间顺序整月归档，余额链才能从归档期末余额接续
+    """
+    datetime.strptime(month, "%Y-%m")
+    return [_archive_month(m) for m in hot_months() if m < month]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="把历史月份归档到只读分区文件")
+    parser.add_argument("before", nargs="?", help="归档早于该月份 (YYYY-MM) 的数据；省略则只列出分区")
+    args = parser.parse_args()
+
+    database.init_db()
+    if args.before:
+        for part in archive_before(args.before):
+            print(f"{part['month']}: {part['row_count']} 行 -> {part['path']}")
+    for part in list_partitions():
+        print(f"{part['month']}  {part['row_count']:>10}  {part['path']}:{part['table_name']}")
@@ -0,0 +1,848 @@
+"""
+性能基准：在临时数据库中生成合成数据，对比不同查询/分析路径的耗时
+用法:
+    python bench.py search --rows 10000000
+    python bench.py projection --rows 1000000
+    python bench.py report --rows 1000000
+    python bench.py sketch --rows 1000000
+    python bench.py baseline --rows 10000000
+    python bench.py rules --rows 10000000
+    python bench.py balance --rows 10000000
+    python bench.py forecast --rows 10000000
+    python bench.py cluster --rows 10000000
+    python bench.py heatmap --rows 10000000
+    python bench.py cohort --rows 1000000
+    python bench.py chart
+    python bench.py table --rows 10000000
+    python bench.py api --rows 1000000 --concurrency 16 --seconds 10
+    python bench.py snapshot --rows 10000000
+    python bench.py storage --rows 10000000
+合成库会缓存在 --db 指定的位置 (默认 data/bench_<行数>.db)，重复运行时直接复用
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import database
+from utils import DATE_FMT
+
+SURNAMES = "赵钱孙李周吴郑王冯陈褚卫蒋沈韩杨朱秦尤许何吕施张孔曹严华金魏陶姜"
+GIVEN = "伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华玉萍红娥玲芬燕彬欣"
+MAJORS = ["计算机", "土木工程", "自动化", "电子信息", "心理学", "数学", "物理", "化学", "经济学", "法学"]
+GRADES = ["2021", "2022", "2023", "2024", "2025"]
+LOCATIONS = [
+    ("一区食堂", "餐饮美食"), ("二区食堂", "餐饮美食"), ("三区食堂", "餐饮美食"),
+    ("清真食堂", "餐饮美食"), ("图书馆便利店", "购物超市"), ("东区超市", "购物超市"),
+    ("1897咖啡", "休闲娱乐"), ("学生活动中心", "休闲娱乐"),
+]
+
+
+def build_synthetic_db(path: Path, rows: int, students: int = 20000, seed: int = 42) -> Path:
+    """生成 rows 条合成交易写入 path (已存在且行数一致时直接复用)"""
+    database.DB_PATH = path
+    if path.exists():
+        database.init_db()  # 旧的缓存库补齐新增的表/索引
+        conn = database.get_connection()
+        try:
+            if conn.execute("SELECT COUNT(*) FROM consumption").fetchone()[0] >= rows:
+                total, sums = _summary_counts(conn)
+                if sums != (total,) * len(sums):
+                    _rebuild_summaries(conn)  # 旧版本生成的缓存库没有重建汇总表
+                return path
+        finally:
+            conn.close()
+        path.unlink()
+
+    database.init_db()
+    rng = random.Random(seed)
+    people = []
+    for i in range(students):
+        people.append((
+            f"{GRADES[i % len(GRADES)]}{i:06d}",
+            rng.choice(SURNAMES) + "".join(rng.choice(GIVEN) for _ in range(rng.choice((1, 2)))),
+            MAJORS[i % len(MAJORS)],
+            GRADES[i % len(GRADES)],
+        ))
+
+    start = datetime(2022, 9, 1)
+    span = int(timedelta(days=3 * 365).total_seconds())
+
+    def gen():
+        for i in range(rows):
+            sid, name, major, grade = people[rng.randrange(students)]
+            ts = (start + timedelta(seconds=rng.randrange(span))).strftime(DATE_FMT)
+            if rng.random() < 0.05:
+                location, merchant, tx_type, amount = "学生活动中心", "充值", "充值", float(rng.choice((50, 100, 200)))
+            else:
+                location, merchant = LOCATIONS[rng.randrange(len(LOCATIONS))]
+                tx_type, amount = "消费", round(rng.uniform(3, 40), 2)
+            yield (sid, name, major, grade, 0.0, ts, amount, merchant, location, tx_type,
+                   database.tx_fingerprint(sid, ts, amount, location))
+
+    conn = database.get_connection()
+    t0 = time.perf_counter()
+    # 批量生成时先去掉全文索引及其触发器，写完后一次性重建
+    conn.execute("DROP TABLE IF EXISTS consumption_fts")
+    for suffix in ("ai", "ad", "au"):
+        conn.execute(f"DROP TRIGGER IF EXISTS consumption_fts_{suffix}")
+    conn.executemany(f"""
+        INSERT OR IGNORE INTO consumption ({', '.join(database.INSERT_COLUMNS)})
+        VALUES ({', '.join('?' * len(database.INSERT_COLUMNS))})
+    """, gen())
+    database._ensure_fts(conn.cursor())
+    _rebuild_summaries(conn)
+    conn.close()
+    print(f"生成 {rows} 行合成数据 -> {path} ({time.perf_counter() - t0:.1f}s)")
+    return path
+
+
+def _rebuild_summaries(conn):
+    """
+    批量插入绕过了变更监听器，由监听器维护的无水位汇总表 (daily_summary、地点负载立方体)
+    需要整表重建；带水位的草图/基线/特征表在首次使用时自行补齐
+    """
+    database._rebuild_daily_summary(conn.cursor())
+    database._rebuild_location_load(conn)  # 内部提交
+
+
+def _summary_counts(conn) -> Tuple[int, Tuple[int, int, int]]:
+    """(消费笔数, (daily_summary, location_load, location_load_monthly) 中的消费笔数)"""
+    rows = conn.execute("SELECT COUNT(*) FROM consumption WHERE tx_type = '消费'").fetchone()[0]
+    return rows, tuple(conn.execute(sql).fetchone()[0] for sql in (
+        "SELECT COALESCE(SUM(tx_count), 0) FROM daily_summary WHERE tx_type = '消费'",
+        "SELECT COALESCE(SUM(tx_count), 0) FROM location_load",
+        "SELECT COALESCE(SUM(tx_count), 0) FROM location_load_monthly",
+    ))
+
+
+def measure(fn: Callable[[], object], repeat: int = 5) -> Tuple[float, float, object]:
+    """执行 repeat 次，返回 (最快, 中位数, 最后一次的结果)，单位毫秒"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - t0) * 1000)
+    return min(times), statistics.median(times), result
+
+
+def print_table(title: str, rows: List[Dict[str, object]]):
+    print(f"\n== {title} ==")
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    widths = {k: max(len(k), *(len(str(r[k])) for r in rows)) for k in keys}
+    print("  ".join(k.ljust(widths[k]) for k in keys))
+    for r in rows:
+        print("  ".join(str(r[k]).ljust(widths[k]) for k in keys))
+
+
+def bench_search(args):
+    """子串过滤：LIKE 全表扫描 vs FTS5 trigram 索引"""
+    build_synthetic_db(args.db, args.rows)
+    conn = database.get_connection()
+
+    cases = [
+        ("student_id", "000123"),
+        ("student_id", "2024"),
+        ("name", "王伟"),      # 两个字，走 LIKE
+        ("name", "赵芳娜"),
+        ("location", "便利店"),
+        ("major", "电子信息"),
+    ]
+    out = []
+    for col, value in cases:
+        like_sql = f"SELECT id FROM consumption WHERE {col} LIKE ?"
+        like_best, like_med, like_rows = measure(
+            lambda: conn.execute(like_sql, (f"%{value}%",)).fetchall(), args.repeat)
+
+        where, params = database._filter_clause(conn, **{col: value})
+        fts_sql = f"SELECT id FROM consumption WHERE {where}"
+        fts_best, fts_med, fts_rows = measure(lambda: conn.execute(fts_sql, params).fetchall(), args.repeat)
+
+        out.append({
+            "列": col, "关键字": value, "命中行数": len(fts_rows),
+            "LIKE(ms)": f"{like_med:.1f}", "索引路径(ms)": f"{fts_med:.1f}",
+            "加速": f"{like_med / fts_med:.1f}x" if fts_med else "-",
+            "结果一致": len(like_rows) == len(fts_rows),
+        })
+    conn.close()
+    print_table(f"子串过滤 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def measure_peak(fn: Callable[[], object]) -> Tuple[float, object]:
+    """在 tracemalloc 下执行一次，返回 (Python 堆内存峰值 MB, 结果)；耗时请另行测量"""
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20, result
+
+
+def bench_projection(args):
+    """分析加载：SELECT * + ConsumptionRecord 对象 vs 只查询所需列的列式数组"""
+    from analyzer import DataAnalyzer
+
+    build_synthetic_db(args.db, args.rows)
+
+    out = []
+    for analysis in ("get_deep_insights", "detect_poverty_students", "generate_report"):
+        cols = DataAnalyzer.columns_for(analysis)
+
+        def full():
+            return DataAnalyzer(database.fetch_records())
+
+        def projected():
+            return DataAnalyzer.from_database((analysis,))
+
+        _, full_ms, _ = measure(full, args.repeat)
+        _, proj_ms, _ = measure(projected, args.repeat)
+        full_mb, a = measure_peak(full)
+        proj_mb, b = measure_peak(projected)
+        out.append({
+            "分析": analysis, "列数": f"{len(cols)}/{len(database.RECORD_COLUMNS)}",
+            "全量加载(ms)": f"{full_ms:.0f}", "投影加载(ms)": f"{proj_ms:.0f}",
+            "全量峰值(MB)": f"{full_mb:.0f}", "投影峰值(MB)": f"{proj_mb:.0f}",
+            "DataFrame(MB)": f"{a.df.memory_usage(deep=True).sum() / 2**20:.0f} -> "
+                             f"{b.df.memory_usage(deep=True).sum() / 2**20:.0f}",
+        })
+    print_table(f"分析数据加载 ({args.rows} 行)", out)
+
+
+def bench_report(args):
+    """统计报告：加载到 pandas 计算 vs 在 SQLite 内聚合 (SqlReportEngine)"""
+    from analyzer import DataAnalyzer
+    from report_engine import SqlReportEngine
+
+    build_synthetic_db(args.db, args.rows)
+    analyses = ("generate_report", "get_deep_insights")
+
+    cases = [
+        ("全部", {}),
+        ("按日期", {"start_date": datetime(2023, 9, 1), "end_date": datetime(2024, 1, 31, 23, 59, 59)}),
+        ("按专业", {"major": "数学"}),
+        ("按学生", {"student_id": "2021000000"}),
+    ]
+    out = []
+    for label, filters in cases:
+        def pandas_path():
+            a = DataAnalyzer.from_database(analyses, **filters)
+            return a.generate_report(200.0, 10, 3), a.get_deep_insights()
+
+        def sql_path():
+            e = SqlReportEngine(**filters)
+            return e.generate_report(200.0, 10, 3), e.get_deep_insights()
+
+        _, pd_ms, pd_result = measure(pandas_path, args.repeat)
+        _, sql_ms, sql_result = measure(sql_path, args.repeat)
+        sql_report = sql_result[0]
+        pd_mb, _ = measure_peak(pandas_path)
+        sql_mb, _ = measure_peak(sql_path)
+        out.append({
+            "过滤": label, "记录数": sql_report["habits"]["count"],
+            "pandas(ms)": f"{pd_ms:.0f}", "SQL(ms)": f"{sql_ms:.0f}",
+            "加速": f"{pd_ms / sql_ms:.1f}x" if sql_ms else "-",
+            "pandas峰值(MB)": f"{pd_mb:.0f}", "SQL峰值(MB)": f"{sql_mb:.1f}",
+            # 金额合计两边都规整到分 (utils.money)，报告与深度分析应逐项完全相同
+            "结果一致": pd_result == sql_result,
+        })
+    print_table(f"统计报告 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def bench_sketch(args):
+    """深度分析：精确 SQL 聚合 vs 合并每日草图的近似模式，并给出实际误差"""
+    import numpy as np
+    import sketches
+    from report_engine import APPROX_QUANTILES, SqlReportEngine
+
+    build_synthetic_db(args.db, args.rows)
+    t0 = time.perf_counter()
+    sketches.refresh()
+    print(f"草图补齐/构建: {time.perf_counter() - t0:.1f}s")
+
+    cases = [
+        ("全部", {}),
+        ("一学期", {"start_date": datetime(2023, 9, 1), "end_date": datetime(2024, 1, 31, 23, 59, 59)}),
+        ("一周", {"start_date": datetime(2023, 10, 9), "end_date": datetime(2023, 10, 15, 23, 59, 59)}),
+    ]
+    conn = database.get_connection()
+    out = []
+    for label, filters in cases:
+        engine = SqlReportEngine(**filters)
+        _, exact_ms, exact = measure(engine.get_deep_insights, args.repeat)
+        _, approx_ms, approx = measure(lambda: engine.get_deep_insights(approximate=True), args.repeat)
+
+        source, _ = database._source_sql(conn, filters.get("start_date"), filters.get("end_date"))
+        where, params = database._filter_clause(conn, **filters)
+        amounts = np.array([r[0] for r in conn.execute(
+            f"SELECT amount FROM {source} WHERE {where} AND tx_type = '消费'", params)])
+        quantile_err = max(
+            abs(np.searchsorted(np.sort(amounts), approx["approx"]["amount_quantiles"][q]) / len(amounts) - q)
+            for q in APPROX_QUANTILES
+        )
+        out.append({
+            "范围": label, "天数": approx["approx"]["days"],
+            "精确(ms)": f"{exact_ms:.0f}", "近似(ms)": f"{approx_ms:.0f}",
+            "学生数": f"{exact['student_count']} / {approx['student_count']}",
+            "学生数误差": f"{abs(approx['student_count'] / exact['student_count'] - 1):.2%}"
+                          f" (σ={approx['approx']['student_count_error']:.2%})",
+            "分位数秩误差": f"{quantile_err:.4f}",
+            "Top5一致": list(exact["top_locations"]) == list(approx["top_locations"]),
+        })
+    conn.close()
+    print_table(f"近似深度分析 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def synthetic_frame(rows: int, students: int = 20000):
+    """内存中直接生成按入库 (时间) 顺序排列的消费 DataFrame，不经过数据库"""
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(42)
+    sid = np.array([f"{GRADES[i % len(GRADES)]}{i:06d}" for i in range(students)], dtype=object)
+    locs = np.array([loc for loc, _ in LOCATIONS], dtype=object)
+    # 每个学生有自己的消费水平，作息集中在三餐时段
+    level = rng.uniform(8, 30, students)
+    who = rng.integers(0, students, rows)
+    day = rng.integers(0, 3 * 365, rows)
+    hour = rng.choice([7, 8, 11, 12, 13, 17, 18, 19, 21, 2], rows,
+                      p=[.12, .10, .15, .15, .08, .12, .12, .08, .07, .01])
+    seconds = np.sort(day * 86400 + hour * 3600 + rng.integers(0, 3600, rows))
+    return pd.DataFrame({
+        "id": np.arange(rows),
+        "student_id": sid[who],
+        "name": "",
+        "major": "",
+        "timestamp": np.datetime64("2022-09-01") + seconds.astype("timedelta64[s]"),
+        "amount": np.round(rng.gamma(4, level[who] / 4), 2),
+        "tx_type": "消费",
+        "location": locs[rng.integers(0, len(locs), rows)],
+    })
+
+
+def bench_baseline(args):
+    """学生基线异常检测：向量化对整段历史打分"""
+    from anomaly import BaselineDetector
+
+    students = 20000
+    df = synthetic_frame(args.rows, students)
+    detector = BaselineDetector()
+    _, score_ms, scored = measure(lambda: detector.score(df), args.repeat)
+    _, build_ms, baselines = measure(lambda: detector.build_baselines(df), args.repeat)
+    print_table(f"基线检测 ({args.rows} 行, {students} 名学生, 中位数, {args.repeat} 次)", [{
+        "打分(ms)": f"{score_ms:.0f}", "构建基线(ms)": f"{build_ms:.0f}",
+        "行/秒": f"{args.rows / score_ms * 1000:,.0f}",
+        "偏离基线": int(scored["z_flag"].sum()), "非常规时段": int(scored["hour_flag"].sum()),
+        "新地点": int(scored["location_flag"].sum()), "学生数": len(baselines),
+    }])
+
+
+def bench_rules(args):
+    """规则引擎：一次排序后逐条执行默认规则，报告每条规则的命中数与耗时 (取耗时中位数的一轮)"""
+    from anomaly import DEFAULT_EXTRA_RULES, RuleEngine, threshold_rules
+
+    df = synthetic_frame(args.rows)
+    engine = RuleEngine.from_specs(threshold_rules(100, 10, 3) + DEFAULT_EXTRA_RULES)
+    runs = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        suspicious, stats = engine.run(df)
+        runs.append(((time.perf_counter() - t0) * 1000, engine.prepare_millis, stats, len(suspicious)))
+    total_ms, prepare_ms, stats, hits = sorted(runs, key=lambda r: r[0])[len(runs) // 2]
+
+    out = [{"规则": "(排序)", "类型": "", "命中": "", "耗时(ms)": f"{prepare_ms:.0f}"}]
+    out += [{"规则": s.label, "类型": s.kind, "命中": s.hits, "耗时(ms)": f"{s.millis:.0f}"} for s in stats]
+    out.append({"规则": "(合计)", "类型": "", "命中": hits, "耗时(ms)": f"{total_ms:.0f}"})
+    print_table(f"规则引擎 ({args.rows} 行, 中位数, {args.repeat} 次, "
+                f"行/秒 {args.rows / statistics.median(r[0] for r in runs) * 1000:,.0f})", out)
+
+
+def bench_balance(args):
+    """余额校验与修复：合成数据的余额全为 0，所有行都需要修复 (在副本上执行，不改动缓存库)"""
+    import os
+    import shutil
+    import integrity
+
+    build_synthetic_db(args.db, args.rows)
+    work = args.db.with_name(args.db.stem + "_balance.db")
+    shutil.copyfile(args.db, work)
+    database.DB_PATH = work
+    try:
+        out = []
+        for workers in sorted({1, os.cpu_count() or 1}):
+            _, ms, report = measure(lambda: integrity.verify_balances(workers=workers), args.repeat)
+            out.append({"操作": f"校验 ({workers} 进程)", "耗时(ms)": f"{ms:.0f}",
+                        "行/秒": f"{report.rows / ms * 1000:,.0f}", "不一致": report.divergent})
+        t0 = time.perf_counter()
+        report = integrity.verify_balances(repair=True)
+        ms = (time.perf_counter() - t0) * 1000
+        out.append({"操作": "校验+修复", "耗时(ms)": f"{ms:.0f}",
+                    "行/秒": f"{report.rows / ms * 1000:,.0f}", "不一致": report.repaired})
+        _, ms, report = measure(lambda: integrity.verify_balances(), 1)
+        out.append({"操作": "修复后校验", "耗时(ms)": f"{ms:.0f}",
+                    "行/秒": f"{report.rows / ms * 1000:,.0f}", "不一致": report.divergent})
+    finally:
+        work.unlink()
+    print_table(f"余额校验 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def bench_forecast(args):
+    """全校余额预测：首次计算 (两次分组查询 + 数组运算) 与同一写版本下的缓存命中"""
+    import forecast
+
+    build_synthetic_db(args.db, args.rows)
+    out = []
+    for days in (7, 28, 90):
+        def cold():
+            forecast._cache.clear()
+            return forecast.forecast(lookback_days=days)
+        _, cold_ms, df = measure(cold, args.repeat)
+        _, warm_ms, _ = measure(lambda: forecast.forecast(lookback_days=days), args.repeat)
+        out.append({"历史天数": days, "学生数": len(df), "首次(ms)": f"{cold_ms:.0f}", "缓存(ms)": f"{warm_ms:.1f}"})
+    print_table(f"余额预测 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def bench_cluster(args):
+    """学生画像聚类：全量构建特征表、增量并入最后 1% 的行、由特征表聚类"""
+    import clustering
+
+    build_synthetic_db(args.db, args.rows)
+    conn = database.get_connection()
+    max_id = database._max_id(conn.cursor())
+    conn.close()
+    tail = max(max_id - args.rows // 100, 0)
+
+    _, full_ms, students = measure(clustering.rebuild_features, args.repeat)
+
+    def rewind(cursor):
+        removed = cursor.execute("SELECT * FROM consumption WHERE id > ?", (tail,)).fetchall()
+        clustering._update_features(cursor, None, removed)
+        clustering._set_watermark(cursor, tail)
+
+    def incremental():
+        # 把水位退回到最后 1% 之前 (先减去这部分的统计)，再由 refresh 增量并入
+        database.write(rewind).result()
+        t0 = time.perf_counter()
+        clustering.refresh()
+        return (time.perf_counter() - t0) * 1000
+    inc_ms = statistics.median(incremental() for _ in range(args.repeat))
+
+    _, matrix_ms, features = measure(clustering.feature_matrix, args.repeat)
+    _, cluster_ms, result = measure(lambda: clustering.cluster_students(8), args.repeat)
+    # 行数较少时可能没有学生达到 MIN_TX 笔，聚类结果为空
+    largest = result.summaries[0]["size"] if result.summaries else f"无符合条件的学生 (不足 {clustering.MIN_TX} 笔)"
+    print_table(f"学生画像聚类 ({args.rows} 行, {students} 名学生, 中位数, {args.repeat} 次)", [{
+        "全量构建(ms)": f"{full_ms:.0f}", f"增量 {max_id - tail} 行(ms)": f"{inc_ms:.0f}",
+        "特征矩阵(ms)": f"{matrix_ms:.0f}", "聚类 k=8 (ms)": f"{cluster_ms:.0f}",
+        "维数": features.shape[1] - 1, "最大类": largest,
+    }])
+
+
+def bench_heatmap(args):
+    """地点负载热力图：读负载立方体 vs 加载明细后用 pandas 分组"""
+    import pandas as pd
+
+    build_synthetic_db(args.db, args.rows)
+    conn = database.get_connection()
+    lo, hi = conn.execute("SELECT MIN(timestamp), MAX(timestamp) FROM consumption").fetchone()
+    rows, cubes = _summary_counts(conn)
+    conn.close()
+    assert cubes[1:] == (rows, rows), f"负载立方体笔数 {cubes[1:]} 与消费记录数 {rows} 不一致"
+    first, last = datetime.strptime(lo, DATE_FMT), datetime.strptime(hi, DATE_FMT)
+    ranges = [
+        ("全部", None, None),
+        ("一年", last - timedelta(days=365), last),
+        ("跨月 45 天", last - timedelta(days=45), last),
+        ("一周", last - timedelta(days=7), last),
+    ]
+
+    def from_rows(start, end):
+        df = pd.DataFrame(database.fetch_columns(("timestamp", "location", "amount", "tx_type"),
+                                                 start_date=start, end_date=end))
+        df = df[df["tx_type"] == "消费"]
+        ts = df["timestamp"].dt
+        return df.groupby(["location", ts.weekday, ts.hour * 4 + ts.minute // 15])["amount"].agg(["count", "sum"])
+
+    out = []
+    for label, start, end in ranges:
+        _, cube_ms, cube = measure(lambda: database.fetch_location_load(start, end), args.repeat)
+        _, rows_ms, _ = measure(lambda: from_rows(start, end), max(1, args.repeat // 2))
+        out.append({"范围": label, "立方体(ms)": f"{cube_ms:.1f}", "明细分组(ms)": f"{rows_ms:.0f}",
+                    "加速": f"{rows_ms / cube_ms:.0f}x", "笔数": int(cube["count"].sum())})
+    print_table(f"地点负载热力图 ({args.rows} 行, {first:%Y-%m} ~ {last:%Y-%m}, 中位数)", out)
+
+
+def bench_cohort(args):
+    """专业/年级对比：每个群体单独跑 SqlReportEngine vs 一次分组扫描后上卷 (cohort.py)"""
+    import cohort
+    from report_engine import SqlReportEngine
+
+    build_synthetic_db(args.db, args.rows)
+    params = (200.0, 10, 3)
+
+    def per_cohort():
+        results = {}
+        for field, values in (("major", MAJORS), ("grade", GRADES)):
+            for value in values:
+                e = SqlReportEngine(**{field: value})
+                results[value] = (e.generate_report(*params), e.get_deep_insights())
+        return results
+
+    def cold():
+        cohort._cache.clear()
+        return cohort.compare_cohorts(*params)
+
+    _, each_ms, expected = measure(per_cohort, 1)
+    _, cold_ms, report = measure(cold, args.repeat)
+    _, warm_ms, _ = measure(lambda: cohort.compare_cohorts(*params), args.repeat)
+    same = all(
+        c.habits == expected[c.key[0]][0]["habits"]
+        and c.anomalies == expected[c.key[0]][0]["anomalies"]
+        and c.insights == expected[c.key[0]][1]
+        for level in ("major", "grade") for c in report.levels[level]
+    )
+    print_table(f"群体对比 ({args.rows} 行, {len(MAJORS)} 个专业 + {len(GRADES)} 个年级)", [{
+        "逐个群体(ms)": f"{each_ms:.0f}", "分组扫描(ms)": f"{cold_ms:.0f}", "缓存(ms)": f"{warm_ms:.1f}",
+        "加速": f"{each_ms / cold_ms:.1f}x", "专业×年级": len(report.levels["major_grade"]), "结果一致": same,
+    }])
+
+
+def bench_chart(args):
+    """趋势图刷新：清空坐标轴逐点重画 + tight_layout vs 降采样后替换折线数据 (charts.TrendPlot)，Agg 离屏渲染"""
+    import logging
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import numpy as np
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import charts
+
+    logging.getLogger("matplotlib").setLevel(logging.ERROR)
+    rng = np.random.default_rng(0)
+    cases = [
+        ("1 年日序列", "D", 365, "%Y-%m-%d"),
+        ("10 年日序列", "D", 3650, "%Y-%m-%d"),
+        ("10 年小时序列", "h", 87600, DATE_FMT),
+    ]
+    out = []
+    for label, unit, n, fmt in cases:
+        stamps = np.arange(np.datetime64("2015-01-01", unit), np.datetime64("2015-01-01", unit) + n)
+        keys = [datetime.fromisoformat(str(t)).strftime(fmt) for t in stamps]
+        # 两组数据交替，保证每次刷新的数据都不同
+        series = [dict(zip(keys, rng.uniform(50, 500, n).tolist())) for _ in range(2)]
+
+        fig = Figure(figsize=(10, 3.5))
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.subplots(1, 2)[0]
+        calls = iter(range(10 ** 9))
+
+        def old_path():
+            data = series[next(calls) % 2]
+            ax.clear()
+            xs = [datetime.strptime(k, fmt) for k in data.keys()]
+            ax.plot(xs, list(data.values()), marker="o", linestyle="-", markersize=4)
+            ax.xaxis.set_major_formatter(mdates.DateFormatter("%m-%d"))
+            ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+            ax.tick_params(axis="x", rotation=30)
+            fig.tight_layout()
+            canvas.draw()
+
+        _, old_ms, _ = measure(old_path, args.repeat)
+
+        ax.clear()
+        plot = charts.TrendPlot(ax)
+        fig.tight_layout()
+        canvas.draw()
+        _, update_ms, _ = measure(lambda: plot.update(series[next(calls) % 2]), args.repeat)
+
+        def new_path():
+            plot.update(series[next(calls) % 2])
+            canvas.draw()
+
+        _, new_ms, _ = measure(new_path, args.repeat)
+        out.append({"序列": label, "点数": n, "绘制点数": plot.points, "重画(ms)": f"{old_ms:.0f}",
+                    "更新数据(ms)": f"{update_ms:.1f}", "更新+渲染(ms)": f"{new_ms:.0f}",
+                    "加速": f"{old_ms / new_ms:.1f}x"})
+    print_table(f"趋势图刷新 (中位数, {args.repeat} 次)", out)
+
+
+def bench_table(args):
+    """结果表：一次加载全部记录 (fetch_records) vs 按列排序的 keyset 分页 (fetch_page)"""
+    build_synthetic_db(args.db, args.rows)
+    database.init_db()  # 补建排序索引
+    _, full_ms, records = measure(database.fetch_records, 1)
+
+    out = [{"排序": "姓名+时间 (全部加载)", "首页(ms)": f"{full_ms:.0f}", "第 100 页(ms)": "-", "行数": len(records)}]
+    del records
+    for col, desc in (("timestamp", True), ("amount", True), ("balance", False), ("name", False), ("major", False)):
+        _, first_ms, (page, cursor) = measure(lambda: database.fetch_page(col, desc), args.repeat)
+        for _ in range(98):
+            if cursor is None:
+                break
+            page, cursor = database.fetch_page(col, desc, cursor)
+        _, deep_ms, _ = measure(lambda: database.fetch_page(col, desc, cursor), args.repeat)
+        out.append({"排序": f"{col} {'降序' if desc else '升序'}", "首页(ms)": f"{first_ms:.1f}",
+                    "第 100 页(ms)": f"{deep_ms:.1f}", "行数": database.PAGE_SIZE})
+    out.append({"排序": "amount 降序 + 列过滤 消费/食堂", "首页(ms)": "{:.1f}".format(measure(
+        lambda: database.fetch_page("amount", True, column_filters=[("tx_type", "=", "消费"), ("location", "包含", "食堂")]),
+        args.repeat)[1]), "第 100 页(ms)": "-", "行数": database.PAGE_SIZE})
+    print_table(f"结果表加载 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+# 负载测试的请求组合：(名称, 路径)
+API_MIX = [
+    ("records", "/records?limit=50"),
+    ("records 按金额", "/records?major=%E8%AE%A1%E7%AE%97%E6%9C%BA&sort=amount&limit=50"),
+    ("count", "/count?grade=2023"),
+    ("report", "/report?major=%E6%B3%95%E5%AD%A6&grade=2024"),
+    ("poverty", "/poverty?major=%E6%95%B0%E5%AD%A6&grade=2022"),
+    ("suspicious", "/suspicious?major=%E7%89%A9%E7%90%86&grade=2021&threshold=150"),
+]
+
+
+def _start_api(workers: int):
+    """在后台线程的事件循环中启动 api_server，返回 (地址, 停止函数)"""
+    import api_server
+
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        async def main():
+            state["loop"] = asyncio.get_running_loop()
+            state["task"] = asyncio.current_task()
+            await api_server.ApiServer(workers).serve("127.0.0.1", 0, ready=lambda a: (state.update(addr=a), ready.set()))
+        try:
+            asyncio.run(main())
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+
+    def stop():
+        state["loop"].call_soon_threadsafe(state["task"].cancel)
+        thread.join()
+    return state["addr"], stop
+
+
+async def _api_client(host: str, port: int, paths: List[Tuple[str, str]], deadline: float,
+                      latencies: Dict[str, List[float]], offset: int):
+    """一个 keep-alive 连接，按顺序循环发送请求直到 deadline"""
+    reader, writer = await asyncio.open_connection(host, port)
+    i = offset
+    try:
+        while time.perf_counter() < deadline:
+            name, path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            status = int(head.split(b" ", 2)[1])
+            length = int(head.lower().split(b"content-length:", 1)[1].split(b"\r\n", 1)[0])
+            await reader.readexactly(length)
+            if status != 200:
+                raise RuntimeError(f"{path} 返回 {status}")
+            latencies[name].append((time.perf_counter() - start) * 1000)
+    finally:
+        writer.close()
+
+
+def bench_api(args):
+    """HTTP 查询服务：并发 keep-alive 客户端循环请求各接口，统计吞吐量与延迟 (单线程单连接 vs 连接池)"""
+    build_synthetic_db(args.db, args.rows)
+    database.init_db()
+
+    out = []
+    for workers in sorted({1, args.workers}):
+        (host, port), stop = _start_api(workers)
+        latencies: Dict[str, List[float]] = {name: [] for name, _ in API_MIX}
+
+        async def load():
+            deadline = time.perf_counter() + args.seconds
+            await asyncio.gather(*(_api_client(host, port, API_MIX, deadline, latencies, i)
+                                   for i in range(args.concurrency)))
+        start = time.perf_counter()
+        try:
+            asyncio.run(load())
+        finally:
+            stop()
+        elapsed = time.perf_counter() - start
+
+        everything = [ms for values in latencies.values() for ms in values]
+        for name, values in list(latencies.items()) + [("合计", everything)]:
+            if not values:
+                continue
+            values.sort()
+            out.append({
+                "线程": workers,
+                "接口": name,
+                "请求数": len(values),
+                "req/s": f"{len(values) / elapsed:.1f}",
+                "p50(ms)": f"{values[len(values) // 2]:.1f}",
+                "p95(ms)": f"{values[int(len(values) * 0.95)]:.1f}",
+            })
+    print_table(f"HTTP 查询服务 ({args.rows} 行, {args.concurrency} 个并发连接, 每轮 {args.seconds}s)", out)
+
+
+def bench_snapshot(args):
+    """分析加载：按列查询数据库 (fetch_columns) vs 内存映射列式快照 (首次映射 / 已映射)"""
+    import shutil
+
+    import snapshot
+    from analyzer import DataAnalyzer
+
+    build_synthetic_db(args.db, args.rows)
+    shutil.rmtree(snapshot.snapshot_dir(), ignore_errors=True)
+    t0 = time.perf_counter()
+    path = snapshot.build()
+    build_s = time.perf_counter() - t0
+    size = sum(p.stat().st_size for p in path.iterdir()) / 2**20
+    print(f"快照构建 {build_s:.1f}s, {size:.0f}MB ({path})")
+
+    conn = database.get_connection()
+    sid = conn.execute("SELECT student_id FROM consumption LIMIT 1").fetchone()[0]
+    day = conn.execute("SELECT MAX(timestamp) FROM consumption").fetchone()[0][:10]
+    conn.close()
+    end = datetime.strptime(day, "%Y-%m-%d")
+    cases = [
+        ("generate_report", {}),
+        ("get_deep_insights", {}),
+        ("detect_poverty_students", {}),
+        ("generate_report", {"student_id": sid}),
+        ("generate_report", {"location": "食堂", "start_date": end - timedelta(days=30), "end_date": end}),
+    ]
+    out = []
+    try:
+        for analysis, filters in cases:
+            cols = DataAnalyzer.columns_for(analysis)
+
+            def cold():
+                snapshot.clear_cache()
+                return snapshot.load(cols, **filters)
+
+            _, sql_ms, a = measure(lambda: database.fetch_columns(cols, **filters), args.repeat)
+            _, cold_ms, _ = measure(cold, args.repeat)
+            _, warm_ms, b = measure(lambda: snapshot.load(cols, **filters), args.repeat)
+            out.append({
+                "分析": analysis, "过滤": ",".join(filters) or "-", "行数": len(b[cols[0]]),
+                "数据库(ms)": f"{sql_ms:.0f}", "快照首次(ms)": f"{cold_ms:.1f}", "快照已映射(ms)": f"{warm_ms:.1f}",
+                "加速": f"{sql_ms / cold_ms:.0f}x" if cold_ms else "-",
+                "行数一致": len(a[cols[0]]) == len(b[cols[0]]),
+            })
+    finally:
+        # 其它子命令测的是查询数据库的路径，不留下快照
+        snapshot.clear_cache()
+        shutil.rmtree(snapshot.snapshot_dir(), ignore_errors=True)
+    print_table(f"分析数据加载 ({args.rows} 行, 中位数, {args.repeat} 次)", out)
+
+
+def bench_storage(args):
+    """
+    存储模式：磁盘 / 内存映射 (mmap) / 整库载入内存下的记录查询、聚合与写入 (在副本上执行)
+    库文件已在操作系统页缓存中时，差别主要来自每页的读取系统调用和拷贝；冷缓存下差距更大
+    """
+    import shutil
+    import anomaly
+    from report_engine import SqlReportEngine
+
+    build_synthetic_db(args.db, args.rows)
+    database.close_writer()
+    work = args.db.with_name(args.db.stem + "_storage.db")
+    shutil.copyfile(args.db, work)
+    database.DB_PATH = work
+    # 合成库没有消费基线，先构建好，免得首次写入触发后台全量构建、干扰写入计时
+    anomaly.rebuild_baselines()
+
+    conn = database.get_connection()
+    sid = conn.execute("SELECT student_id FROM consumption LIMIT 1").fetchone()[0]
+    end = datetime.strptime(conn.execute("SELECT MAX(timestamp) FROM consumption").fetchone()[0], DATE_FMT)
+    conn.close()
+
+    def aggregate():
+        c = database.get_connection()
+        try:
+            return c.execute("SELECT merchant_type, tx_type, COUNT(*), SUM(amount) FROM consumption "
+                             "GROUP BY 1, 2").fetchall()
+        finally:
+            c.close()
+
+    def add_and_delete():
+        from models import ConsumptionRecord
+        rid = database.add_record(ConsumptionRecord(
+            id=None, student_id=sid, name="基准", major=MAJORS[0], grade=GRADES[0], balance=0.0,
+            timestamp=end, amount=1.0, merchant_type="购物超市", location="基准测试", tx_type="消费"))
+        database.delete_record(rid)
+
+    cases = [
+        ("fetch_records 按学生", lambda: database.fetch_records(student_id=sid)),
+        ("fetch_records 最近 7 天", lambda: database.fetch_records(start_date=end - timedelta(days=7), end_date=end)),
+        ("fetch_page 按金额排序", lambda: database.fetch_page(sort_by="amount")),
+        ("fetch_columns 全表 3 列", lambda: database.fetch_columns(("timestamp", "amount", "tx_type"))),
+        ("GROUP BY 全表聚合", aggregate),
+        ("统计报告 (SqlReportEngine)", lambda: SqlReportEngine().generate_report(200.0, 10, 3)),
+        ("新增并删除一条记录", add_and_delete),
+    ]
+    results = {label: {"操作": label} for label, _ in cases}
+    try:
+        for mode in database.STORAGE_MODES:
+            t0 = time.perf_counter()
+            database.set_storage_mode(mode)
+            print(f"{mode}: 切换用时 {(time.perf_counter() - t0) * 1000:.0f}ms")
+            for label, fn in cases:
+                _, ms, _ = measure(fn, args.repeat)
+                results[label][f"{mode}(ms)"] = f"{ms:.1f}"
+    finally:
+        database.set_storage_mode("disk")
+        database.close_writer()
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(work) + suffix).unlink(missing_ok=True)
+    print_table(f"存储模式 ({args.rows} 行, 中位数, {args.repeat} 次)", list(results.values()))
+
+
+COMMANDS = {
+    "search": bench_search,
+    "projection": bench_projection,
+    "report": bench_report,
+    "sketch": bench_sketch,
+    "baseline": bench_baseline,
+    "rules": bench_rules,
+    "balance": bench_balance,
+    "forecast": bench_forecast,
+    "cluster": bench_cluster,
+    "heatmap": bench_heatmap,
+    "cohort": bench_cohort,
+    "chart": bench_chart,
+    "table": bench_table,
+    "api": bench_api,
+    "snapshot": bench_snapshot,
+    "storage": bench_storage,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="校园卡消费分析系统性能基准")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--rows", type=int, default=1_000_000, help="合成数据行数")
+    parser.add_argument("--db", type=Path, default=None, help="合成库路径")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数")
+    parser.add_argument("--concurrency", type=int, default=16, help="api: 并发连接数")
+    parser.add_argument("--seconds", type=float, default=10.0, help="api: 每轮压测时长 (秒)")
+    parser.add_argument("-j", "--workers", type=int, default=4, help="api: 查询线程数 (连接池大小)")
+    args = parser.parse_args()
+    if args.db is None:
+        args.db = Path(f"data/bench_{args.rows}.db")
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+趋势图的降采样与增量绘制。
+
+多年的日序列或小时序列有成千上万个点，而坐标轴只有几百个像素宽：
+逐点绘制既慢又看不出差别。这里先按 min-max 在每个桶里保留最低/最高点做粗筛，
+再用 LTTB (Largest-Triangle-Three-Buckets) 选出与像素数相当的点，峰谷和整体形状都得以保留。
+
+TrendPlot 在一个坐标轴上只创建一次折线，之后的刷新只替换数据并调整坐标范围，
+不清空坐标轴、不重建刻度，数据没有变化时不触发重绘。
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# 每个像素最多保留的点数
+POINTS_PER_PIXEL = 2
+# 降采样后至少保留的点数 (坐标轴尚未布局、宽度未知时使用)
+MIN_POINTS = 200
+# 点数超过目标的这么多倍时，先用 min-max 粗筛再做 LTTB
+MINMAX_RATIO = 4
+# 点数不超过这个数时画出每个点的标记
+MARKER_LIMIT = 100
+
+
+def series_arrays(data: Dict[str, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """{'YYYY-MM-DD' 或 'YYYY-MM-DD HH:MM:SS': 值} -> (matplotlib 日期数值, 值)，按时间升序"""
+    import matplotlib.dates as mdates
+
+    if not data:
+        return np.empty(0), np.empty(0)
+    x = mdates.date2num(np.array(list(data.keys()), dtype="datetime64[s]"))
+    y = np.fromiter(data.values(), dtype=np.float64, count=len(data))
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind="stable")
+        x, y = x[order], y[order]
+    return x, y
+
+
+def minmax(x: np.ndarray, y: np.ndarray, n_buckets: int) -> Tuple[np.ndarray, np.ndarray]:
+    """把序列按下标均分为 n_buckets 个桶，每桶保留最低点和最高点 (保持原有顺序)"""
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return x, y
+    size = -(-n // n_buckets)
+    buckets = -(-n // size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    grid = padded.reshape(buckets, size)
+    base = np.arange(buckets) * size
+    lo = base + np.nanargmin(grid, axis=1)
+    hi = base + np.nanargmax(grid, axis=1)
+    keep = np.unique(np.concatenate([lo, hi, [0, n - 1]]))
+    return x[keep], y[keep]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Largest-Triangle-Three-Buckets：保留首尾两点，中间均分为 n_out - 2 个桶，
+    每桶选出与上一个选中点、下一桶均值构成的三角形面积最大的点
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    # 每个桶的均值 (最后一个桶的 "下一桶" 为末点)
+    sums_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        # 三角形面积的两倍，省去常数因子
+        area = np.abs((ax - avg_x[i + 1]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (avg_y[i + 1] - ay))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return x[selected], y[selected]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """降到约 n_out 个点：点数远多于目标时先 min-max 粗筛，再做 LTTB"""
+    if len(y) <= n_out:
+        return x, y
+    if len(y) > MINMAX_RATIO * n_out:
+        x, y = minmax(x, y, MINMAX_RATIO * n_out // 2)
+    return lttb(x, y, n_out)
+
+
+class TrendPlot:
+    """在一个坐标轴上维护一条日期折线，刷新时替换数据而不是重画整个坐标轴"""
+
+    def __init__(self, ax, title: str = "", xlabel: str = "", ylabel: str = ""):
+        import matplotlib.dates as mdates
+
+        self.ax = ax
+        self.title = title
+        self.line = ax.plot([], [], linestyle="-", marker="o", markersize=4)[0]
+        self.line.set_visible(False)
+        self.points = 0        # 当前绘制的点数 (降采样后)
+        self._source = None    # 最近一次的原始数据，相同则不更新
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator(locator)
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator))
+        ax.tick_params(axis="x", rotation=30)
+        ax.grid(True, linestyle="--", alpha=0.7)
+
+    def target_points(self) -> int:
+        """按坐标轴当前的像素宽度决定保留的点数"""
+        width = self.ax.get_window_extent().width
+        return max(int(width * POINTS_PER_PIXEL), MIN_POINTS)
+
+    def update(self, data: Dict[str, float], x: Optional[np.ndarray] = None,
+               y: Optional[np.ndarray] = None) -> bool:
+        """
+        用新的序列替换折线数据，返回是否需要重绘
+        可直接传入已转换好的 x/y (matplotlib 日期数值) 省去解析日期
+        """
+        if data is self._source or (self._source is not None and data == self._source):
+            return False
+        self._source = data
+        if x is None or y is None:
+            x, y = series_arrays(data)
+
+        if not len(y):
+            self.line.set_visible(False)
+            self.points = 0
+            self.ax.set_title("无数据")
+            return True
+
+        x, y = downsample(x, y, self.target_points())
+        self.points = len(y)
+        self.line.set_data(x, y)
+        self.line.set_marker("o" if len(y) <= MARKER_LIMIT else "")
+        self.line.set_visible(True)
+        self.ax.set_title(self.title)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        return True
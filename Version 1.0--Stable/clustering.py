@@ -0,0 +1,392 @@
+"""
+学生消费画像聚类：按三餐规律、商户结构、周末占比、客单价把学生分群，
+补充 detect_poverty_students 单一阈值之外的行为视角。
+
+特征来自 student_features 表中每个学生的可加统计 (按小时 / 工作日与周末 / 商户类型
+的笔数与金额)，与 daily_summary 一样由变更监听器在写入事务内加减维护，
+每天导入后重新聚类只读这张表，不再扫描全部历史。
+聚类是 NumPy 实现的 k-means：k-means++ 初始化，学生较多时用 mini-batch 更新中心。
+"""
+import sqlite3
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import database
+from report_engine import MEAL_HOURS
+
+# 消费笔数少于此数的学生不参与聚类 (画像不稳定)
+MIN_TX = 10
+# 参与聚类的商户类型数 (按全校笔数取前几个)
+TOP_MERCHANTS = 6
+# 学生数超过该值时改用 mini-batch 更新
+MINIBATCH_THRESHOLD = 20000
+BATCH_SIZE = 2048
+
+# 特征的显示名称 (商户占比为 "商户:<类型>")
+FEATURE_LABELS = {
+    "avg_ticket": "客单价",
+    "weekend_ratio": "周末占比",
+    "breakfast": "早餐占比",
+    "lunch": "午餐占比",
+    "dinner": "晚餐占比",
+    "other": "非饭点占比",
+    "regularity": "时段集中度",
+}
+
+# 一次按 (学生, kind, key) 汇总消费记录的可加统计
+_FEATURE_SQL = """
+    SELECT student_id, 'hour', substr(timestamp, 12, 2), COUNT(*), SUM(amount)
+    FROM {source} WHERE {where} GROUP BY 1, 3
+    UNION ALL
+    SELECT student_id, 'weekend', CASE WHEN strftime('%w', timestamp) IN ('0', '6') THEN '1' ELSE '0' END,
+           COUNT(*), SUM(amount)
+    FROM {source} WHERE {where} GROUP BY 1, 3
+    UNION ALL
+    SELECT student_id, 'merchant', merchant_type, COUNT(*), SUM(amount)
+    FROM {source} WHERE {where} GROUP BY 1, 3
+"""
+
+_UPSERT_SQL = """
+    INSERT INTO student_features (student_id, kind, key, tx_count, total_amount)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(student_id, kind, key) DO UPDATE SET
+        tx_count = tx_count + excluded.tx_count,
+        total_amount = total_amount + excluded.total_amount
+"""
+
+
+def _watermark(cursor: sqlite3.Cursor) -> Optional[int]:
+    """已并入特征表的最大 id，尚未全量构建时为 None"""
+    row = cursor.execute("SELECT value FROM meta WHERE key = 'features_max_id'").fetchone()
+    return row[0] if row else None
+
+
+def _set_watermark(cursor: sqlite3.Cursor, max_id: int):
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES ('features_max_id', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (max_id,))
+
+
+def _add_rows(cursor: sqlite3.Cursor, first_id: int, last_id: int):
+    where = "id BETWEEN ? AND ? AND tx_type = '消费'"
+    rows = cursor.execute(_FEATURE_SQL.format(source="consumption", where=where), [first_id, last_id] * 3).fetchall()
+    cursor.executemany(_UPSERT_SQL, [tuple(r) for r in rows])
+
+
+def _catch_up(cursor: sqlite3.Cursor) -> bool:
+    """把水位之后的新增行并入特征表，尚未全量构建时返回 False"""
+    watermark = _watermark(cursor)
+    if watermark is None:
+        return False
+    max_id = database._max_id(cursor)
+    if max_id > watermark:
+        _add_rows(cursor, watermark + 1, max_id)
+        _set_watermark(cursor, max_id)
+    return True
+
+
+def _update_features(cursor: sqlite3.Cursor, inserted, removed):
+    """
+    变更监听器：被删除/覆盖的旧行逐条减去，修改后的行 (id 不变，在水位之内) 重新加入，
+    水位之后的新增行按组汇总后加入
+    """
+    watermark = _watermark(cursor)
+    if watermark is None:
+        return  # 尚未全量构建，首次聚类时由 rebuild_features 补齐
+    # 水位之后的行还没有并入，无需减去
+    removed = [r for r in removed if r["tx_type"] == "消费" and r["id"] <= watermark]
+    if removed:
+        rows = []
+        for r in removed:
+            ts = r["timestamp"]
+            weekend = "1" if pd.Timestamp(ts).dayofweek >= 5 else "0"
+            for kind, key in (("hour", ts[11:13]), ("weekend", weekend), ("merchant", r["merchant_type"])):
+                rows.append((r["amount"], r["student_id"], kind, key))
+        cursor.executemany("""
+            UPDATE student_features SET tx_count = tx_count - 1, total_amount = total_amount - ?
+            WHERE student_id = ? AND kind = ? AND key = ?
+        """, rows)
+        cursor.execute("DELETE FROM student_features WHERE tx_count <= 0")
+    if inserted and inserted[0] <= watermark:
+        _add_rows(cursor, inserted[0], min(inserted[1], watermark))
+    _catch_up(cursor)
+
+
+def _read_features(conn: sqlite3.Connection) -> Tuple[List[tuple], int]:
+    source, _ = database._source_sql(conn, None, None)
+    cursor = conn.cursor()
+    rows = cursor.execute(_FEATURE_SQL.format(source=source, where="tx_type = '消费'")).fetchall()
+    return [tuple(r) for r in rows], database._max_id(cursor)
+
+
+def _apply_features(cursor: sqlite3.Cursor, result: Tuple[List[tuple], int]) -> int:
+    rows, max_id = result
+    cursor.execute("DELETE FROM student_features")
+    cursor.executemany(_UPSERT_SQL, rows)
+    _set_watermark(cursor, max_id)
+    return len({r[0] for r in rows})
+
+
+def rebuild_features() -> int:
+    """由完整历史 (含归档) 重建 student_features，写入经写线程完成，返回学生数"""
+    return database.rebuild_derived(_read_features, _apply_features)
+
+
+def refresh():
+    """补齐未经监听器写入的新增行 (经写线程)，尚未构建时全量构建"""
+    conn = database.get_connection()
+    try:
+        cursor = conn.cursor()
+        watermark = _watermark(cursor)
+        behind = watermark is not None and database._max_id(cursor) > watermark
+    finally:
+        conn.close()
+    if watermark is None or (behind and not database.write(_catch_up).result()):
+        rebuild_features()
+
+
+def _matrix(students: np.ndarray, n_students: int, keys: np.ndarray, n_keys: int,
+            values: np.ndarray) -> np.ndarray:
+    """(学生编码, 取值编码, 数值) 三元组累加成稠密矩阵"""
+    flat = np.bincount(students * n_keys + keys, weights=values, minlength=n_students * n_keys)
+    return flat.reshape(n_students, n_keys)
+
+
+def feature_matrix(min_tx: int = MIN_TX, top_merchants: int = TOP_MERCHANTS) -> pd.DataFrame:
+    """
+    每个学生一行的特征表 (索引为学号)：客单价、周末占比、三餐占比、时段集中度
+    (笔数最多的 3 个小时占比)、主要商户类型的笔数占比，以及总笔数 tx_count
+    """
+    refresh()
+    conn = database.get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute("SELECT student_id, kind, key, tx_count, total_amount FROM student_features").fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        return pd.DataFrame()
+
+    sid, kind, key, count, total = (np.array(c, dtype=object) for c in zip(*rows))
+    count = count.astype(np.float64)
+    total = total.astype(np.float64)
+    codes, students = pd.factorize(sid)
+    n_students = len(students)
+
+    is_hour = kind == "hour"
+    hour_codes = codes[is_hour]
+    h = _matrix(hour_codes, n_students, key[is_hour].astype(np.int64), 24, count[is_hour])
+    n = h.sum(axis=1)
+    spent = np.bincount(hour_codes, weights=total[is_hour], minlength=n_students)
+
+    is_weekend = (kind == "weekend") & (key == "1")
+    weekend = np.bincount(codes[is_weekend], weights=count[is_weekend], minlength=n_students)
+
+    is_merchant = kind == "merchant"
+    m_codes, merchants = pd.factorize(key[is_merchant])
+    mix = _matrix(codes[is_merchant], n_students, m_codes, len(merchants), count[is_merchant])
+    top = np.argsort(-mix.sum(axis=0), kind="stable")[:top_merchants]
+    top = top[np.argsort(np.asarray(merchants, dtype=object)[top])]
+
+    keep = n >= min_tx
+    h, n, spent, weekend, mix = h[keep], n[keep], spent[keep], weekend[keep], mix[keep]
+    features = pd.DataFrame(index=pd.Index(np.asarray(students, dtype=object)[keep], name="student_id"))
+    features["avg_ticket"] = spent / n
+    features["weekend_ratio"] = weekend / n
+
+    in_meal = np.zeros(24, dtype=bool)
+    for meal, rng in MEAL_HOURS.items():
+        features[meal] = h[:, list(rng)].sum(axis=1) / n
+        in_meal[list(rng)] = True
+    features["other"] = h[:, ~in_meal].sum(axis=1) / n
+    features["regularity"] = np.sort(h, axis=1)[:, -3:].sum(axis=1) / n
+    for j in top:
+        features[f"商户:{merchants[j]}"] = mix[:, j] / n
+
+    features["tx_count"] = n.astype(np.int64)
+    return features
+
+
+def _sq_distances(X: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """每行到各中心的平方距离 (展开为 |x|² - 2x·c + |c|²，一次矩阵乘法)"""
+    d = (X * X).sum(axis=1)[:, None] - 2 * X @ centers.T + (centers * centers).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+
+def _assign(X: np.ndarray, centers: np.ndarray, chunk: int = 65536) -> Tuple[np.ndarray, float]:
+    """分块计算最近中心，返回 (标签, 总平方误差)"""
+    labels = np.empty(len(X), dtype=np.int64)
+    inertia = 0.0
+    for start in range(0, len(X), chunk):
+        d = _sq_distances(X[start:start + chunk], centers)
+        labels[start:start + chunk] = d.argmin(axis=1)
+        inertia += float(d.min(axis=1).sum())
+    return labels, inertia
+
+
+def _kmeans_pp(X: np.ndarray, k: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    贪心 k-means++ 初始化：每一步按到已有中心的平方距离加权抽取若干候选，
+    取使总平方误差最小的一个，比只抽一个更不容易把两个中心放进同一簇
+    """
+    trials = 2 + int(np.log(k))
+    centers = [X[rng.integers(len(X))]]
+    closest = _sq_distances(X, centers[0][None, :])[:, 0]
+    for _ in range(1, k):
+        total = closest.sum()
+        if total <= 0:
+            centers.append(X[rng.integers(len(X))])
+            continue
+        candidates = np.searchsorted(np.cumsum(closest), rng.random(trials) * total)
+        candidates = np.minimum(candidates, len(X) - 1)
+        dist = np.minimum(closest[None, :], _sq_distances(X[candidates], X))
+        best = int(dist.sum(axis=1).argmin())
+        centers.append(X[candidates[best]])
+        closest = dist[best]
+    return np.array(centers)
+
+
+def _cluster_sums(X: np.ndarray, labels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """每类的样本数与各维之和 (逐列 bincount，比 np.add.at 快得多)"""
+    counts = np.bincount(labels, minlength=k).astype(np.float64)
+    sums = np.stack([np.bincount(labels, X[:, j], minlength=k) for j in range(X.shape[1])], axis=1)
+    return counts, sums
+
+
+def kmeans(
+    X: np.ndarray,
+    k: int,
+    max_iter: int = 100,
+    tol: float = 1e-4,
+    batch_size: Optional[int] = None,
+    seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    k-means 聚类，返回 (中心, 标签, 总平方误差)
+    batch_size 为空时行数超过 MINIBATCH_THRESHOLD 才用 mini-batch (按中心的累计样本数递减学习率)，
+    否则为标准 Lloyd 迭代；中心移动量低于 tol 时提前结束
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(X))
+    if batch_size is None and len(X) > MINIBATCH_THRESHOLD:
+        batch_size = BATCH_SIZE
+    sample = X if len(X) <= 10 * MINIBATCH_THRESHOLD else X[rng.choice(len(X), 10 * MINIBATCH_THRESHOLD, replace=False)]
+    centers = _kmeans_pp(sample, k, rng)
+
+    if batch_size:
+        seen = np.zeros(k)
+        for _ in range(max_iter):
+            batch = X[rng.integers(0, len(X), batch_size)]
+            labels = _sq_distances(batch, centers).argmin(axis=1)
+            hits, sums = _cluster_sums(batch, labels, k)
+            seen += hits
+            moved = hits > 0
+            # 每个中心向本批均值移动 hits/seen，相当于对它见过的全部样本求均值
+            step = (hits[moved] / seen[moved])[:, None]
+            new = centers.copy()
+            new[moved] += step * (sums[moved] / hits[moved][:, None] - centers[moved])
+            shift = float(np.abs(new - centers).max())
+            centers = new
+            if shift < tol:
+                break
+    else:
+        for _ in range(max_iter):
+            labels, _ = _assign(X, centers)
+            counts, sums = _cluster_sums(X, labels, k)
+            new = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+            shift = float(np.abs(new - centers).max())
+            centers = new
+            if shift < tol:
+                break
+
+    labels, inertia = _assign(X, centers)
+    return centers, labels, inertia
+
+
+@dataclass
+class ClusterResult:
+    features: pd.DataFrame       # 每个学生的原始特征，附加 cluster 列
+    centers: np.ndarray          # 标准化空间中的中心
+    inertia: float
+    summaries: List[Dict[str, Any]]
+
+
+def cluster_students(k: int = 5, seed: int = 0, min_tx: int = MIN_TX) -> ClusterResult:
+    """
+    读取特征表并聚类：特征先标准化 (客单价取对数)，各维同等权重
+    summaries 每类一项：类号、人数、各特征均值、与全体相比最突出的特征说明
+    """
+    features = feature_matrix(min_tx)
+    if features.empty:
+        return ClusterResult(features, np.empty((0, 0)), 0.0, [])
+
+    cols = [c for c in features.columns if c != "tx_count"]
+    X = features[cols].to_numpy(dtype=np.float64).copy()
+    X[:, cols.index("avg_ticket")] = np.log1p(X[:, cols.index("avg_ticket")])
+    mean, std = X.mean(axis=0), X.std(axis=0)
+    std[std == 0] = 1.0
+    Z = (X - mean) / std
+
+    centers, labels, inertia = kmeans(Z, k, seed=seed)
+    features = features.assign(cluster=labels)
+
+    summaries = []
+    for c in range(len(centers)):
+        members = features[features["cluster"] == c]
+        profile = {col: float(members[col].mean()) for col in cols}
+        # 中心在标准化空间中偏离最大的几个特征即该类的特点
+        order = np.argsort(-np.abs(centers[c]))[:3]
+        traits = [f"{_label(cols[i])}{'高' if centers[c][i] > 0 else '低'}" for i in order if abs(centers[c][i]) >= 0.5]
+        summaries.append({
+            "cluster": c,
+            "size": len(members),
+            "share": len(members) / len(features),
+            "avg_tx": float(members["tx_count"].mean()),
+            "profile": profile,
+            "traits": traits,
+        })
+    summaries.sort(key=lambda s: -s["size"])
+    return ClusterResult(features, centers, inertia, summaries)
+
+
+def _label(col: str) -> str:
+    if col.startswith("商户:"):
+        return f"{col[3:]}占比"
+    return FEATURE_LABELS.get(col, col)
+
+
+def format_summary(result: ClusterResult, columns: Sequence[str] = ()) -> List[Tuple[str, ...]]:
+    """界面/命令行用的表格行：类号、人数、占比、主要特点，以及 columns 指定的特征均值"""
+    rows = []
+    for s in result.summaries:
+        values = [f"{s['profile'][c]:.2f}" if c == "avg_ticket" else f"{s['profile'][c]:.0%}" for c in columns]
+        rows.append((str(s["cluster"]), str(s["size"]), f"{s['share']:.1%}",
+                     "、".join(s["traits"]) or "接近全体平均", *values))
+    return rows
+
+
+# 界面与命令行中展示的特征列
+SUMMARY_COLUMNS = ("avg_ticket", "weekend_ratio", "breakfast", "lunch", "dinner", "other", "regularity")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="按消费画像对学生聚类")
+    parser.add_argument("-k", type=int, default=5, help="类别数")
+    parser.add_argument("--rebuild", action="store_true", help="先由完整历史重建特征表")
+    args = parser.parse_args()
+
+    database.init_db()
+    if args.rebuild:
+        print(f"重建特征: {rebuild_features()} 名学生")
+    result = cluster_students(args.k)
+    header = ("类", "人数", "占比", "特点") + tuple(_label(c) for c in SUMMARY_COLUMNS)
+    print("\t".join(header))
+    for row in format_summary(result, SUMMARY_COLUMNS):
+        print("\t".join(row))
@@ -0,0 +1,270 @@
+"""
+群体对比：按专业、年级并排比较 generate_report / get_deep_insights 中的各项指标。
+
+逐个群体打开 AnalysisWindow 时，每个专业/年级都要把报告和深度分析的所有查询重跑一遍。
+这里只做一次分组扫描，按 (专业, 年级, 是否消费, 小时, 周末, 地点, 商户类型) 聚合出
+计数/金额/最高/大额笔数，这些量都可以相加，之后在 Python 中上卷到专业、年级、
+专业×年级和全体各个层级；学生数和高频笔数不能由细分结果相加，另用一次按学生的窗口查询。
+结果与 SqlReportEngine 对单个群体的统计一致 (群体按精确值划分，而不是子串匹配)，
+并按 (写版本号, 过滤条件, 参数) 缓存。
+"""
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import database
+from report_engine import SqlReportEngine, _empty_insights, _fill_insights
+from utils import money, money_mean
+
+# 对比的层级及其分组列
+LEVELS = {
+    "major": ("major",),
+    "grade": ("grade",),
+    "major_grade": ("major", "grade"),
+}
+
+# 对比表的列 (Cohort.metrics 中的键) 及表头
+COLUMN_LABELS = {
+    "student_count": "人数",
+    "count": "笔数",
+    "total": "总额",
+    "avg": "笔均",
+    "max": "最高",
+    "per_student": "人均消费",
+    "weekday_avg": "工作日笔均",
+    "weekend_avg": "周末笔均",
+    "peak_hour": "高峰时段",
+    "breakfast": "早餐占比",
+    "lunch": "午餐占比",
+    "dinner": "晚餐占比",
+    "top_location": "热门地点",
+    "large_count": "大额笔数",
+    "freq_count": "高频笔数",
+}
+
+_CELL_COLUMNS = ["major", "grade", "cons", "hour", "weekend", "location", "merchant_type",
+                 "cnt", "total", "max", "large"]
+
+# (写版本号, 过滤条件, 大额阈值, 高频窗口, 高频次数) -> 对比结果
+_cache: Dict[Tuple, "CohortReport"] = {}
+
+
+@dataclass
+class Cohort:
+    """一个群体的报告，habits / anomalies / insights 与 SqlReportEngine 的同名部分结构相同"""
+    key: Tuple[str, ...]
+    habits: Dict[str, Any]
+    anomalies: Dict[str, int]
+    insights: Dict[str, Any]
+    metrics: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def label(self) -> str:
+        return " ".join(self.key) if self.key else "全体"
+
+
+@dataclass
+class CohortReport:
+    """各层级的群体列表 (按群体名排序) 与全体汇总"""
+    levels: Dict[str, List[Cohort]]
+    overall: Cohort
+    seconds: float = 0.0
+
+    def table(self, level: str) -> pd.DataFrame:
+        """level 层级的对比表，每行一个群体，最后一行为全体"""
+        cohorts = self.levels[level] + [self.overall]
+        df = pd.DataFrame([c.metrics for c in cohorts], columns=list(COLUMN_LABELS))
+        df.insert(0, "cohort", [c.label for c in cohorts])
+        return df
+
+
+def _load(conn, source: str, where: str, params: list, single_threshold: float,
+          freq_window_min: int, freq_count: int):
+    """(可相加的细分聚合, 每个 (学生, 专业, 年级) 是否有消费及其群体内/全体口径的高频笔数)"""
+    cells = pd.DataFrame(conn.execute(f"""
+        SELECT major, grade, tx_type = '消费' AS cons,
+               CAST(substr(timestamp, 12, 2) AS INTEGER) AS hour,
+               strftime('%w', timestamp) IN ('0', '6') AS weekend,
+               location, merchant_type,
+               COUNT(*), SUM(amount), MAX(amount), SUM(amount > ?)
+        FROM {source} WHERE {where}
+        GROUP BY major, grade, cons, hour, weekend, location, merchant_type
+    """, [single_threshold] + params).fetchall(), columns=_CELL_COLUMNS)
+
+    # 与 SqlReportEngine.generate_report 相同的窗口计数：cnt 的分区再按群体细分，使每个群体的结果
+    # 等于单独过滤该群体后的统计；全体只按学生分区 (cnt_all)，学生中途换了专业/年级时两者不同。
+    # 同一次扫描按学生汇总，顺带得到各群体有消费的学生
+    students = pd.DataFrame(conn.execute(f"""
+        SELECT student_id, major, grade, MAX(cons),
+               COALESCE(SUM(cnt >= ?), 0), COALESCE(SUM(cnt_all >= ?), 0) FROM (
+            SELECT student_id, major, grade, cons,
+                   ROW_NUMBER() OVER (PARTITION BY student_id, major, grade ORDER BY ts, id)
+                 - COUNT(*) OVER (
+                       PARTITION BY student_id, major, grade ORDER BY ts
+                       RANGE BETWEEN UNBOUNDED PRECEDING AND ? PRECEDING
+                   ) AS cnt,
+                   ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY ts, id)
+                 - COUNT(*) OVER (
+                       PARTITION BY student_id ORDER BY ts
+                       RANGE BETWEEN UNBOUNDED PRECEDING AND ? PRECEDING
+                   ) AS cnt_all
+            FROM (
+                SELECT id, student_id, major, grade, tx_type = '消费' AS cons,
+                       CAST(strftime('%s', timestamp) AS INTEGER) AS ts
+                FROM {source} WHERE {where}
+            )
+        )
+        GROUP BY student_id, major, grade
+    """, [freq_count, freq_count, int(freq_window_min) * 60, int(freq_window_min) * 60] + params).fetchall(),
+        columns=["student_id", "major", "grade", "cons", "freq", "freq_all"])
+    return cells, students
+
+
+def _cohort(key: Tuple[str, ...], cells: pd.DataFrame, student_count: int, freq_count: int) -> Cohort:
+    """由一个群体的细分聚合行还原报告"""
+    count = int(cells["cnt"].sum())
+    total = money(cells["total"].sum())
+    merchants = cells.groupby("merchant_type", sort=True)[["total", "cnt"]].sum()
+    habits = {
+        "count": count,
+        "total": total,
+        "avg": money_mean(total, count),
+        "max": float(cells["max"].max()) if count else 0.0,
+        "merchant_breakdown": {
+            m: {"total": money(t), "count": int(c)}
+            for m, t, c in zip(merchants.index, merchants["total"], merchants["cnt"])
+        },
+    }
+    anomalies = {"large_count": int(cells["large"].sum()), "freq_count": freq_count}
+
+    insights = _empty_insights()
+    cons = cells[cells["cons"] == 1]
+    cons_count = int(cons["cnt"].sum())
+    cons_total = money(cons["total"].sum())
+    if cons_count:
+        weekend = cons[cons["weekend"] == 1]
+        weekday = cons[cons["weekend"] == 0]
+        overall = (
+            student_count,
+            money_mean(cons_total, cons_count),
+            cons["max"].max(),
+            money_mean(weekend["total"].sum(), int(weekend["cnt"].sum())),
+            money_mean(weekday["total"].sum(), int(weekday["cnt"].sum())),
+        )
+        hours = cons.groupby("hour")["cnt"].sum()
+        locations = cons.groupby("location")["cnt"].sum()
+        # 与 SqlReportEngine 相同：次数降序，次数相同按地点名
+        top = sorted(zip(locations.index, locations.to_numpy()), key=lambda x: (-x[1], x[0]))[:5]
+        _fill_insights(insights, overall, [(int(h), int(c)) for h, c in hours.items()],
+                       [(loc, int(c)) for loc, c in top])
+
+    meals = insights["meal_stats"]
+    metrics = {
+        "student_count": insights["student_count"],
+        "count": count,
+        "total": total,
+        "avg": habits["avg"],
+        "max": habits["max"],
+        "per_student": cons_total / student_count if student_count else 0.0,
+        "weekday_avg": insights["weekday_avg"],
+        "weekend_avg": insights["weekend_avg"],
+        "peak_hour": insights["peak_hour"],
+        "top_location": next(iter(insights["top_locations"]), ""),
+        "large_count": anomalies["large_count"],
+        "freq_count": freq_count,
+    }
+    for meal in ("breakfast", "lunch", "dinner"):
+        metrics[meal] = meals[meal] / cons_count if cons_count else 0.0
+    return Cohort(key, habits, anomalies, insights, metrics)
+
+
+def _rollup(cells: pd.DataFrame, students: pd.DataFrame, keys: Tuple[str, ...]) -> List[Cohort]:
+    """按 keys 上卷细分聚合，keys 为空时得到全体"""
+    consumers = students[students["cons"] == 1]
+    if not keys:
+        return [_cohort((), cells, consumers["student_id"].nunique(), int(students["freq_all"].sum()))]
+
+    student_counts = consumers.groupby(list(keys))["student_id"].nunique()
+    freq_counts = students.groupby(list(keys))["freq"].sum()
+    cohorts = []
+    for key, group in cells.groupby(list(keys), sort=True):
+        key = tuple(str(k) for k in key)
+        lookup = key if len(keys) > 1 else key[0]
+        cohorts.append(_cohort(
+            key, group,
+            int(student_counts.get(lookup, 0)),
+            int(freq_counts.get(lookup, 0)),
+        ))
+    return cohorts
+
+
+def compare_cohorts(
+    single_threshold: float,
+    freq_window_min: int,
+    freq_count: int,
+    **filters
+) -> CohortReport:
+    """
+    在 filters (与 SqlReportEngine 相同) 范围内按专业、年级和专业×年级对比报告指标
+    数据未变化且参数相同时直接返回缓存的结果
+    """
+    engine = SqlReportEngine(**filters)
+    key = (database.get_write_version(), tuple(engine.filters.items()),
+           single_threshold, freq_window_min, freq_count)
+    if key in _cache:
+        return _cache[key]
+
+    start = time.perf_counter()
+    conn, source, where, params = engine._open()
+    try:
+        cells, students = _load(conn, source, where, params, single_threshold, freq_window_min, freq_count)
+    finally:
+        conn.close()
+
+    levels = {level: _rollup(cells, students, keys) for level, keys in LEVELS.items()}
+    overall = _rollup(cells, students, ())[0]
+    report = CohortReport(levels, overall, time.perf_counter() - start)
+
+    _cache.clear()
+    _cache[key] = report
+    return report
+
+
+def format_row(cohort: Cohort) -> Tuple[str, ...]:
+    """对比表中一行的显示文本 (首列为群体名)"""
+    m = cohort.metrics
+    values = [cohort.label]
+    for col in COLUMN_LABELS:
+        v = m[col]
+        if col in ("breakfast", "lunch", "dinner"):
+            values.append(f"{v:.1%}")
+        elif col == "peak_hour":
+            values.append(f"{v}:00" if m["count"] else "-")
+        elif isinstance(v, float):
+            values.append(f"{v:.2f}")
+        else:
+            values.append(str(v))
+    return tuple(values)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="按专业/年级并排对比消费指标")
+    parser.add_argument("--by", choices=list(LEVELS), default="major", help="对比层级")
+    parser.add_argument("--threshold", type=float, default=200.0, help="大额交易阈值")
+    parser.add_argument("--freq-window", type=int, default=10, help="高频检测时间窗口 (分钟)")
+    parser.add_argument("--freq-count", type=int, default=3, help="高频检测次数阈值")
+    parser.add_argument("--csv", default=None, help="把对比表写入 CSV 文件")
+    args = parser.parse_args()
+
+    database.init_db()
+    result = compare_cohorts(args.threshold, args.freq_window, args.freq_count)
+    if args.csv:
+        result.table(args.by).to_csv(args.csv, index=False, encoding="utf-8-sig")
+    print(f"{len(result.levels[args.by])} 个群体，用时 {result.seconds:.2f}s")
+    print("  ".join(["群体"] + list(COLUMN_LABELS.values())))
+    for c in result.levels[args.by] + [result.overall]:
+        print("  ".join(format_row(c)))
@@ -1,24 +1,406 @@
+import csv
+import hashlib
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from pathlib import Path
-from typing import List, Optional, Tuple
-from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from datetime import datetime, timedelta
+import numpy as np
+import metrics
 from models import ConsumptionRecord
 from utils import DATE_FMT
 
 DB_PATH = Path("data/campus.db")
 
-def get_connection():
-    """获取数据库连接"""
-    if not DB_PATH.parent.exists():
-        DB_PATH.parent.mkdir(parents=True)
-    conn = sqlite3.connect(DB_PATH)
+# 连接等待写锁的秒数：其它连接正在写入时排队等待，而不是立即报 database is locked
+BUSY_TIMEOUT = 30.0
+# 写线程一次最多把这么多个排队的写操作合并为一个事务提交 (组提交)
+WRITE_BATCH_MAX = 64
+# 整表重建 (rebuild_derived) 期间数据有变化时最多重新读取的次数
+REBUILD_RETRIES = 3
+
+# 存储模式：disk 按页读文件；mmap 以内存映射方式读库文件 (PRAGMA mmap_size)；
+# memory 把整个库复制到进程内的内存库，查询不再触及磁盘，写入同时回写磁盘库
+STORAGE_MODES = ("disk", "mmap", "memory")
+# mmap 模式的映射上限 (字节)，超过 SQLite 编译时的上限时按编译上限
+MMAP_SIZE = 1 << 36
+storage_mode = "disk"
+
+# 导入时每块的行数：每块一个事务，也是断点续传的粒度
+IMPORT_CHUNK_ROWS = 5000
+
+# 没有归档期末余额的学生的初始余额
+DEFAULT_BALANCE = 500.0
+
+# 导入写入的列顺序 (fingerprint 为交易指纹，用于去重)
+INSERT_COLUMNS = (
+    "student_id", "name", "major", "grade", "balance",
+    "timestamp", "amount", "merchant_type", "location", "tx_type", "fingerprint"
+)
+
+logger = logging.getLogger(__name__)
+
+# 全文索引覆盖的文本列：fetch_records 的子串过滤通过 FTS5 trigram 索引完成
+FTS_COLUMNS = ("student_id", "name", "major", "grade", "location")
+# trigram 分词至少需要 3 个字符才能走索引，更短的关键字仍用 LIKE
+FTS_MIN_CHARS = 3
+# 文本子串过滤的统一语义 (LIKE、FTS5、分析快照一致)：按字面匹配 (% 和 _ 不是通配符)，
+# 只对 ASCII 字母不区分大小写 (与 SQLite 内置 LIKE 相同)
+LIKE_ESCAPE = "\\"
+
+# 归档分区：历史月份从 consumption 移到按年划分的只读文件中 (每个月一张表)
+ARCHIVE_DIR_NAME = "archive"
+# 查询列 (含 id)，热表与归档分区的 UNION ALL 以此对齐
+RECORD_COLUMNS = ("id",) + INSERT_COLUMNS
+
+# 结果表分页：每页行数、可排序/过滤的列和列过滤运算符
+PAGE_SIZE = 500
+TABLE_COLUMNS = ("student_id", "name", "major", "grade", "balance",
+                 "timestamp", "amount", "merchant_type", "location", "tx_type")
+NUMERIC_COLUMNS = ("balance", "amount")
+COLUMN_OPERATORS = ("包含", "=", "!=", ">", ">=", "<", "<=")
+# 结果数估计最多数到这么多条，超过时只显示下限
+COUNT_CAP = 100_000
+
+# 地点负载立方体的时间粒度：一天分成 96 个 15 分钟的时段
+LOAD_BUCKET_MINUTES = 15
+LOAD_BUCKETS = 24 * 60 // LOAD_BUCKET_MINUTES
+
+# 列式读取时各列的数组类型，未列出的文本列为 object 数组
+COLUMN_DTYPES = {
+    "id": np.int64,
+    "balance": np.float64,
+    "amount": np.float64,
+    "timestamp": "datetime64[s]",
+}
+
+# 数据变更监听器：fn(cursor, inserted, removed)
+# inserted 为新增行的 id 闭区间 (first_id, last_id) 或 None，removed 为被删除/被覆盖的旧行
+# 在写入事务内调用，用于增量维护各类汇总表 (默认监听器由 register_default_listeners 统一注册)
+_change_listeners: List[Callable[[sqlite3.Cursor, Optional[Tuple[int, int]], Sequence[sqlite3.Row]], None]] = []
+_defaults_registered = False
+
+def _open(uri: str, **kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(uri, uri=True, timeout=BUSY_TIMEOUT, factory=metrics.connection_factory(), **kwargs)
     conn.row_factory = sqlite3.Row
+    if storage_mode == "mmap":
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
     return conn
 
+def _disk_uri() -> str:
+    if not DB_PATH.parent.exists():
+        DB_PATH.parent.mkdir(parents=True)
+    # 以 URI 方式打开，归档分区才能以 mode=ro 只读挂载
+    return DB_PATH.resolve().as_uri()
+
+def get_connection():
+    """获取数据库连接 (内存模式下连接内存库，写入应经由 write() 才会回写磁盘)"""
+    mirror = _active_mirror()
+    if mirror is not None:
+        mirror.sync()
+        return _open(mirror.uri)
+    return _open(_disk_uri())
+
+def get_readonly_connection() -> sqlite3.Connection:
+    """
+    只读连接 (mode=ro)，供连接池在多个线程间复用 (同一时刻只由一个线程使用)
+    只能查询，挂载归档分区同样是只读的
+    """
+    mirror = _active_mirror()
+    if mirror is not None:
+        mirror.sync()
+        return _open(mirror.uri + "&mode=ro", check_same_thread=False)
+    return _open(_disk_uri() + "?mode=ro", check_same_thread=False)
+
+def get_disk_connection() -> sqlite3.Connection:
+    """
+    始终连接磁盘库：供初始化、写入归档文件 (不属于主库的写入) 和长时间的读事务使用；
+    主库的写入一律经 write() 交给写线程 (单写者、组提交，内存模式下还要在磁盘库重放)
+    内存库没有 WAL，长读事务放在磁盘库上才不会阻塞写线程
+    """
+    return _open(_disk_uri())
+
+class _RecordingCursor(sqlite3.Cursor):
+    """内存模式的写游标：记下执行成功的写语句，供提交前在磁盘库重放"""
+
+    log: list
+
+    def execute(self, sql, parameters=()):
+        super().execute(sql, parameters)
+        if not sql.lstrip()[:6].upper().startswith("SELECT"):
+            self.log.append((sql, parameters, False))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        rows = list(seq_of_parameters)
+        super().executemany(sql, rows)
+        self.log.append((sql, rows, True))
+        return self
+
+class MemoryMirror:
+    """
+    内存模式：磁盘库的完整副本放在进程内的命名内存库 (memdb VFS)，本进程的连接共享这一份
+    写线程先在内存库执行一批写操作并记下其中的写语句，再在磁盘库重放，两边在同一批次内提交；
+    其它连接 (其它进程、init_db 的初始化) 的提交由磁盘连接的 PRAGMA data_version
+    发现 (本连接自己的提交不会改变它)，发现后整库重新载入
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.pid = os.getpid()
+        self.uri = f"file:/campus-{self.pid}-{id(self)}?vfs=memdb"
+        self._lock = threading.Lock()
+        self._disk = sqlite3.connect(path.resolve().as_uri(), uri=True, timeout=BUSY_TIMEOUT,
+                                     check_same_thread=False, isolation_level=None)
+        # 命名内存库在最后一个连接关闭时释放，这个连接一直持有它
+        self._anchor = sqlite3.connect(self.uri, uri=True, timeout=BUSY_TIMEOUT,
+                                       check_same_thread=False, isolation_level=None)
+        self._version: Optional[int] = None
+        with self._lock:
+            self._load()
+
+    def _data_version(self) -> int:
+        return self._disk.execute("PRAGMA data_version").fetchone()[0]
+
+    def _load(self):
+        start = time.perf_counter()
+        # 载入期间独占内存库，读连接按 BUSY_TIMEOUT 等待
+        self._anchor.execute("PRAGMA locking_mode=EXCLUSIVE")
+        self._disk.backup(self._anchor)
+        # 备份带来了磁盘库的 WAL 标记，memdb 不支持 WAL，改回回滚日志后其它连接才能打开
+        self._anchor.execute("PRAGMA journal_mode=DELETE")
+        self._anchor.execute("PRAGMA locking_mode=NORMAL")
+        self._anchor.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        self._version = self._data_version()
+        metrics.incr("db.memory_loads")
+        logger.info("已载入内存库 %s (%.1fs)", self.path, time.perf_counter() - start)
+
+    def sync(self):
+        """其它连接改动过磁盘库时重新载入 (写线程或其它线程正持有时跳过，由它负责)"""
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._data_version() != self._version:
+                self._load()
+        finally:
+            self._lock.release()
+
+    def begin(self):
+        """写批次开始：锁住磁盘库 (BEGIN IMMEDIATE)，在此之前其它连接的提交先载入内存库"""
+        self._lock.acquire()
+        try:
+            self._disk.execute("BEGIN IMMEDIATE")
+            if self._data_version() != self._version:
+                self._load()
+        except BaseException:
+            self.rollback()
+            raise
+
+    def commit(self, statements: Sequence[Tuple[str, object, bool]]):
+        """在磁盘库重放本批次的写语句并提交"""
+        try:
+            for sql, params, many in statements:
+                if many:
+                    self._disk.executemany(sql, params)
+                else:
+                    self._disk.execute(sql, params)
+            self._disk.execute("COMMIT")
+        except BaseException:
+            self.rollback()
+            raise
+        self._lock.release()
+
+    def rollback(self):
+        if self._disk.in_transaction:
+            self._disk.execute("ROLLBACK")
+        self._lock.release()
+
+    def invalidate(self):
+        """内存库与磁盘库可能不一致时调用，下次访问整库重新载入"""
+        self._version = None
+
+    def close(self):
+        with self._lock:
+            self._anchor.close()
+            self._disk.close()
+
+_mirror: Optional[MemoryMirror] = None
+
+def _active_mirror() -> Optional[MemoryMirror]:
+    mirror = _mirror
+    # fork 出的子进程 (进程池) 不能使用父进程的连接，直接读磁盘库
+    if storage_mode == "memory" and mirror is not None and mirror.path == DB_PATH and mirror.pid == os.getpid():
+        return mirror
+    return None
+
+def set_storage_mode(mode: str):
+    """切换存储模式 (见 STORAGE_MODES)；切到 memory 时立即把当前库整库载入内存"""
+    global storage_mode, _mirror
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode: {mode}")
+    # 写线程按新模式重新打开连接
+    close_writer()
+    old, _mirror = _mirror, None
+    if old is not None:
+        old.close()
+    if mode == "memory":
+        _mirror = MemoryMirror(DB_PATH)
+    storage_mode = mode
+    logger.info("存储模式: %s", mode)
+
+def storage_from_env():
+    """环境变量 CAMPUS_STORAGE 指定启动时的存储模式 (disk / mmap / memory)"""
+    mode = os.environ.get("CAMPUS_STORAGE")
+    if mode:
+        set_storage_mode(mode)
+
+class WriteQueue:
+    """
+    单写线程：所有写操作按提交顺序在同一个连接上执行，读连接不受影响 (WAL)
+    排队中的写操作被一次取出，合并为一个事务提交 (组提交)；每个写操作包在各自的
+    SAVEPOINT 中，某一个失败只回滚它自己，结果或异常通过 Future 交还提交方
+    """
+
+    def __init__(self):
+        self._jobs: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._cursor: Optional[sqlite3.Cursor] = None
+        self._key = None
+
+    def submit(self, fn: Callable[..., object], *args, **kwargs) -> Future:
+        """提交 fn(cursor, *args, **kwargs)，fn 只执行写入，不提交也不关闭连接"""
+        future: Future = Future()
+        if threading.current_thread() is self._thread:
+            # 写操作内部再发起写入：直接在当前事务中执行，排队会互相等待
+            future.set_result(fn(self._cursor, *args, **kwargs))
+            return future
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+            self._jobs.put((fn, args, kwargs, future))
+        return future
+
+    def _connection(self) -> sqlite3.Connection:
+        # DB_PATH 或存储模式被切换 (基准测试、临时库) 时重新打开
+        key = (DB_PATH, _active_mirror())
+        if self._conn is None or self._key != key:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = get_connection()
+            self._conn.isolation_level = None  # 事务由写线程显式控制
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._key = key
+        return self._conn
+
+    def _run(self):
+        while True:
+            batch = [self._jobs.get()]
+            while batch[-1] is not None and len(batch) < WRITE_BATCH_MAX:
+                try:
+                    batch.append(self._jobs.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._commit(batch)
+            if stop:
+                break
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _commit(self, batch):
+        results = []
+        mirror = _active_mirror()
+        pending = False    # 磁盘库的事务已开始、尚未提交
+        replayed = False   # 磁盘库已提交
+        try:
+            conn = self._connection()
+            if mirror is not None:
+                # 内存模式：先锁住磁盘库，写语句记下来提交前在磁盘库重放
+                mirror.begin()
+                pending = True
+                cursor = self._cursor = conn.cursor(_RecordingCursor)
+                cursor.log = []
+            else:
+                cursor = self._cursor = conn.cursor()
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                mark = len(cursor.log) if mirror is not None else 0
+                try:
+                    results.append((future, fn(cursor, *args, **kwargs), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    if mirror is not None:
+                        del cursor.log[mark:]
+                    results.append((future, None, e))
+            if mirror is not None:
+                pending = False  # 重放失败时 commit() 自行回滚磁盘库
+                mirror.commit(cursor.log)
+                replayed = True
+            conn.execute("COMMIT")
+            metrics.incr("db.write_batches")
+            metrics.incr("db.write_jobs", len(batch))
+        except Exception as e:
+            logger.exception("写入事务失败，回滚 %d 个写操作", len(batch))
+            if pending:
+                mirror.rollback()
+            elif replayed:
+                # 磁盘库已提交而内存库没有，下次访问整库重新载入
+                mirror.invalidate()
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.rollback()
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        """执行完排队中的写操作后停止写线程"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._jobs.put(None)
+        thread.join()
+
+
+_writer = WriteQueue()
+
+def write(fn: Callable[..., object], *args, **kwargs) -> Future:
+    """把写操作 fn(cursor, *args, **kwargs) 交给写线程，返回 Future"""
+    return _writer.submit(fn, *args, **kwargs)
+
+def close_writer():
+    _writer.close()
+
 def init_db():
-    """初始化数据库表"""
-    conn = get_connection()
+    """初始化数据库表，并注册派生表的增量维护监听器"""
+    register_default_listeners()
+    conn = get_disk_connection()
     cursor = conn.cursor()
+    # WAL：读连接读取快照，不阻塞写线程，也不被写入阻塞
+    cursor.execute("PRAGMA journal_mode=WAL")
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS consumption (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -34,8 +416,629 @@ def init_db():
             tx_type TEXT NOT NULL
         )
     """)
+    # 按学生+时间的索引：余额重算依赖它
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_consumption_student_ts
+        ON consumption (student_id, timestamp)
+    """)
+    # 导入台账：记录每个文件的哈希和已提交的字节偏移，用于幂等和断点续传
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS import_ledger (
+            file_hash TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            byte_offset INTEGER NOT NULL DEFAULT 0,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # 元数据：目前只有写版本号 write_version，每次数据变更 +1，供各类缓存判断是否失效
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    # 目录监听导入的检查点：每个文件已处理到的字节偏移
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_checkpoint (
+            path TEXT PRIMARY KEY,
+            head_hash TEXT NOT NULL,
+            byte_offset INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    _migrate_fingerprint(conn)
+
+    # 按天汇总表：随写入增量维护，新建时从明细回填一次
+    has_summary = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='daily_summary'"
+    ).fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            day TEXT NOT NULL,
+            merchant_type TEXT NOT NULL,
+            tx_type TEXT NOT NULL,
+            tx_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            PRIMARY KEY (day, merchant_type, tx_type)
+        )
+    """)
+    if not has_summary:
+        _rebuild_daily_summary(cursor)
+
+    _ensure_fts(cursor)
+
+    # 按时间的索引：日期范围查询在热表内的裁剪
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_consumption_ts ON consumption (timestamp)")
+    # 结果表按列排序的索引 (索引项隐含 rowid，即按 (列, id) 有序，正好用于分页)；
+    # 时间、学号复用上面的索引，低基数的文本列排序时由 SQLite 在过滤结果上做 Top-N 排序
+    for col in ("amount", "balance", "name"):
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_consumption_{col} ON consumption ({col})")
+    # 归档分区目录：month 为 YYYY-MM，path 为归档文件，table_name 为文件中的表
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_partitions (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            table_name TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            min_ts TEXT,
+            max_ts TEXT,
+            archived_at TEXT NOT NULL
+        )
+    """)
+    # 每个学生在已归档历史中的期末余额，热表重算余额时以此为起点
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS archive_balances (
+            student_id TEXT PRIMARY KEY,
+            balance REAL NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    """)
+    # 已归档月份不再接受写入，避免同一笔交易同时出现在热表和归档中
+    # 导入时静默跳过 (与重复行一致)，修改记录时直接报错
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS consumption_archived_guard
+        BEFORE INSERT ON consumption
+        WHEN substr(new.timestamp, 1, 7) <= (SELECT MAX(month) FROM archive_partitions)
+        BEGIN
+            SELECT RAISE(IGNORE);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS consumption_archived_guard_update
+        BEFORE UPDATE OF timestamp ON consumption
+        WHEN substr(new.timestamp, 1, 7) <= (SELECT MAX(month) FROM archive_partitions)
+        BEGIN
+            SELECT RAISE(ABORT, 'target month is archived');
+        END
+    """)
+
+    # 每日近似统计草图 (见 sketches.py)：新增行按 id 水位合并，修改/删除的日期记为脏日期整天重建
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS day_sketches (
+            day TEXT PRIMARY KEY,
+            tx_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            max_amount REAL NOT NULL,
+            hours BLOB NOT NULL,
+            students BLOB NOT NULL,
+            locations TEXT NOT NULL,
+            merchants TEXT NOT NULL,
+            amounts BLOB NOT NULL
+        )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS sketch_dirty (day TEXT PRIMARY KEY)")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS consumption_sketch_ad AFTER DELETE ON consumption
+        BEGIN
+            INSERT OR IGNORE INTO sketch_dirty (day) VALUES (substr(old.timestamp, 1, 10));
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS consumption_sketch_au
+        AFTER UPDATE OF student_id, timestamp, amount, merchant_type, location, tx_type ON consumption
+        BEGIN
+            INSERT OR IGNORE INTO sketch_dirty (day) VALUES (substr(old.timestamp, 1, 10));
+            INSERT OR IGNORE INTO sketch_dirty (day) VALUES (substr(new.timestamp, 1, 10));
+        END
+    """)
+
+    # 每个学生的滚动消费基线与入库时的基线告警 (见 anomaly.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS student_baselines (
+            student_id TEXT PRIMARY KEY,
+            tx_count INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            var REAL NOT NULL,
+            last_ts TEXT NOT NULL,
+            hours BLOB NOT NULL,
+            locations TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS baseline_alerts (
+            tx_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            student_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            score REAL NOT NULL,
+            desc TEXT NOT NULL,
+            detected_at TEXT NOT NULL,
+            PRIMARY KEY (tx_id, kind)
+        )
+    """)
+    # 学生消费画像的可加统计 (见 clustering.py)：kind 为 hour/weekend/merchant，key 为对应取值
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS student_features (
+            student_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            tx_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            PRIMARY KEY (student_id, kind, key)
+        )
+    """)
+    # 地点负载立方体：每天 × 地点 × 15 分钟时段的消费笔数与金额，随写入增量维护；
+    # 另有按月 × 地点 × 星期 × 时段的上卷，长日期范围的整月部分直接读它
+    has_load = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='location_load'"
+    ).fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS location_load (
+            day TEXT NOT NULL,
+            location TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            tx_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            PRIMARY KEY (day, location, bucket)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS location_load_monthly (
+            month TEXT NOT NULL,
+            location TEXT NOT NULL,
+            weekday INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            tx_count INTEGER NOT NULL,
+            total_amount REAL NOT NULL,
+            PRIMARY KEY (month, location, weekday, bucket)
+        )
+    """)
+
     conn.commit()
+    if not has_load:
+        # 新建时从明细 (含已归档分区) 回填一次，挂载归档需要在事务之外
+        _rebuild_location_load(conn)
+    conn.close()
+
+def _ensure_fts(cursor: sqlite3.Cursor):
+    """
+    创建 consumption 的 FTS5 trigram 影子索引 (外部内容表) 及同步触发器
+    SQLite 未编译 FTS5 或版本过旧 (< 3.34，不支持 trigram) 时跳过，查询自动退回 LIKE
+    """
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'consumption_fts'").fetchone():
+        return
+
+    cols = ", ".join(FTS_COLUMNS)
+    new_cols = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_cols = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    try:
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE consumption_fts USING fts5(
+                {cols}, content='consumption', content_rowid='id', tokenize='trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning("FTS5 trigram 不可用，文本过滤将使用 LIKE: %s", e)
+        return
+
+    cursor.execute(f"""
+        CREATE TRIGGER consumption_fts_ai AFTER INSERT ON consumption BEGIN
+            INSERT INTO consumption_fts (rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER consumption_fts_ad AFTER DELETE ON consumption BEGIN
+            INSERT INTO consumption_fts (consumption_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER consumption_fts_au AFTER UPDATE OF {cols} ON consumption BEGIN
+            INSERT INTO consumption_fts (consumption_fts, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+            INSERT INTO consumption_fts (rowid, {cols}) VALUES (new.id, {new_cols});
+        END
+    """)
+    cursor.execute("INSERT INTO consumption_fts (consumption_fts) VALUES ('rebuild')")
+
+def _has_fts(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'consumption_fts'").fetchone() is not None
+
+def _fts_phrase(text: str) -> str:
+    """把用户输入转义为 FTS5 短语 (双引号包裹，内部双引号加倍)"""
+    return '"' + text.replace('"', '""') + '"'
+
+def _like_contains(text: str) -> str:
+    """把用户输入转义为 LIKE '%...%' 模式 (配合 ESCAPE LIKE_ESCAPE，% 和 _ 按字面匹配)"""
+    for ch in (LIKE_ESCAPE, "%", "_"):
+        text = text.replace(ch, LIKE_ESCAPE + ch)
+    return f"%{text}%"
+
+def _filter_clause(
+    conn: sqlite3.Connection,
+    student_id: str = "",
+    name: str = "",
+    major: str = "",
+    grade: str = "",
+    location: str = "",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    use_fts: bool = True
+) -> Tuple[str, list]:
+    """
+    构造过滤条件，返回 (WHERE 子句, 参数)
+    长度足够的子串过滤合并为一次 FTS5 MATCH 缩小候选行，每个过滤再用 LIKE 精确判断：
+    trigram 索引按 Unicode 规则折叠大小写，比 LIKE 宽，复核后结果与没有索引时完全一致
+    全文索引只覆盖热表，数据源包含归档分区时应传 use_fts=False
+    """
+    where = ["1=1"]
+    params = []
+    use_fts = use_fts and _has_fts(conn)
+    matches = []
+
+    for col, value in (("student_id", student_id), ("name", name), ("major", major),
+                       ("grade", grade), ("location", location)):
+        if not value:
+            continue
+        if use_fts and len(value) >= FTS_MIN_CHARS:
+            matches.append(f"{col} : {_fts_phrase(value)}")
+        where.append(f"{col} LIKE ? ESCAPE '{LIKE_ESCAPE}'")
+        params.append(_like_contains(value))
+
+    if matches:
+        where.append("id IN (SELECT rowid FROM consumption_fts WHERE consumption_fts MATCH ?)")
+        params.append(" AND ".join(matches))
+    if start_date:
+        where.append("timestamp >= ?")
+        params.append(start_date.strftime(DATE_FMT))
+    if end_date:
+        where.append("timestamp <= ?")
+        params.append(end_date.strftime(DATE_FMT))
+
+    return " AND ".join(where), params
+
+def _month_of(dt: datetime) -> str:
+    return dt.strftime("%Y-%m")
+
+def archived_partitions(
+    conn: sqlite3.Connection,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+) -> List[sqlite3.Row]:
+    """返回与日期范围有交集的归档分区 (分区裁剪)"""
+    query = "SELECT * FROM archive_partitions WHERE 1=1"
+    params = []
+    if start_date:
+        query += " AND month >= ?"
+        params.append(_month_of(start_date))
+    if end_date:
+        query += " AND month <= ?"
+        params.append(_month_of(end_date))
+    return conn.execute(query + " ORDER BY month", params).fetchall()
+
+def _attach_archive(conn: sqlite3.Connection, path: str, readonly: bool = True) -> str:
+    """按需挂载归档文件 (默认只读)，返回 schema 名"""
+    schema = "arch_" + Path(path).stem.rsplit("_", 1)[-1]
+    attached = {row[1] for row in conn.execute("PRAGMA database_list")}
+    if schema not in attached:
+        uri = Path(path).resolve().as_uri() + ("?mode=ro" if readonly else "")
+        conn.execute("ATTACH DATABASE ? AS " + schema, (uri,))
+    return schema
+
+def _source_sql(
+    conn: sqlite3.Connection,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None
+) -> Tuple[str, bool]:
+    """
+    查询的数据源：只有热表时直接返回 consumption，
+    否则挂载与日期范围相交的归档分区，拼成 UNION ALL 子查询
+    返回 (FROM 子句, 是否包含归档分区)
+    """
+    parts = archived_partitions(conn, start_date, end_date)
+    if not parts:
+        return "consumption", False
+
+    cols = ", ".join(RECORD_COLUMNS)
+    selects = [f"SELECT {cols} FROM main.consumption"]
+    for part in parts:
+        schema = _attach_archive(conn, part['path'])
+        selects.append(f"SELECT {cols} FROM {schema}.{part['table_name']}")
+    return "(" + " UNION ALL ".join(selects) + ")", True
+
+def register_change_listener(fn: Callable[[sqlite3.Cursor, Optional[Tuple[int, int]], Sequence[sqlite3.Row]], None]):
+    """注册数据变更监听器 (同一函数只注册一次)"""
+    if fn not in _change_listeners:
+        _change_listeners.append(fn)
+
+def register_default_listeners():
+    """
+    注册所有派生表的增量维护监听器：按天汇总、地点负载立方体、每日草图、学生基线、画像特征和分析快照
+    由 init_db 调用，第一次通知变更时也会确保已注册，只导入 database 的脚本写入后这些表同样正确
+    """
+    global _defaults_registered
+    if _defaults_registered:
+        return
+    # 这些模块依赖 database，在函数内导入避免循环导入
+    import anomaly
+    import clustering
+    import sketches
+    import snapshot
+    for fn in (_update_daily_summary, _update_location_load, sketches._update_day_sketches,
+               anomaly._update_baselines, clustering._update_features, snapshot._on_change):
+        register_change_listener(fn)
+    _defaults_registered = True
+
+def notify_changes(
+    cursor: sqlite3.Cursor,
+    inserted: Optional[Tuple[int, int]] = None,
+    removed: Sequence[sqlite3.Row] = ()
+):
+    """在写入事务内通知数据变更：递增写版本号并调用所有监听器"""
+    if inserted and inserted[1] < inserted[0]:
+        inserted = None
+    if not inserted and not removed:
+        return
+    register_default_listeners()
+    bump_write_version(cursor)
+    for fn in _change_listeners:
+        fn(cursor, inserted, removed)
+
+def bump_write_version(cursor: sqlite3.Cursor):
+    """递增写版本号 (不提交)"""
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES ('write_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    """)
+
+def _read_write_version(conn) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'write_version'").fetchone()
+    return row[0] if row else 0
+
+def get_write_version() -> int:
+    """当前写版本号"""
+    conn = get_connection()
+    version = _read_write_version(conn)
     conn.close()
+    return version
+
+class StaleRebuild(RuntimeError):
+    """整表重建期间数据一直在变化，重试 REBUILD_RETRIES 次后仍未能写回"""
+
+def _apply_rebuild(cursor: sqlite3.Cursor, version: int, apply: Callable, result):
+    if _read_write_version(cursor) != version:
+        return StaleRebuild
+    return apply(cursor, result)
+
+def rebuild_derived(read: Callable[[sqlite3.Connection], object],
+                    apply: Callable[[sqlite3.Cursor, object], object]):
+    """
+    整表重建派生表：read(conn) 在一个读事务内 (已挂载全部归档分区) 由完整历史算出结果，
+    apply(cursor, result) 经写线程写回；写回时写版本号已变 (期间有交易写入、修改或归档)
+    则重新读取，保证写回的结果对应写回时的数据。返回 apply 的返回值
+    """
+    for _ in range(REBUILD_RETRIES):
+        conn = get_connection()
+        try:
+            _source_sql(conn)  # ATTACH 不能在事务内执行，先挂载
+            conn.execute("BEGIN")
+            version = _read_write_version(conn)
+            result = read(conn)
+        finally:
+            conn.close()
+        applied = write(_apply_rebuild, version, apply, result).result()
+        if applied is not StaleRebuild:
+            return applied
+    raise StaleRebuild(f"数据持续变化，{REBUILD_RETRIES} 次重建均未能写回，请稍后重试")
+
+def _max_id(cursor: sqlite3.Cursor) -> int:
+    return cursor.execute("SELECT COALESCE(MAX(id), 0) FROM consumption").fetchone()[0]
+
+def _rebuild_daily_summary(cursor: sqlite3.Cursor):
+    cursor.execute("DELETE FROM daily_summary")
+    cursor.execute("""
+        INSERT INTO daily_summary (day, merchant_type, tx_type, tx_count, total_amount)
+        SELECT substr(timestamp, 1, 10), merchant_type, tx_type, COUNT(*), SUM(amount)
+        FROM consumption
+        GROUP BY 1, 2, 3
+    """)
+
+def _update_daily_summary(cursor: sqlite3.Cursor, inserted: Optional[Tuple[int, int]], removed: Sequence[sqlite3.Row]):
+    """按天汇总表的增量维护"""
+    if removed:
+        cursor.executemany("""
+            UPDATE daily_summary SET tx_count = tx_count - 1, total_amount = total_amount - ?
+            WHERE day = ? AND merchant_type = ? AND tx_type = ?
+        """, [(r['amount'], r['timestamp'][:10], r['merchant_type'], r['tx_type']) for r in removed])
+        cursor.execute("DELETE FROM daily_summary WHERE tx_count <= 0")
+    if inserted:
+        cursor.execute("""
+            INSERT INTO daily_summary (day, merchant_type, tx_type, tx_count, total_amount)
+            SELECT substr(timestamp, 1, 10), merchant_type, tx_type, COUNT(*), SUM(amount)
+            FROM consumption
+            WHERE id BETWEEN ? AND ?
+            GROUP BY 1, 2, 3
+            ON CONFLICT(day, merchant_type, tx_type) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_amount = total_amount + excluded.total_amount
+        """, inserted)
+
+# 消费记录所在的 15 分钟时段 (0 ~ LOAD_BUCKETS-1) 与星期 (周一为 0)
+_LOAD_BUCKET_SQL = (
+    f"(CAST(substr(timestamp, 12, 2) AS INTEGER) * 60 + CAST(substr(timestamp, 15, 2) AS INTEGER))"
+    f" / {LOAD_BUCKET_MINUTES}"
+)
+_WEEKDAY_SQL = "(CAST(strftime('%w', {}) AS INTEGER) + 6) % 7"
+
+_LOAD_UPSERTS = (
+    f"""
+    INSERT INTO location_load (day, location, bucket, tx_count, total_amount)
+    SELECT substr(timestamp, 1, 10), location, {_LOAD_BUCKET_SQL}, COUNT(*), SUM(amount)
+    FROM {{source}} WHERE {{where}}
+    GROUP BY 1, 2, 3
+    ON CONFLICT(day, location, bucket) DO UPDATE SET
+        tx_count = tx_count + excluded.tx_count,
+        total_amount = total_amount + excluded.total_amount
+    """,
+    f"""
+    INSERT INTO location_load_monthly (month, location, weekday, bucket, tx_count, total_amount)
+    SELECT substr(timestamp, 1, 7), location, {_WEEKDAY_SQL.format('timestamp')}, {_LOAD_BUCKET_SQL},
+           COUNT(*), SUM(amount)
+    FROM {{source}} WHERE {{where}}
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT(month, location, weekday, bucket) DO UPDATE SET
+        tx_count = tx_count + excluded.tx_count,
+        total_amount = total_amount + excluded.total_amount
+    """,
+)
+
+def _rebuild_location_load(conn: sqlite3.Connection):
+    source, _ = _source_sql(conn, None, None)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM location_load")
+    cursor.execute("DELETE FROM location_load_monthly")
+    for sql in _LOAD_UPSERTS:
+        cursor.execute(sql.format(source=source, where="tx_type = '消费'"))
+    conn.commit()
+
+def _update_location_load(cursor: sqlite3.Cursor, inserted: Optional[Tuple[int, int]], removed: Sequence[sqlite3.Row]):
+    """地点负载立方体的增量维护 (与 daily_summary 相同)"""
+    removed = [r for r in removed if r['tx_type'] == '消费']
+    if removed:
+        cells = []
+        for r in removed:
+            ts = r['timestamp']
+            bucket = (int(ts[11:13]) * 60 + int(ts[14:16])) // LOAD_BUCKET_MINUTES
+            weekday = datetime.strptime(ts[:10], "%Y-%m-%d").weekday()
+            cells.append((r['amount'], ts[:10], ts[:7], weekday, r['location'], bucket))
+        cursor.executemany("""
+            UPDATE location_load SET tx_count = tx_count - 1, total_amount = total_amount - ?
+            WHERE day = ? AND location = ? AND bucket = ?
+        """, [(amt, day, loc, bucket) for amt, day, _, _, loc, bucket in cells])
+        cursor.executemany("""
+            UPDATE location_load_monthly SET tx_count = tx_count - 1, total_amount = total_amount - ?
+            WHERE month = ? AND location = ? AND weekday = ? AND bucket = ?
+        """, [(amt, month, loc, weekday, bucket) for amt, _, month, weekday, loc, bucket in cells])
+        cursor.execute("DELETE FROM location_load WHERE tx_count <= 0")
+        cursor.execute("DELETE FROM location_load_monthly WHERE tx_count <= 0")
+    if inserted:
+        for sql in _LOAD_UPSERTS:
+            cursor.execute(sql.format(source="consumption", where="id BETWEEN ? AND ? AND tx_type = '消费'"), inserted)
+
+def _month_span(start_day: str, end_day: str) -> Optional[Tuple[str, str]]:
+    """[start_day, end_day] 中完整覆盖的月份范围 (首月, 末月)，没有完整月份时为 None"""
+    first = start_day[:7] if start_day[8:] == "01" else _add_month(start_day[:7], 1)
+    last = end_day[:7]
+    if end_day != "9999-12-31":
+        following = datetime.strptime(end_day, "%Y-%m-%d") + timedelta(days=1)
+        if following.day != 1:
+            last = _add_month(last, -1)
+    return (first, last) if first <= last else None
+
+def _add_month(month: str, delta: int) -> str:
+    year, mon = (int(x) for x in month.split("-"))
+    index = year * 12 + mon - 1 + delta
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def fetch_location_load(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    location: str = ""
+) -> Dict[str, np.ndarray]:
+    """
+    从负载立方体汇总日期范围内 (按整天) 各地点、星期、时段的消费笔数与金额：
+    完整月份读按月上卷，首尾不足一月的部分读按天的立方体
+    location 为子串过滤；返回 {"locations": 地点数组, "count"/"amount": (地点, 7, LOAD_BUCKETS) 数组}，
+    星期按周一为 0
+    """
+    start_day = start_date.strftime("%Y-%m-%d") if start_date else "0000-01-01"
+    end_day = end_date.strftime("%Y-%m-%d") if end_date else "9999-12-31"
+    loc_clause = f" AND location LIKE ? ESCAPE '{LIKE_ESCAPE}'" if location else ""
+    loc_params = [_like_contains(location)] if location else []
+
+    daily = f"""
+        SELECT location, {_WEEKDAY_SQL.format('day')}, bucket, SUM(tx_count), SUM(total_amount)
+        FROM location_load WHERE day BETWEEN ? AND ?{loc_clause}
+        GROUP BY 1, 2, 3
+    """
+    queries = []
+    span = _month_span(start_day, end_day)
+    if span is None:
+        queries.append((daily, [start_day, end_day] + loc_params))
+    else:
+        first, last = span
+        queries.append((f"""
+            SELECT location, weekday, bucket, SUM(tx_count), SUM(total_amount)
+            FROM location_load_monthly WHERE month BETWEEN ? AND ?{loc_clause}
+            GROUP BY 1, 2, 3
+        """, [first, last] + loc_params))
+        # 首尾零散的天 (月份字符串后接 "-00" / "-32" 恰好落在该月所有日期之外)
+        if start_day < f"{first}-01":
+            queries.append((daily, [start_day, f"{first}-00"] + loc_params))
+        if end_day > f"{last}-32":
+            queries.append((daily, [f"{last}-32", end_day] + loc_params))
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = [r for sql, params in queries for r in cursor.execute(sql, params).fetchall()]
+    conn.close()
+
+    locations = sorted({r[0] for r in rows})
+    index = {loc: i for i, loc in enumerate(locations)}
+    count = np.zeros((len(locations), 7, LOAD_BUCKETS), dtype=np.int64)
+    amount = np.zeros((len(locations), 7, LOAD_BUCKETS))
+    if rows:
+        loc, weekday, bucket, n, total = zip(*rows)
+        cell = (np.array([index[x] for x in loc]), np.array(weekday), np.array(bucket))
+        np.add.at(count, cell, n)
+        np.add.at(amount, cell, total)
+    return {"locations": np.array(locations, dtype=object), "count": count, "amount": amount}
+
+def tx_fingerprint(student_id: str, timestamp: str, amount: float, location: str) -> str:
+    """交易指纹：由 (学号, 时间, 金额, 地点) 这一自然键计算"""
+    key = f"{student_id}|{timestamp}|{float(amount):.2f}|{location}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _migrate_fingerprint(conn: sqlite3.Connection):
+    """
+    为旧库补充 fingerprint 列和唯一索引
+    已存在的重复交易只保留 id 最小的一条，并重算相关学生余额
+    """
+    cursor = conn.cursor()
+    cols = {row['name'] for row in cursor.execute("PRAGMA table_info(consumption)")}
+    if 'fingerprint' not in cols:
+        cursor.execute("ALTER TABLE consumption ADD COLUMN fingerprint TEXT")
+
+        conn.create_function("tx_fingerprint", 4, tx_fingerprint, deterministic=True)
+        cursor.execute("UPDATE consumption SET fingerprint = tx_fingerprint(student_id, timestamp, amount, location)")
+
+        dup_students = [r[0] for r in cursor.execute("""
+            SELECT DISTINCT student_id FROM consumption
+            WHERE id NOT IN (SELECT MIN(id) FROM consumption GROUP BY fingerprint)
+        """)]
+        if dup_students:
+            cursor.execute("DELETE FROM consumption WHERE id NOT IN (SELECT MIN(id) FROM consumption GROUP BY fingerprint)")
+            logger.warning("清理了 %d 条重复交易", cursor.rowcount)
+            for sid in dup_students:
+                _rebalance(cursor, sid)
+
+    cursor.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_consumption_fingerprint
+        ON consumption (fingerprint)
+    """)
 
 def record_to_obj(row: sqlite3.Row) -> ConsumptionRecord:
     """将数据库行转换为对象"""
@@ -60,33 +1063,17 @@ def fetch_records(
     grade: str = "",
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
-    time_asc: bool = False
+    time_asc: bool = False,
+    location: str = ""
 ) -> List[ConsumptionRecord]:
     """查询记录"""
     conn = get_connection()
     cursor = conn.cursor()
     
-    query = "SELECT * FROM consumption WHERE 1=1"
-    params = []
-    
-    if student_id:
-        query += " AND student_id LIKE ?"
-        params.append(f"%{student_id}%")
-    if name:
-        query += " AND name LIKE ?"
-        params.append(f"%{name}%")
-    if major:
-        query += " AND major LIKE ?"
-        params.append(f"%{major}%")
-    if grade:
-        query += " AND grade LIKE ?"
-        params.append(f"%{grade}%")
-    if start_date:
-        query += " AND timestamp >= ?"
-        params.append(start_date.strftime(DATE_FMT))
-    if end_date:
-        query += " AND timestamp <= ?"
-        params.append(end_date.strftime(DATE_FMT))
+    source, has_archive = _source_sql(conn, start_date, end_date)
+    where, params = _filter_clause(conn, student_id, name, major, grade, location, start_date, end_date,
+                                   use_fts=not has_archive)
+    query = f"SELECT * FROM {source} WHERE {where}"
         
     # 排序逻辑：
     # 1. 姓名 (拼音顺序，方便找人)
@@ -100,59 +1087,246 @@ def fetch_records(
     
     return [record_to_obj(row) for row in rows]
 
-def add_record(record: ConsumptionRecord) -> int:
-    """添加记录"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
+def _column_filter_clause(column_filters: Sequence[Tuple[str, str, str]]) -> Tuple[str, list]:
+    """结果表的列过滤 [(列, 运算符, 值)] -> (AND 连接的条件, 参数)；列和运算符只接受白名单中的值"""
+    where, params = [], []
+    for col, op, value in column_filters:
+        if col not in TABLE_COLUMNS or op not in COLUMN_OPERATORS:
+            raise ValueError(f"Unsupported column filter: {col} {op}")
+        if op == "包含":
+            where.append(f"{col} LIKE ? ESCAPE '{LIKE_ESCAPE}'")
+            params.append(_like_contains(value))
+        else:
+            where.append(f"{col} {op} ?")
+            params.append(float(value) if col in NUMERIC_COLUMNS else value)
+    return " AND ".join(where), params
+
+def _keyset_clause(sort_by: str, descending: bool, after: tuple) -> Tuple[str, list]:
+    """
+    keyset 分页：排在上一页最后一行 (排序值, id) 之后的行
+    只有 balance 可能为 NULL，SQLite 升序时 NULL 在最前、降序时在最后
+    """
+    value, last_id = after
+    op = "<" if descending else ">"
+    if sort_by != "balance":
+        return f"({sort_by}, id) {op} (?, ?)", [value, last_id]
+    if value is None:
+        if descending:
+            return f"({sort_by} IS NULL AND id < ?)", [last_id]
+        return f"(({sort_by} IS NULL AND id > ?) OR {sort_by} IS NOT NULL)", [last_id]
+    if descending:
+        return f"(({sort_by}, id) < (?, ?) OR {sort_by} IS NULL)", [value, last_id]
+    return f"({sort_by}, id) > (?, ?)", [value, last_id]
+
+def _table_where(conn, column_filters, student_id, name, major, grade, location,
+                 start_date, end_date) -> Tuple[str, list, str]:
+    """结果表的 (WHERE 子句, 参数, FROM 子句)：过滤条件加列过滤"""
+    source, has_archive = _source_sql(conn, start_date, end_date)
+    where, params = _filter_clause(conn, student_id, name, major, grade, location, start_date, end_date,
+                                   use_fts=not has_archive)
+    extra, extra_params = _column_filter_clause(column_filters)
+    if extra:
+        where += f" AND {extra}"
+        params += extra_params
+    return where, params, source
+
+def fetch_page(
+    sort_by: str = "timestamp",
+    descending: bool = True,
+    after: Optional[tuple] = None,
+    limit: Optional[int] = PAGE_SIZE,
+    column_filters: Sequence[Tuple[str, str, str]] = (),
+    student_id: str = "",
+    name: str = "",
+    major: str = "",
+    grade: str = "",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    location: str = "",
+    conn: Optional[sqlite3.Connection] = None
+) -> Tuple[List[ConsumptionRecord], Optional[tuple]]:
+    """
+    结果表分页查询：按 (sort_by, id) 排序，after 为上一页返回的游标
+    排序和列过滤都在库内执行，翻页用 keyset 条件而不是 OFFSET，任何一页都只读 limit 行附近的索引
+    返回 (本页记录, 下一页游标)，没有更多数据时游标为 None；limit=None 返回全部
+    conn 为空时自行打开连接 (传入连接便于调用方中断查询)
+    """
+    if sort_by not in TABLE_COLUMNS:
+        raise ValueError(f"Unsupported sort column: {sort_by}")
+    own = conn is None
+    conn = conn or get_connection()
+    try:
+        where, params, source = _table_where(conn, column_filters, student_id, name, major, grade,
+                                             location, start_date, end_date)
+        if after is not None:
+            keyset, keyset_params = _keyset_clause(sort_by, descending, after)
+            where += f" AND {keyset}"
+            params += keyset_params
+
+        direction = "DESC" if descending else "ASC"
+        query = f"SELECT * FROM {source} WHERE {where} ORDER BY {sort_by} {direction}, id {direction}"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        if own:
+            conn.close()
+
+    records = [record_to_obj(row) for row in rows]
+    more = limit is not None and len(rows) == limit
+    return records, ((rows[-1][sort_by], rows[-1]["id"]) if more else None)
+
+def estimate_count(
+    column_filters: Sequence[Tuple[str, str, str]] = (),
+    cap: int = COUNT_CAP,
+    student_id: str = "",
+    name: str = "",
+    major: str = "",
+    grade: str = "",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    location: str = "",
+    conn: Optional[sqlite3.Connection] = None
+) -> Tuple[int, bool]:
+    """
+    结果条数，返回 (条数, 是否精确)
+    只有整天的日期过滤时直接汇总 daily_summary (精确，含归档)；否则最多数到 cap 条，
+    超过时返回 (cap, False)，不为了一个数字扫描整张表
+    """
+    own = conn is None
+    conn = conn or get_connection()
+    try:
+        whole_days = ((not start_date or start_date.time() == datetime.min.time())
+                      and (not end_date or end_date.strftime("%H:%M:%S") == "23:59:59"))
+        if whole_days and not column_filters and not any((student_id, name, major, grade, location)):
+            lo = start_date.strftime("%Y-%m-%d") if start_date else ""
+            hi = end_date.strftime("%Y-%m-%d") if end_date else "9999-12-31"
+            row = conn.execute("SELECT COALESCE(SUM(tx_count), 0) FROM daily_summary WHERE day BETWEEN ? AND ?",
+                               (lo, hi)).fetchone()
+            return row[0], True
+
+        where, params, source = _table_where(conn, column_filters, student_id, name, major, grade,
+                                             location, start_date, end_date)
+        count = conn.execute(f"SELECT COUNT(*) FROM (SELECT 1 FROM {source} WHERE {where} LIMIT ?)",
+                             params + [cap + 1]).fetchone()[0]
+    finally:
+        if own:
+            conn.close()
+    return (count, True) if count <= cap else (cap, False)
+
+def fetch_columns(
+    columns: Sequence[str],
+    student_id: str = "",
+    name: str = "",
+    major: str = "",
+    grade: str = "",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    location: str = "",
+    column_filters: Sequence[Tuple[str, str, str]] = (),
+    conn: Optional[sqlite3.Connection] = None
+) -> Dict[str, np.ndarray]:
+    """
+    列式查询：只 SELECT 指定的列，直接返回 {列名: 数组}，不构造 ConsumptionRecord
+    数值列为 float64/int64，timestamp 为 datetime64[s]，文本列为 object 数组
+    column_filters 为结果表的列过滤 (与 fetch_page 相同)
+    结果不排序，调用方按需排序；conn 为空时自行打开连接
+    """
+    columns = list(dict.fromkeys(columns))
+    unknown = [c for c in columns if c not in RECORD_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown columns: {unknown}")
+
+    own = conn is None
+    conn = conn or get_connection()
+    try:
+        where, params, source = _table_where(conn, column_filters, student_id, name, major, grade,
+                                             location, start_date, end_date)
+        # 普通元组比 sqlite3.Row 更省内存，也便于按列转置
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(f"SELECT {', '.join(columns)} FROM {source} WHERE {where}", params).fetchall()
+    finally:
+        if own:
+            conn.close()
+
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    result = {}
+    for col, vals in zip(columns, values):
+        dtype = COLUMN_DTYPES.get(col, object)
+        result[col] = np.array(vals, dtype=dtype)
+    return result
+
+def _add_record(cursor: sqlite3.Cursor, record: ConsumptionRecord) -> int:
     # 检查是否需要添加 balance 列 (简单的迁移逻辑)
     try:
         cursor.execute("SELECT balance FROM consumption LIMIT 1")
     except sqlite3.OperationalError:
         # 列不存在，添加它
         cursor.execute("ALTER TABLE consumption ADD COLUMN balance REAL DEFAULT 0.0")
-        conn.commit()
 
+    # 重复记录 (指纹冲突) 直接抛出 sqlite3.IntegrityError，由调用方提示
+    ts = record.timestamp.strftime(DATE_FMT)
     cursor.execute("""
-        INSERT INTO consumption (student_id, name, major, grade, balance, timestamp, amount, merchant_type, location, tx_type)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO consumption (student_id, name, major, grade, balance, timestamp, amount, merchant_type, location, tx_type, fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     """, (
         record.student_id,
         record.name,
         record.major,
         record.grade,
         record.balance,
-        record.timestamp.strftime(DATE_FMT),
+        ts,
         record.amount,
         record.merchant_type,
         record.location,
-        record.tx_type
+        record.tx_type,
+        tx_fingerprint(record.student_id, ts, record.amount, record.location)
     ))
+    if cursor.rowcount == 0:
+        raise ValueError(f"{ts[:7]} 已归档，不能再新增该月份的记录")
     new_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    # 重新计算该学生的余额
-    recalculate_balance(record.student_id)
-    
+    notify_changes(cursor, inserted=(new_id, new_id))
+
+    # 重新计算该学生的余额 (与写入在同一事务中)
+    _rebalance(cursor, record.student_id)
     return new_id
 
-def recalculate_balance(student_id: str):
-    """重新计算指定学生的所有余额"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # 1. 获取该学生所有记录，按时间正序排列
+def add_record(record: ConsumptionRecord) -> int:
+    """添加记录"""
+    return write(_add_record, record).result()
+
+def _opening_balance(cursor: sqlite3.Cursor, student_id: str) -> float:
+    """热表中第一条记录之前的余额：已归档学生取归档期末余额，否则为默认初始余额"""
+    row = cursor.execute("SELECT balance FROM archive_balances WHERE student_id = ?", (student_id,)).fetchone()
+    return row['balance'] if row else DEFAULT_BALANCE
+
+def _rebalance(cursor: sqlite3.Cursor, student_id: str, since: Optional[str] = None):
+    """
+    在给定游标上重算某个学生的余额（不提交）
+    since 不为空时只重算该时间点及之后的记录，起始余额取其之前最后一条记录的余额
+    """
+    current_balance = _opening_balance(cursor, student_id)
+
+    if since:
+        prev = cursor.execute("""
+            SELECT balance FROM consumption
+            WHERE student_id = ? AND timestamp < ?
+            ORDER BY timestamp DESC, id DESC LIMIT 1
+        """, (student_id, since)).fetchone()
+        if prev is not None:
+            current_balance = prev['balance']
+
+    # 1. 获取该学生需要重算的记录，按时间正序排列
     cursor.execute("""
         SELECT id, amount, tx_type FROM consumption 
-        WHERE student_id = ? 
+        WHERE student_id = ? AND timestamp >= ?
         ORDER BY timestamp ASC, id ASC
-    """, (student_id,))
+    """, (student_id, since or ""))
     
     rows = cursor.fetchall()
     
-    current_balance = 500.0 # 默认初始余额
-    
     # 2. 遍历计算
     for row in rows:
         rid = row['id']
@@ -166,20 +1340,34 @@ def recalculate_balance(student_id: str):
             
         # 3. 更新当前记录的 balance
         cursor.execute("UPDATE consumption SET balance = ? WHERE id = ?", (round(current_balance, 2), rid))
-        
-    conn.commit()
-    conn.close()
 
-def update_record(record: ConsumptionRecord):
-    """更新记录"""
-    if record.id is None:
-        raise ValueError("Record ID cannot be None for update")
-        
-    conn = get_connection()
-    cursor = conn.cursor()
+def recalculate_balance(student_id: str):
+    """重新计算指定学生的所有余额"""
+    write(_rebalance_many, [student_id], {}).result()
+
+def _rebalance_many(cursor: sqlite3.Cursor, student_ids: Iterable[str], since: Dict[str, str]):
+    student_ids = list(student_ids)
+    for sid in student_ids:
+        _rebalance(cursor, sid, since.get(sid))
+    # 余额变了：按写版本号缓存的结果 (分析快照、余额预测) 需要失效
+    if student_ids:
+        bump_write_version(cursor)
+
+def recalculate_balances(student_ids: Iterable[str], since: Optional[Dict[str, str]] = None):
+    """
+    批量重算多个学生的余额，在一个事务中完成
+    since 可按学生给出最早的变更时间，只重算该时间之后的部分
+    """
+    write(_rebalance_many, list(student_ids), since or {}).result()
+
+def _update_record(cursor: sqlite3.Cursor, record: ConsumptionRecord):
+    old_rows = cursor.execute("SELECT * FROM consumption WHERE id=?", (record.id,)).fetchall()
+    if not old_rows:
+        raise ValueError("记录不存在或已归档，无法修改")
+    ts = record.timestamp.strftime(DATE_FMT)
     cursor.execute("""
-        UPDATE consumption 
-        SET student_id=?, name=?, major=?, grade=?, balance=?, timestamp=?, amount=?, merchant_type=?, location=?, tx_type=?
+        UPDATE consumption
+        SET student_id=?, name=?, major=?, grade=?, balance=?, timestamp=?, amount=?, merchant_type=?, location=?, tx_type=?, fingerprint=?
         WHERE id=?
     """, (
         record.student_id,
@@ -187,86 +1375,199 @@ def update_record(record: ConsumptionRecord):
         record.major,
         record.grade,
         record.balance,
-        record.timestamp.strftime(DATE_FMT),
+        ts,
         record.amount,
         record.merchant_type,
         record.location,
         record.tx_type,
+        tx_fingerprint(record.student_id, ts, record.amount, record.location),
         record.id
     ))
-    conn.commit()
-    conn.close()
-    
+    notify_changes(cursor, inserted=(record.id, record.id), removed=old_rows)
+
     # 重新计算余额
-    recalculate_balance(record.student_id)
+    _rebalance(cursor, record.student_id)
 
-def delete_record(record_id: int):
-    """删除记录"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    
+def update_record(record: ConsumptionRecord):
+    """更新记录"""
+    if record.id is None:
+        raise ValueError("Record ID cannot be None for update")
+    write(_update_record, record).result()
+
+def _delete_record(cursor: sqlite3.Cursor, record_id: int):
     # 先获取 student_id 以便重算
-    cursor.execute("SELECT student_id FROM consumption WHERE id=?", (record_id,))
-    row = cursor.fetchone()
+    row = cursor.execute("SELECT * FROM consumption WHERE id=?", (record_id,)).fetchone()
     if not row:
-        conn.close()
         return
-        
-    student_id = row['student_id']
-    
     cursor.execute("DELETE FROM consumption WHERE id=?", (record_id,))
-    conn.commit()
-    conn.close()
-    
+    notify_changes(cursor, removed=[row])
+
     # 重新计算余额
-    recalculate_balance(student_id)
+    _rebalance(cursor, row['student_id'])
 
-def import_from_csv(csv_path: Path) -> Tuple[int, List[str]]:
-    """从CSV导入数据"""
-    import csv
-    
+def delete_record(record_id: int):
+    """删除记录"""
+    write(_delete_record, record_id).result()
+
+def file_sha1(path: Path) -> str:
+    """计算文件内容的 SHA-1，用于识别同一份导入文件"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def csv_row_values(row: dict) -> tuple:
+    """将一行 CSV (DictReader) 转为 INSERT_COLUMNS 顺序的值，格式不合法时抛出异常"""
+    ts = row['timestamp'].strip()
+    # 只做格式校验，入库仍保存原始字符串
+    datetime.strptime(ts, DATE_FMT)
+    student_id = row['student_id'].strip()
+    amount = float(row['amount'])
+    location = row['location'].strip()
+    return (
+        student_id,
+        row['name'].strip(),
+        row['major'].strip(),
+        row['grade'].strip(),
+        # 处理 balance 字段，如果 CSV 中没有则默认为 0.0
+        float(row.get('balance') or 0.0),
+        ts,
+        amount,
+        row['merchant_type'].strip(),
+        location,
+        row['tx_type'].strip(),
+        tx_fingerprint(student_id, ts, amount, location),
+    )
+
+def iter_csv_chunks(
+    csv_path: Path,
+    start_offset: int = 0,
+    chunk_rows: int = IMPORT_CHUNK_ROWS,
+    complete_lines_only: bool = False
+) -> Iterator[Tuple[List[tuple], List[str], int]]:
+    """
+    按块读取 CSV，每块 yield (值元组列表, 错误列表, 块末尾的字节偏移)
+    start_offset 为上次提交到的字节位置 (0 表示从表头之后开始)
+    complete_lines_only 为 True 时，末尾没有换行符的半行 (仍在写入中) 留到下次读取
+    """
+    with open(csv_path, 'rb') as f:
+        # 使用 utf-8-sig 以处理可能的 BOM，并移除表头可能的空白字符
+        header_line = f.readline().decode('utf-8-sig')
+        fieldnames = [name.strip() for name in next(csv.reader([header_line]), [])]
+        if start_offset > f.tell():
+            f.seek(start_offset)
+
+        while True:
+            lines = []
+            for _ in range(chunk_rows):
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if complete_lines_only and not line.endswith(b'\n'):
+                    f.seek(pos)
+                    break
+                lines.append(line.decode('utf-8'))
+            if not lines:
+                return
+
+            values = []
+            errors = []
+            for row in csv.DictReader(lines, fieldnames=fieldnames):
+                try:
+                    values.append(csv_row_values(row))
+                except Exception as e:
+                    errors.append(f"Line error: {e}")
+            yield values, errors, f.tell()
+
+def _ledger_upsert(cursor: sqlite3.Cursor, file_hash: str, path: Path, size: int,
+                   offset: int, rows: int, status: str):
+    """更新导入台账 (不提交，和数据写入处于同一事务)"""
+    now = datetime.now().strftime(DATE_FMT)
+    cursor.execute("""
+        INSERT INTO import_ledger (file_hash, path, file_size, byte_offset, row_count, status, started_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(file_hash) DO UPDATE SET
+            path = excluded.path,
+            byte_offset = excluded.byte_offset,
+            row_count = import_ledger.row_count + excluded.row_count,
+            status = excluded.status,
+            updated_at = excluded.updated_at
+    """, (file_hash, str(path), size, offset, rows, status, now, now))
+
+def get_ledger_entry(file_hash: str) -> Optional[sqlite3.Row]:
+    """查询某个文件的导入台账"""
     conn = get_connection()
-    cursor = conn.cursor()
-    
+    row = conn.execute("SELECT * FROM import_ledger WHERE file_hash = ?", (file_hash,)).fetchone()
+    conn.close()
+    return row
+
+def _import_chunk(cursor: sqlite3.Cursor, values: List[tuple], file_hash: str, csv_path: Path,
+                  size: int, offset: int) -> int:
+    """
+    写入一块 CSV 行、重算涉及学生的余额并把字节偏移写入台账 (同一事务)
+    中断后续传时，已提交的块连同其余额都已完成，返回写入行数
+    """
+    first_id = _max_id(cursor) + 1
+    cursor.executemany(f"""
+        INSERT OR IGNORE INTO consumption ({', '.join(INSERT_COLUMNS)})
+        VALUES ({', '.join('?' * len(INSERT_COLUMNS))})
+    """, values)
+    inserted = max(cursor.rowcount, 0)
+    notify_changes(cursor, inserted=(first_id, _max_id(cursor)))
+    # CSV 中自带的余额不可信，从每个学生最早的新增交易处按累计收支重算
+    since = cursor.execute("""
+        SELECT student_id, MIN(timestamp) FROM consumption
+        WHERE id >= ? GROUP BY student_id
+    """, (first_id,)).fetchall()
+    for sid, ts in since:
+        _rebalance(cursor, sid, ts)
+    _ledger_upsert(cursor, file_hash, csv_path, size, offset, inserted, 'running')
+    return inserted
+
+def import_from_csv(
+    csv_path: Path,
+    chunk_rows: int = IMPORT_CHUNK_ROWS,
+    resume: bool = True
+) -> Tuple[int, List[str]]:
+    """
+    从CSV导入数据 (幂等、可续传)
+    - 以交易指纹做唯一约束，重复记录通过 INSERT OR IGNORE 跳过
+    - 每 chunk_rows 行由写线程提交一次，涉及学生的余额重算和字节偏移 (import_ledger) 在同一事务中
+    - 中途中断后再次导入同一文件，会从最后一次提交的位置继续
+    - 已完整导入过的文件直接跳过
+    """
     count = 0
     errors = []
-    
+
     try:
-        # 使用 utf-8-sig 以处理可能的 BOM
-        with open(csv_path, encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            # 移除表头可能的空白字符
-            if reader.fieldnames:
-                reader.fieldnames = [name.strip() for name in reader.fieldnames]
-            
-            for row in reader:
-                try:
-                    # 处理 balance 字段，如果 CSV 中没有则默认为 0.0
-                    balance_val = float(row.get('balance', 0.0))
-                    
-                    cursor.execute("""
-                        INSERT INTO consumption (student_id, name, major, grade, balance, timestamp, amount, merchant_type, location, tx_type)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """, (
-                        row['student_id'],
-                        row['name'],
-                        row['major'],
-                        row['grade'],
-                        balance_val,
-                        row['timestamp'],
-                        float(row['amount']),
-                        row['merchant_type'],
-                        row['location'],
-                        row['tx_type']
-                    ))
-                    count += 1
-                except Exception as e:
-                    errors.append(f"Line error: {e}")
-        
-        conn.commit()
+        file_hash = file_sha1(csv_path)
+        size = csv_path.stat().st_size
+    except Exception as e:
+        return 0, [f"File error: {e}"]
+
+    entry = get_ledger_entry(file_hash)
+    if entry and entry['status'] == 'done':
+        logger.info("%s 已导入过 (sha1=%s)，跳过", csv_path, file_hash[:12])
+        return 0, []
+    start_offset = entry['byte_offset'] if entry and resume else 0
+    if start_offset:
+        logger.info("%s 从字节 %d 处继续导入", csv_path, start_offset)
+
+    try:
+        offset = start_offset
+        pending = None
+        # 每块交给写线程提交，同时解析下一块；上一块失败时停在该块之前
+        for values, chunk_errors, offset in iter_csv_chunks(csv_path, start_offset, chunk_rows):
+            if pending is not None:
+                count += pending.result()
+            pending = write(_import_chunk, values, file_hash, csv_path, size, offset)
+            errors.extend(chunk_errors)
+        if pending is not None:
+            count += pending.result()
+        write(_ledger_upsert, file_hash, csv_path, size, offset, 0, 'done').result()
     except Exception as e:
         errors.append(f"File error: {e}")
-    finally:
-        conn.close()
-        
+
     return count, errors
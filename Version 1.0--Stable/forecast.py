@@ -0,0 +1,180 @@
+"""
+余额预警：按最近 LOOKBACK_DAYS 天的消费估计每个学生工作日/周末的日均支出 (与
+get_deep_insights 的工作日/周末划分一致)，结合当前余额预测还能用几天。
+
+两次分组查询拿到全校每个学生的近期支出和最新余额，之后的预测对所有学生一次性
+做数组运算：按周期为 7 天的支出序列先跳过整周，再在最后一周内定位余额耗尽的那天。
+结果按 (当天日期, 写版本号) 缓存，同一天内数据没有变化时直接复用。
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import database
+from utils import DATE_FMT
+
+# 估计支出速度所用的历史天数
+LOOKBACK_DAYS = 28
+# 预计在这么多天内用完余额的学生需要提醒
+WARN_DAYS = 7
+
+# (当天, 写版本号, 预测基准时间, 历史天数) -> 预测结果
+_cache: Dict[Tuple[str, int, str, int], pd.DataFrame] = {}
+
+
+def _latest_timestamp(conn) -> Optional[datetime]:
+    row = conn.execute("""
+        SELECT COALESCE((SELECT MAX(timestamp) FROM consumption), (SELECT MAX(max_ts) FROM archive_partitions))
+    """).fetchone()
+    return datetime.strptime(row[0], DATE_FMT) if row and row[0] else None
+
+
+def _archived_latest(conn, as_of: datetime, known) -> pd.DataFrame:
+    """热表中截至 as_of 没有记录、全部交易都已归档的学生：余额取 archive_balances 中的归档期末余额"""
+    end = as_of.strftime(DATE_FMT)
+    balances = {sid: balance for sid, balance in conn.execute(
+        "SELECT student_id, balance FROM archive_balances WHERE timestamp <= ?", (end,)
+    ) if sid not in known}
+    rows = []
+    if balances:
+        source, _ = database._source_sql(conn, None, as_of)
+        ids = sorted(balances)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            # 姓名等取该学生最后一条归档记录 (聚合 MAX 时其余列取自同一行)
+            for sid, name, major, grade, _ in conn.execute(f"""
+                SELECT student_id, name, major, grade, MAX(timestamp) FROM {source}
+                WHERE student_id IN ({', '.join('?' * len(chunk))}) AND timestamp <= ?
+                GROUP BY student_id
+            """, chunk + [end]):
+                rows.append((sid, name, major, grade, balances[sid]))
+    return pd.DataFrame(rows, columns=["student_id", "name", "major", "grade", "balance"])
+
+
+def _load(conn, as_of: datetime, lookback_days: int) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """(每个学生截至 as_of 的最新余额, 窗口内工作日/周末的消费总额)"""
+    end = as_of.strftime(DATE_FMT)
+    # 窗口从 lookback_days 个日历天 (含 as_of 当天) 中第一天的零点开始，与下面按日历天数求平均一致
+    start_dt = datetime.combine(as_of.date() - timedelta(days=lookback_days - 1), datetime.min.time())
+    # 每个学生在 (student_id, timestamp) 索引上倒序取第一条；同一时刻多条时 id 较大的为最新 (与余额重算顺序一致)
+    latest = pd.DataFrame(conn.execute("""
+        SELECT student_id, name, major, grade, balance FROM consumption
+        WHERE id IN (
+            SELECT (
+                SELECT id FROM consumption AS c
+                WHERE c.student_id = s.student_id AND c.timestamp <= ?
+                ORDER BY c.timestamp DESC, c.id DESC LIMIT 1
+            ) FROM (SELECT DISTINCT student_id FROM consumption) AS s
+        )
+    """, (end,)).fetchall(), columns=["student_id", "name", "major", "grade", "balance"])
+    archived = _archived_latest(conn, as_of, set(latest["student_id"]))
+    if len(archived):
+        latest = pd.concat([latest, archived], ignore_index=True)
+
+    source, _ = database._source_sql(conn, start_dt, as_of)
+    spend = pd.DataFrame(conn.execute(f"""
+        SELECT student_id,
+               SUM(CASE WHEN strftime('%w', timestamp) NOT IN ('0', '6') THEN amount ELSE 0 END),
+               SUM(CASE WHEN strftime('%w', timestamp) IN ('0', '6') THEN amount ELSE 0 END)
+        FROM {source}
+        WHERE timestamp >= ? AND timestamp <= ? AND tx_type = '消费'
+        GROUP BY student_id
+    """, (start_dt.strftime(DATE_FMT), end)).fetchall(), columns=["student_id", "weekday_spend", "weekend_spend"])
+    return latest, spend
+
+
+def days_to_empty(balance: np.ndarray, rates: np.ndarray) -> np.ndarray:
+    """
+    balance: (学生数,)，rates: (学生数, 7) 为之后第 1..7 天各自的支出 (按周循环)
+    返回最小的天数 n 使前 n 天累计支出 >= 余额；余额已不足为 0，不再支出为 inf
+    """
+    cum = np.cumsum(rates, axis=1)
+    weekly = cum[:, -1]
+    result = np.full(len(balance), np.inf)
+    result[balance <= 0] = 0
+
+    live = (balance > 0) & (weekly > 0)
+    b, w, c = balance[live], weekly[live], cum[live]
+    # 需要先完整度过的周数，剩余部分一定在接下来的一周内用完
+    weeks = np.maximum(np.ceil(b / w) - 1, 0)
+    rest = b - weeks * w
+    day = (c < rest[:, None] - 1e-9).sum(axis=1) + 1
+    result[live] = weeks * 7 + day
+    return result
+
+
+def forecast(as_of: Optional[datetime] = None, lookback_days: int = LOOKBACK_DAYS) -> pd.DataFrame:
+    """
+    全校余额预测，as_of 为空时以库中最新一笔交易的时间为基准
+    返回按预计剩余天数升序的 DataFrame：学号、姓名、专业、年级、余额、工作日/周末日均支出、
+    日均支出、剩余天数 (不再消费为 inf) 和预计用完的日期
+    """
+    conn = database.get_connection()
+    try:
+        as_of = as_of or _latest_timestamp(conn)
+        if as_of is None:
+            return _empty_frame()
+        key = (datetime.now().strftime("%Y-%m-%d"), database.get_write_version(),
+               as_of.strftime(DATE_FMT), lookback_days)
+        if key in _cache:
+            return _cache[key]
+        latest, spend = _load(conn, as_of, lookback_days)
+    finally:
+        conn.close()
+
+    df = latest.merge(spend, on="student_id", how="left").fillna({"weekday_spend": 0.0, "weekend_spend": 0.0})
+
+    # 窗口 (含 as_of 当天的 lookback_days 个日历天) 中工作日/周末各有几天，支出按日历天数平均 (没消费的天也算)
+    window = pd.date_range(as_of.date() - timedelta(days=lookback_days - 1), periods=lookback_days, freq="D")
+    weekend_days = int((window.dayofweek >= 5).sum())
+    weekday_days = lookback_days - weekend_days
+    df["weekday_rate"] = df["weekday_spend"] / weekday_days if weekday_days else 0.0
+    df["weekend_rate"] = df["weekend_spend"] / weekend_days if weekend_days else 0.0
+
+    # 之后第 1..7 天分别是工作日还是周末
+    upcoming = pd.date_range(as_of.date() + timedelta(days=1), periods=7, freq="D").dayofweek >= 5
+    rates = np.where(upcoming[None, :], df["weekend_rate"].to_numpy()[:, None], df["weekday_rate"].to_numpy()[:, None])
+    df["daily_rate"] = rates.mean(axis=1)
+    df["days_to_empty"] = days_to_empty(df["balance"].to_numpy(dtype=np.float64), rates)
+
+    finite = np.isfinite(df["days_to_empty"])
+    df["empty_date"] = pd.NaT
+    df.loc[finite, "empty_date"] = (
+        pd.Timestamp(as_of.date()) + pd.to_timedelta(df.loc[finite, "days_to_empty"], unit="D")
+    )
+    df = df.drop(columns=["weekday_spend", "weekend_spend"])
+    df = df.sort_values(["days_to_empty", "balance"], kind="stable").reset_index(drop=True)
+
+    _cache.clear()
+    _cache[key] = df
+    return df
+
+
+def _empty_frame() -> pd.DataFrame:
+    return pd.DataFrame(columns=[
+        "student_id", "name", "major", "grade", "balance", "weekday_rate", "weekend_rate",
+        "daily_rate", "days_to_empty", "empty_date",
+    ])
+
+
+def low_balance_students(within_days: int = WARN_DAYS, as_of: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """预计 within_days 天内 (含) 余额用完的学生"""
+    df = forecast(as_of)
+    return df[df["days_to_empty"] <= within_days].to_dict("records")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="预测每个学生的余额还能用几天")
+    parser.add_argument("--days", type=int, default=WARN_DAYS, help="列出预计多少天内用完的学生")
+    parser.add_argument("--as-of", default=None, help="预测基准时间 (YYYY-MM-DD HH:MM:SS)，默认为最新交易时间")
+    args = parser.parse_args()
+
+    database.init_db()
+    as_of = datetime.strptime(args.as_of, DATE_FMT) if args.as_of else None
+    for s in low_balance_students(args.days, as_of):
+        print(f"{s['student_id']}  {s['name']:<6} 余额 {s['balance']:>8.2f}  日均 {s['daily_rate']:>6.2f}  "
+              f"约 {s['days_to_empty']:.0f} 天 ({s['empty_date']:%Y-%m-%d})")
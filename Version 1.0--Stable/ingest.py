@@ -0,0 +1,406 @@
+"""
+批量导入：终端每天按食堂各产生一个 CSV，这里把整个目录 (或 glob 匹配到的文件)
+交给进程池并行解析，解析结果统一交给 database 的写线程写入数据库。
+
+IngestService 则是常驻的增量导入：监听投递目录或持续追加的 CSV，
+只读取上次检查点之后的新字节，按微批次写入并增量更新余额和汇总表。
+"""
+import csv
+import glob
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class FileStats:
+    """单个文件的导入统计"""
+    path: str
+    rows: int = 0            # 解析成功的行数
+    inserted: int = 0        # 去重后实际写入的行数 (整文件已导入过时为 0)
+    parse_seconds: float = 0.0
+    write_seconds: float = 0.0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def duplicates(self) -> int:
+        return self.rows - self.inserted
+
+    @property
+    def rows_per_sec(self) -> float:
+        elapsed = self.parse_seconds + self.write_seconds
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+
+@dataclass
+class ImportSummary:
+    """一次批量导入的汇总结果"""
+    files: List[FileStats] = field(default_factory=list)
+    students: Dict[str, str] = field(default_factory=dict)  # 受影响的学生 -> 最早的新增交易时间
+    seconds: float = 0.0
+
+    @property
+    def inserted(self) -> int:
+        return sum(f.inserted for f in self.files)
+
+    @property
+    def duplicates(self) -> int:
+        return sum(f.duplicates for f in self.files)
+
+    @property
+    def errors(self) -> List[str]:
+        return [f"{Path(f.path).name}: {e}" for f in self.files for e in f.errors]
+
+
+def expand_sources(source: str) -> List[Path]:
+    """将目录或 glob 模式展开为按名称排序的 CSV 文件列表"""
+    path = Path(source)
+    if path.is_dir():
+        return sorted(p for p in path.glob("*.csv") if p.is_file())
+    if path.is_file():
+        return [path]
+    return sorted(Path(p) for p in glob.glob(source) if Path(p).is_file())
+
+
+def parse_csv_file(path: str) -> Tuple[str, str, int, List[tuple], List[str], float]:
+    """
+    解析单个 CSV 文件 (在子进程中执行)
+    返回 (路径, 文件哈希, 文件大小, 行元组列表, 错误列表, 解析耗时)
+    """
+    start = time.perf_counter()
+    rows = []
+    errors = []
+    file_hash = ""
+    size = 0
+
+    try:
+        file_hash = database.file_sha1(Path(path))
+        size = os.path.getsize(path)
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames:
+                reader.fieldnames = [name.strip() for name in reader.fieldnames]
+
+            for line_no, row in enumerate(reader, start=2):
+                try:
+                    rows.append(database.csv_row_values(row))
+                except Exception as e:
+                    errors.append(f"Line {line_no} error: {e}")
+    except Exception as e:
+        errors.append(f"File error: {e}")
+
+    return path, file_hash, size, rows, errors, time.perf_counter() - start
+
+
+def _insert_rows(cursor, rows: List[tuple]) -> Tuple[int, Dict[str, str]]:
+    """
+    写入一批行，交易指纹冲突的行 (批内重复或库中已有) 被忽略，并通知变更监听器
+    返回 (写入行数, 学生 -> 该学生最早的新增交易时间)
+    """
+    first_id = database._max_id(cursor) + 1
+    cursor.executemany(f"""
+        INSERT OR IGNORE INTO consumption ({', '.join(database.INSERT_COLUMNS)})
+        VALUES ({', '.join('?' * len(database.INSERT_COLUMNS))})
+    """, rows)
+    inserted = max(cursor.rowcount, 0)
+    if not inserted:
+        return 0, {}
+
+    last_id = database._max_id(cursor)
+    database.notify_changes(cursor, inserted=(first_id, last_id))
+    since = dict(cursor.execute("""
+        SELECT student_id, MIN(timestamp) FROM consumption
+        WHERE id BETWEEN ? AND ?
+        GROUP BY student_id
+    """, (first_id, last_id)).fetchall())
+    return inserted, since
+
+
+def _merge_since(target: Dict[str, str], since: Dict[str, str]):
+    for sid, ts in since.items():
+        if sid not in target or ts < target[sid]:
+            target[sid] = ts
+
+
+def _ingest_batch(cursor, values: List[tuple], key: str, head: str, end: int) -> Tuple[int, Dict[str, str]]:
+    """增量导入的一个微批次 (在写线程中执行)：写入、重算涉及学生的余额、推进检查点，同一事务"""
+    inserted, since = _insert_rows(cursor, values)
+    for sid, ts in since.items():
+        database._rebalance(cursor, sid, ts)
+    cursor.execute("""
+        INSERT INTO ingest_checkpoint (path, head_hash, byte_offset, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            head_hash = excluded.head_hash,
+            byte_offset = excluded.byte_offset,
+            updated_at = excluded.updated_at
+    """, (key, head, end, datetime.now().strftime(DATE_FMT)))
+    return inserted, since
+
+def _write_batch(cursor, path: str, file_hash: str, size: int, rows: List[tuple]) -> Tuple[int, Dict[str, str]]:
+    """
+    把一个文件的解析结果写入数据库 (在写线程中执行)，写入与台账在同一事务中，已完整导入过的文件直接跳过
+    返回 (写入行数, 学生 -> 最早的新增交易时间)
+    """
+    entry = cursor.execute("SELECT status FROM import_ledger WHERE file_hash = ?", (file_hash,)).fetchone()
+    if entry and entry['status'] == 'done':
+        return 0, {}
+
+    inserted, since = _insert_rows(cursor, rows)
+    database._ledger_upsert(cursor, file_hash, Path(path), size, size, inserted, 'done')
+    return inserted, since
+
+
+def import_paths(
+    paths: List[Path],
+    workers: Optional[int] = None,
+    on_progress: Optional[Callable[[FileStats], None]] = None
+) -> ImportSummary:
+    """
+    并行解析多个 CSV 文件并写入数据库
+    - 解析在进程池中进行，写入交给 database 的写线程，每个文件一个写操作
+    - 全部写完后，对涉及的学生统一重算一次余额
+    """
+    summary = ImportSummary()
+    if not paths:
+        return summary
+
+    start = time.perf_counter()
+    workers = workers or min(len(paths), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parse_csv_file, str(p)) for p in paths]
+        for fut in as_completed(futures):
+            path, file_hash, size, rows, errors, parse_seconds = fut.result()
+            stats = FileStats(path=path, rows=len(rows), parse_seconds=parse_seconds, errors=errors)
+
+            if rows:
+                t0 = time.perf_counter()
+                try:
+                    stats.inserted, students = database.write(
+                        _write_batch, path, file_hash, size, rows).result()
+                    _merge_since(summary.students, students)
+                except Exception as e:
+                    stats.errors.append(f"Write error: {e}")
+                stats.write_seconds = time.perf_counter() - t0
+
+            logger.info(
+                "导入 %s: %d 行, 写入 %d, 重复 %d, 错误 %d, %.0f 行/秒",
+                Path(path).name, stats.rows, stats.inserted, stats.duplicates,
+                len(stats.errors), stats.rows_per_sec
+            )
+            summary.files.append(stats)
+            if on_progress:
+                on_progress(stats)
+
+    # 所有文件写完后只重算一次余额 (每个学生从最早的新增交易处开始)
+    if summary.students:
+        database.recalculate_balances(sorted(summary.students), since=summary.students)
+
+    summary.seconds = time.perf_counter() - start
+    return summary
+
+
+def import_source(source: str, workers: Optional[int] = None) -> ImportSummary:
+    """按目录或 glob 模式批量导入"""
+    return import_paths(expand_sources(source), workers=workers)
+
+
+def _head_hash(path: Path) -> str:
+    """文件表头行的哈希：文件被替换 (而非追加) 时用来识别"""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.readline()).hexdigest()
+
+
+@dataclass
+class IngestStats:
+    """增量导入的运行计数"""
+    rows: int = 0                   # 累计写入行数
+    duplicates: int = 0             # 累计跳过的重复行
+    batches: int = 0                # 累计微批次数
+    errors: int = 0                 # 累计错误行/文件数
+    pending_bytes: int = 0          # 尚未读取的字节数 (上一轮扫描时)
+    rows_per_sec: float = 0.0       # 最近一个批次的写入速度
+    last_batch_at: Optional[datetime] = None
+    last_event_at: Optional[datetime] = None   # 已导入数据中最新的交易时间
+    last_error: str = ""
+
+    @property
+    def lag_seconds(self) -> Optional[float]:
+        """数据延迟：当前时间与已导入的最新交易时间之差"""
+        if not self.last_event_at:
+            return None
+        return max((datetime.now() - self.last_event_at).total_seconds(), 0.0)
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "rows": self.rows,
+            "duplicates": self.duplicates,
+            "batches": self.batches,
+            "errors": self.errors,
+            "pending_bytes": self.pending_bytes,
+            "rows_per_sec": round(self.rows_per_sec, 1),
+            "lag_seconds": None if self.lag_seconds is None else round(self.lag_seconds, 1),
+            "last_batch_at": self.last_batch_at.strftime(DATE_FMT) if self.last_batch_at else None,
+            "last_error": self.last_error,
+        }
+
+
+class IngestService:
+    """
+    常驻增量导入服务
+    source 可以是投递目录 (监听其中的 *.csv) 或单个持续追加的 CSV 文件
+    每个文件的已读字节偏移保存在 ingest_checkpoint 表中，与数据在同一事务提交，
+    因此重启后会从断点继续；文件被截断或替换时从头重读 (重复行由交易指纹过滤)
+    """
+
+    def __init__(self, source: str, interval: float = 2.0, batch_rows: int = 2000,
+                 on_batch: Optional[Callable[[IngestStats], None]] = None):
+        self.source = Path(source)
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self.on_batch = on_batch
+        self.stats = IngestStats()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest-service", daemon=True)
+        self._thread.start()
+        logger.info("开始监听 %s", self.source)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+        logger.info("停止监听 %s", self.source)
+
+    def snapshot(self) -> Dict[str, object]:
+        """线程安全地读取计数"""
+        with self._lock:
+            return self.stats.as_dict()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.exception("增量导入出错")
+                with self._lock:
+                    self.stats.errors += 1
+                    self.stats.last_error = str(e)
+            self._stop.wait(self.interval)
+
+    def _files(self) -> List[Path]:
+        if self.source.is_dir():
+            return sorted(p for p in self.source.glob("*.csv") if p.is_file())
+        return [self.source] if self.source.is_file() else []
+
+    def poll_once(self) -> int:
+        """扫描一轮，导入所有文件中的新字节，返回本轮写入的行数"""
+        total = 0
+        pending = 0
+        conn = database.get_connection()
+        try:
+            for path in self._files():
+                total += self._ingest_file(conn, path)
+                row = conn.execute(
+                    "SELECT byte_offset FROM ingest_checkpoint WHERE path = ?", (str(path),)
+                ).fetchone()
+                pending += max(path.stat().st_size - (row['byte_offset'] if row else 0), 0)
+        finally:
+            conn.close()
+        with self._lock:
+            self.stats.pending_bytes = pending
+        return total
+
+    def _ingest_file(self, conn, path: Path) -> int:
+        key = str(path)
+        size = path.stat().st_size
+        head = _head_hash(path)
+        row = conn.execute(
+            "SELECT head_hash, byte_offset FROM ingest_checkpoint WHERE path = ?", (key,)
+        ).fetchone()
+
+        offset = 0
+        if row and row['head_hash'] == head and row['byte_offset'] <= size:
+            offset = row['byte_offset']
+            if offset == size:
+                return 0
+        elif row:
+            logger.info("%s 被替换或截断，从头重新读取", path.name)
+
+        written = 0
+        for values, errors, end in database.iter_csv_chunks(path, offset, self.batch_rows, complete_lines_only=True):
+            t0 = time.perf_counter()
+            inserted, since = database.write(_ingest_batch, values, key, head, end).result()
+            elapsed = time.perf_counter() - t0
+            written += inserted
+
+            with self._lock:
+                st = self.stats
+                st.rows += inserted
+                st.duplicates += len(values) - inserted
+                st.batches += 1
+                st.errors += len(errors)
+                if errors:
+                    st.last_error = f"{path.name}: {errors[-1]}"
+                st.rows_per_sec = len(values) / elapsed if elapsed > 0 else 0.0
+                st.last_batch_at = datetime.now()
+                if since:
+                    newest = datetime.strptime(max(r[5] for r in values), DATE_FMT)
+                    if not st.last_event_at or newest > st.last_event_at:
+                        st.last_event_at = newest
+            if self.on_batch:
+                self.on_batch(self.stats)
+        return written
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="批量导入 CSV 目录或 glob 匹配的文件")
+    parser.add_argument("source", help="目录路径或 glob 模式，例如 'drop/*.csv'")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="解析进程数")
+    parser.add_argument("--watch", action="store_true", help="常驻监听目录或追加写入的 CSV，增量导入")
+    parser.add_argument("--interval", type=float, default=2.0, help="监听模式的扫描间隔 (秒)")
+    args = parser.parse_args()
+
+    database.init_db()
+
+    if args.watch:
+        service = IngestService(args.source, interval=args.interval)
+        service.start()
+        try:
+            while True:
+                time.sleep(10)
+                print(service.snapshot())
+        except KeyboardInterrupt:
+            service.stop()
+        raise SystemExit(0)
+
+    result = import_source(args.source, workers=args.workers)
+    print(f"{len(result.files)} 个文件, 写入 {result.inserted} 条, 重复 {result.duplicates} 条, "
+          f"错误 {len(result.errors)} 个, 重算 {len(result.students)} 名学生余额, 用时 {result.seconds:.2f}s")
+    for err in result.errors[:20]:
+        print("  " + err)
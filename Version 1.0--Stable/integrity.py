@@ -0,0 +1,206 @@
+"""
+余额完整性校验与修复：每条记录的 balance 应等于期初余额加上按 (时间, id) 的累计收支，
+但 CSV 里自带的余额、被中断的重算等都可能让它与累计值不一致。
+
+这里用窗口函数在库内按学生一次性算出应有的余额，按学生范围分块 (每块约
+CHUNK_ROWS 行) 交给进程池并行校验；修复时每块一个事务，用 UPDATE ... FROM
+把窗口结果写回，不在 Python 中逐行重算。期初余额与 database._rebalance 一致：
+已归档学生取 archive_balances 中的期末余额，否则为默认初始余额。
+归档分区是只读的，只校验热表。
+"""
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# 每个校验/修复块覆盖的大致行数 (按学生整体划分，不拆开同一学生)
+CHUNK_ROWS = 500_000
+# 余额按分存储，差额超过半分即视为不一致
+TOLERANCE = 0.005
+# 报告中保留的不一致样例数
+SAMPLE_LIMIT = 200
+
+# 某个学生范围内每条记录应有的余额 (累计收支在窗口内计算，期初余额在外层加上)
+_EXPECTED_SQL = f"""
+    SELECT r.id, r.student_id, r.timestamp, r.balance,
+           ROUND(COALESCE(a.balance, {database.DEFAULT_BALANCE}) + r.running, 2) AS expected
+    FROM (
+        SELECT id, student_id, timestamp, balance,
+               SUM(CASE WHEN tx_type IN ('充值', '退款') THEN amount ELSE -amount END) OVER (
+                   PARTITION BY student_id ORDER BY timestamp, id ROWS UNBOUNDED PRECEDING
+               ) AS running
+        FROM consumption
+        WHERE student_id BETWEEN ? AND ?
+    ) AS r
+    LEFT JOIN archive_balances AS a ON a.student_id = r.student_id
+"""
+_DIVERGENT = "balance IS NULL OR ABS(balance - expected) > ?"
+
+
+@dataclass
+class BalanceReport:
+    """校验 (及修复) 结果"""
+    rows: int = 0              # 校验的行数
+    students: int = 0          # 校验的学生数
+    divergent: int = 0         # 余额不一致的行数
+    divergent_students: int = 0
+    max_diff: float = 0.0
+    repaired: int = 0          # 已修复的行数
+    seconds: float = 0.0
+    samples: List[Dict[str, Any]] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.divergent == self.repaired
+
+
+def plan_chunks(conn, student_ids: Optional[Sequence[str]] = None,
+                chunk_rows: int = CHUNK_ROWS) -> List[Tuple[str, str, int, int]]:
+    """
+    把学生按学号顺序切成连续范围，每块约 chunk_rows 行
+    返回 [(起始学号, 结束学号, 行数, 学生数)]，只统计 student_ids 中的学生 (为空则全部)
+    """
+    counts = conn.execute(
+        "SELECT student_id, COUNT(*) FROM consumption GROUP BY student_id ORDER BY student_id"
+    ).fetchall()
+    if student_ids is not None:
+        wanted = set(student_ids)
+        counts = [c for c in counts if c[0] in wanted]
+
+    chunks = []
+    first, rows, students = None, 0, 0
+    for sid, n in counts:
+        if first is None:
+            first = sid
+        rows += n
+        students += 1
+        if rows >= chunk_rows:
+            chunks.append((first, sid, rows, students))
+            first, rows, students = None, 0, 0
+    if first is not None:
+        chunks.append((first, counts[-1][0], rows, students))
+    return chunks
+
+
+def _verify_chunk(db_path: str, lo: str, hi: str, tolerance: float,
+                  only: Optional[List[str]], sample_limit: int) -> Tuple[int, int, float, List[Dict[str, Any]]]:
+    """
+    在独立连接上校验一个学生范围 (进程池中执行)
+    返回 (不一致行数, 不一致学生数, 最大差额, 样例)
+    """
+    database.DB_PATH = Path(db_path)
+    conn = database.get_connection()
+    try:
+        cursor = conn.execute(f"SELECT * FROM ({_EXPECTED_SQL}) WHERE {_DIVERGENT}", (lo, hi, tolerance))
+        wanted = set(only) if only is not None else None
+        count, students, max_diff, samples = 0, set(), 0.0, []
+        for row in cursor:
+            if wanted is not None and row["student_id"] not in wanted:
+                continue
+            count += 1
+            students.add(row["student_id"])
+            diff = abs((row["balance"] or 0.0) - row["expected"])
+            max_diff = max(max_diff, diff)
+            if len(samples) < sample_limit:
+                samples.append({
+                    "id": row["id"], "student_id": row["student_id"], "timestamp": row["timestamp"],
+                    "balance": row["balance"], "expected": row["expected"],
+                })
+        return count, len(students), max_diff, samples
+    finally:
+        conn.close()
+
+
+def _repair_chunk(cursor, lo: str, hi: str, tolerance: float, only: Optional[List[str]]) -> int:
+    """把一个学生范围的不一致余额改为窗口计算的结果 (经 database.write 在写线程执行)"""
+    scope, params = "", [lo, hi, tolerance]
+    if only is not None:
+        scope = f" AND student_id IN ({', '.join('?' * len(only))})"
+        params += list(only)
+    cursor.execute(f"""
+        UPDATE consumption SET balance = fix.expected
+        FROM (SELECT id, expected FROM ({_EXPECTED_SQL}) WHERE ({_DIVERGENT}){scope}) AS fix
+        WHERE consumption.id = fix.id
+    """, params)
+    repaired = max(cursor.rowcount, 0)
+    if repaired:
+        # 余额不影响各类汇总表，不通知变更监听器，只让依赖写版本号的缓存失效
+        database.bump_write_version(cursor)
+    return repaired
+
+
+def verify_balances(
+    student_ids: Optional[Sequence[str]] = None,
+    repair: bool = False,
+    workers: Optional[int] = None,
+    chunk_rows: int = CHUNK_ROWS,
+    tolerance: float = TOLERANCE,
+    sample_limit: int = SAMPLE_LIMIT
+) -> BalanceReport:
+    """
+    校验热表中所有 (或 student_ids 指定的) 学生的余额
+    各块在进程池中并行只读校验；repair=True 时按块逐个交给写线程修复有问题的块
+    """
+    start = time.perf_counter()
+    report = BalanceReport()
+    conn = database.get_connection()
+    try:
+        chunks = plan_chunks(conn, student_ids, chunk_rows)
+        report.rows = sum(c[2] for c in chunks)
+        report.students = sum(c[3] for c in chunks)
+        # 指定了学生时，只在块内进一步筛选这些学生
+        only = sorted(set(student_ids)) if student_ids is not None else None
+
+        def scoped(lo, hi):
+            return [s for s in only if lo <= s <= hi] if only is not None else None
+
+        args = [(str(database.DB_PATH), lo, hi, tolerance, scoped(lo, hi), sample_limit)
+                for lo, hi, _, _ in chunks]
+        workers = min(workers or os.cpu_count() or 1, len(chunks))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_verify_chunk, *zip(*args)))
+        else:
+            results = [_verify_chunk(*a) for a in args]
+
+        for (lo, hi, _, _), (count, students, max_diff, samples) in zip(chunks, results):
+            report.divergent += count
+            report.divergent_students += students
+            report.max_diff = max(report.max_diff, max_diff)
+            report.samples.extend(samples[:sample_limit - len(report.samples)])
+            if repair and count:
+                report.repaired += database.write(_repair_chunk, lo, hi, tolerance, scoped(lo, hi)).result()
+                logger.info("修复余额 %s ~ %s: %d 行", lo, hi, count)
+    finally:
+        conn.close()
+
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="校验 (并修复) 每条记录的余额与累计收支是否一致")
+    parser.add_argument("--repair", action="store_true", help="把不一致的余额改为重算结果")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="并行校验的进程数")
+    parser.add_argument("--student", action="append", default=None, help="只校验指定学号 (可重复)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="每块的大致行数")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    database.init_db()
+    r = verify_balances(args.student, repair=args.repair, workers=args.workers, chunk_rows=args.chunk_rows)
+    print(f"校验 {r.rows} 行 / {r.students} 名学生，用时 {r.seconds:.1f}s")
+    print(f"不一致 {r.divergent} 行 / {r.divergent_students} 名学生，最大差额 {r.max_diff:.2f}")
+    for s in r.samples[:10]:
+        print(f"  #{s['id']} {s['student_id']} {s['timestamp']}  记录 {s['balance']}  应为 {s['expected']:.2f}")
+    if args.repair:
+        print(f"已修复 {r.repaired} 行")
@@ -0,0 +1,75 @@
+"""
+边输入边查询：查询在单个后台线程中按提交顺序执行，新的一轮查询开始时，
+上一轮仍在执行的 SQLite 语句会被 interrupt() 立即中断，排队未执行的直接放弃。
+
+每一轮用递增的代号标识；每个查询在独立连接上执行，连接的进度回调在代号过期时
+返回非零，保证即使 interrupt() 早于语句开始也能尽快停下。被放弃的查询以
+QueryCancelled 结束，调用方忽略即可。
+"""
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import database
+import metrics
+
+# 进度回调的间隔 (SQLite 虚拟机指令数)
+PROGRESS_STEPS = 10000
+
+
+class QueryCancelled(Exception):
+    """查询被更新的一轮查询取代"""
+
+
+class LiveQuery:
+    """后台执行最新一轮查询，提交新一轮时取消旧的"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="live-query")
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def cancel(self):
+        """放弃当前一轮：中断正在执行的语句，排队中的查询不再执行"""
+        with self._lock:
+            self._generation += 1
+            if self._conn is not None:
+                self._conn.interrupt()
+
+    def submit(self, fn: Callable[..., Any], *args, replace: bool = True, **kwargs) -> Future:
+        """
+        提交 fn(conn, *args, **kwargs)，conn 为后台线程中新开的连接
+        replace=True 时先取消上一轮；同一轮的多个查询用 replace=False 依次提交
+        """
+        if replace:
+            self.cancel()
+        return self._executor.submit(self._run, self._generation, fn, args, kwargs)
+
+    def _run(self, generation: int, fn, args, kwargs):
+        if generation != self._generation:
+            raise QueryCancelled()
+        conn = database.get_connection()
+        conn.set_progress_handler(lambda: generation != self._generation, PROGRESS_STEPS)
+        with self._lock:
+            self._conn = conn
+        try:
+            return fn(conn, *args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if generation != self._generation and "interrupted" in str(e):
+                metrics.incr("live_query.interrupted")
+                raise QueryCancelled() from e
+            raise
+        finally:
+            with self._lock:
+                self._conn = None
+            conn.close()
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
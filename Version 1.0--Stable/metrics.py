@@ -0,0 +1,308 @@
+"""
+性能指标：计时器、计数器和慢查询日志。
+
+默认关闭。关闭时不安装任何包装：database 的函数、DataAnalyzer / SqlReportEngine 的方法保持原样，
+连接为普通的 sqlite3.Connection，界面刷新处的 timed / timer 只多一次全局变量判断。
+
+enable() 时：
+- database 的公开函数、DataAnalyzer 和 SqlReportEngine 的公开方法被替换为计时包装 (disable() 时还原)
+- 之后打开的连接使用 TimedConnection，逐条统计 SQL 的执行 + 取数耗时，
+  超过 slow_query_ms 的语句连同 EXPLAIN QUERY PLAN 写入日志并保留最近 SLOW_LOG_SIZE 条
+snapshot() / dump_json() 导出全部指标；界面和 api_server 启动时若设置了环境变量 CAMPUS_METRICS=1
+则自动开启 (enable_from_env)。
+"""
+import functools
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+# 默认慢查询阈值 (毫秒)
+SLOW_QUERY_MS = 200.0
+# 保留的慢查询条数
+SLOW_LOG_SIZE = 100
+# SQL 计时按语句归类时保留的前缀长度
+SQL_KEY_CHARS = 60
+# 逐行调用的小函数，包装的开销会超过函数本身，不计时
+_SKIP = {"record_to_obj", "tx_fingerprint", "csv_row_values", "register_change_listener"}
+
+_enabled = False
+_lock = threading.Lock()
+slow_query_ms = SLOW_QUERY_MS
+
+
+@dataclass
+class Timer:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total_ms": round(self.total * 1000, 3),
+            "avg_ms": round(self.total * 1000 / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+_timers: Dict[str, Timer] = {}
+_counters: Dict[str, int] = {}
+_slow: Deque[Dict[str, Any]] = deque(maxlen=SLOW_LOG_SIZE)
+# enable() 替换掉的原属性：(所属对象, 属性名, 原值)
+_patched: List[Tuple[Any, str, Any]] = []
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def record(name: str, seconds: float):
+    """把一次耗时计入名为 name 的计时器"""
+    if not _enabled:
+        return
+    with _lock:
+        t = _timers.get(name)
+        if t is None:
+            t = _timers[name] = Timer()
+        t.add(seconds)
+
+
+def incr(name: str, n: int = 1):
+    """计数器加 n"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+@contextmanager
+def _timing(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+_NULL = nullcontext()
+
+
+def timer(name: str):
+    """with metrics.timer("..."): 计时一段代码，关闭时为空的上下文"""
+    return _timing(name) if _enabled else _NULL
+
+
+def timed(name: str):
+    """计时装饰器，用于界面刷新等调用不频繁的位置"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def _sql_key(sql: str) -> str:
+    return "sql " + " ".join(sql.split())[:SQL_KEY_CHARS]
+
+
+class TimedCursor(sqlite3.Cursor):
+    """统计每条语句从 execute 到 fetchall 结束的耗时，超过阈值时记录查询计划"""
+
+    _sql = ""
+    _params: Any = ()
+    _start = 0.0
+    _exec = 0.0
+    _logged = True
+
+    def execute(self, sql, parameters=()):
+        self._sql, self._params, self._logged = sql, parameters, False
+        self._start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql, self._params, self._logged = sql, None, False
+        self._start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._finish()
+
+    def fetchall(self):
+        try:
+            return super().fetchall()
+        finally:
+            if not self._logged:
+                self._finish(fetched=True)
+
+    def _finish(self, fetched: bool = False):
+        elapsed = time.perf_counter() - self._start
+        name = _sql_key(self._sql)
+        if fetched:
+            # execute 时已计过一次，这里只补上取数的时间
+            with _lock:
+                t = _timers.get(name)
+                if t is not None:
+                    t.total += elapsed - self._exec
+                    t.max = max(t.max, elapsed)
+        else:
+            self._exec = elapsed
+            record(name, elapsed)
+        if elapsed * 1000 >= slow_query_ms:
+            self._logged = True
+            _log_slow(self.connection, self._sql, self._params, elapsed)
+
+
+class TimedConnection(sqlite3.Connection):
+    """execute / executemany / cursor 都使用 TimedCursor"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connection_factory():
+    """sqlite3.connect 的 factory 参数：开启时为 TimedConnection"""
+    return TimedConnection if _enabled else sqlite3.Connection
+
+
+def _log_slow(conn: sqlite3.Connection, sql: str, params, elapsed: float):
+    plan = ""
+    if params is not None:
+        try:
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            plan = "\n".join(str(r[3]) for r in rows)
+        except sqlite3.Error as e:
+            plan = f"(无法获取查询计划: {e})"
+    text = " ".join(sql.split())
+    logger.warning("慢查询 %.0fms: %s\n%s", elapsed * 1000, text, plan)
+    with _lock:
+        _slow.append({
+            "at": datetime.now().strftime(DATE_FMT),
+            "ms": round(elapsed * 1000, 1),
+            "sql": text,
+            "params": [p if isinstance(p, (int, float, str)) or p is None else str(p)
+                       for p in (params.values() if isinstance(params, dict) else params or ())],
+            "plan": plan,
+        })
+
+
+def _wrap(fn: Callable, name: str) -> Callable:
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def _targets():
+    """(所属对象, 属性名, 计时器名) 的列表：database 的公开函数和两个分析类的公开方法"""
+    import analyzer
+    import database
+    import report_engine
+
+    result = []
+    for attr, value in vars(database).items():
+        if inspect.isfunction(value) and value.__module__ == "database" \
+                and not attr.startswith("_") and attr not in _SKIP:
+            result.append((database, attr, f"database.{attr}"))
+    for cls in (analyzer.DataAnalyzer, report_engine.SqlReportEngine):
+        for attr, value in vars(cls).items():
+            if inspect.isfunction(value) and not attr.startswith("_"):
+                result.append((cls, attr, f"{cls.__name__}.{attr}"))
+    return result
+
+
+def enable(slow_ms: Optional[float] = None):
+    """开启指标收集并安装计时包装"""
+    global _enabled, slow_query_ms
+    if slow_ms is not None:
+        slow_query_ms = slow_ms
+    if _enabled:
+        return
+    for owner, attr, name in _targets():
+        original = getattr(owner, attr)
+        _patched.append((owner, attr, original))
+        setattr(owner, attr, _wrap(original, name))
+    _enabled = True
+    logger.info("性能指标已开启 (慢查询阈值 %.0fms)", slow_query_ms)
+
+
+def disable():
+    """关闭指标收集并还原所有被包装的函数 (已收集的数据保留)"""
+    global _enabled
+    _enabled = False
+    while _patched:
+        owner, attr, original = _patched.pop()
+        setattr(owner, attr, original)
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _slow.clear()
+
+
+def snapshot() -> Dict[str, Any]:
+    """当前全部指标：计时器按总耗时降序"""
+    with _lock:
+        timers = sorted(_timers.items(), key=lambda kv: -kv[1].total)
+        return {
+            "enabled": _enabled,
+            "slow_query_ms": slow_query_ms,
+            "at": datetime.now().strftime(DATE_FMT),
+            "timers": {name: t.as_dict() for name, t in timers},
+            "counters": dict(sorted(_counters.items())),
+            "slow_queries": list(_slow),
+        }
+
+
+def dump_json(path: Path) -> Path:
+    path = Path(path)
+    path.write_text(json.dumps(snapshot(), ensure_ascii=False, indent=2), encoding="utf-8")
+    return path
+
+
+def enable_from_env():
+    """环境变量 CAMPUS_METRICS=1 时开启，CAMPUS_SLOW_MS 可覆盖慢查询阈值"""
+    if os.environ.get("CAMPUS_METRICS") == "1":
+        slow = os.environ.get("CAMPUS_SLOW_MS")
+        enable(float(slow) if slow else None)
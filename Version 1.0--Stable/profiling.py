@@ -0,0 +1,376 @@
+"""
+性能分析模式：把一次操作 (统计分析、异常检测、导入) 包在 cProfile 或采样分析器中，
+同时可用 tracemalloc 记录内存分配，结果写入 data/profiles/：
+
+- <操作>-<时间>.collapsed   折叠调用栈 ("根;...;叶 数值" 每行一条)，可直接交给 flamegraph.pl / speedscope
+                            cProfile 模式的数值为微秒，采样模式为采样次数
+- <操作>-<时间>.txt         自身耗时最多的函数、cProfile 累计耗时排行、分配最多的代码行和峰值内存
+
+cProfile 只记录调用者 -> 被调用者的边，折叠栈由调用图按边上的累计耗时比例展开得到；
+采样模式由后台线程每隔 interval 秒读取被分析线程的当前栈，开销低、栈是真实的，但短操作样本少。
+写入在 database 的写线程中执行，两种模式都同时记录该线程 (折叠栈中以 db-writer 为根)。
+
+界面的诊断菜单或 configure() 设置模式后，session() 包住的操作都会被分析，未开启时为空的上下文。
+命令行：
+    python profiling.py analyze --mode sample --major 计算机
+    python profiling.py suspicious --threshold 200
+    python profiling.py import data/consumption_sample.csv --db /tmp/copy.db
+"""
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import anomaly
+import database
+from analyzer import DataAnalyzer
+from report_engine import SqlReportEngine
+from reporting import format_report_text
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sample")
+# 采样间隔 (秒)
+SAMPLE_INTERVAL = 0.005
+# tracemalloc 为每次分配保留的栈深度 (用于把分配归到本项目的代码行)
+TRACE_FRAMES = 25
+# 报告中各排行的条数
+TOP_N = 30
+# cProfile 展开调用图时，占总耗时比例低于此值的分支不再展开
+MIN_SHARE = 1e-4
+
+# 当前模式 (None 为关闭)、是否跟踪内存、结果回调，由 configure() 设置
+mode: Optional[str] = None
+trace_memory = True
+_on_done: Optional[Callable[["ProfileResult"], None]] = None
+
+_SOURCE_DIR = str(Path(__file__).resolve().parent)
+
+
+@dataclass
+class ProfileResult:
+    action: str
+    mode: str
+    seconds: float
+    collapsed_path: Path
+    report_path: Path
+    peak_bytes: Optional[int] = None
+
+
+def configure(new_mode: Optional[str], memory: bool = True,
+              on_done: Optional[Callable[[ProfileResult], None]] = None):
+    """设置之后 session() 使用的模式，new_mode 为 None 时关闭"""
+    global mode, trace_memory, _on_done
+    if new_mode is not None and new_mode not in MODES:
+        raise ValueError(f"未知的分析模式: {new_mode}")
+    mode, trace_memory, _on_done = new_mode, memory, on_done
+
+
+def _label(filename: str, lineno: int, name: str) -> str:
+    if filename == "~":  # 内置函数
+        return name
+    return f"{name} ({Path(filename).name}:{lineno})"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return _label(code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class Sampler:
+    """
+    后台线程定时读取目标线程的调用栈，统计每条栈出现的次数
+    database 的写线程正在提交写操作时也一并采样，栈从 WriteQueue._commit 之下开始
+    """
+
+    def __init__(self, thread_id: int, base_frame, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.base_frame = base_frame  # 这一帧及其调用者不计入
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        commit = database.WriteQueue._commit.__code__
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            frame = frames.get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.base_frame:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+            writer = database._writer._thread
+            frame = frames.get(writer.ident) if writer is not None else None
+            stack = []
+            while frame is not None and frame.f_code is not commit:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if frame is not None and stack:
+                self.stacks["db-writer;" + ";".join(reversed(stack))] += 1
+            del frames, frame
+
+
+def collapse_cprofile(profile: cProfile.Profile) -> Counter:
+    """
+    cProfile 结果 -> 折叠栈 (微秒)
+    从没有调用者的函数出发沿调用边展开，每条边按其累计耗时占被调用函数总累计耗时的比例
+    分摊被调用函数的自身耗时和下游耗时；递归调用不再展开
+    """
+    stats = pstats.Stats(profile).stats
+    callees: Dict[tuple, Dict[tuple, float]] = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+
+    roots = [func for func, value in stats.items() if not value[4]]
+    total = sum(stats[r][3] for r in roots)
+    cutoff = total * MIN_SHARE
+    stacks: Counter = Counter()
+
+    def walk(func, path: List[str], on_path: set, share: float):
+        _, _, tt, ct, _ = stats[func]
+        path = path + [_label(*func)]
+        scale = share / ct if ct else 0.0
+        self_us = int(round(tt * scale * 1e6))
+        if self_us:
+            stacks[";".join(path)] += self_us
+        on_path = on_path | {func}
+        for callee, edge_ct in callees.get(func, {}).items():
+            sub = edge_ct * scale
+            if callee not in on_path and sub >= cutoff:
+                walk(callee, path, on_path, sub)
+
+    for root in roots:
+        walk(root, [], set(), stats[root][3])
+    return stacks
+
+
+def self_times(stacks: Counter) -> Counter:
+    """折叠栈 -> 每个函数的自身数值 (栈顶)"""
+    result: Counter = Counter()
+    for stack, value in stacks.items():
+        result[stack.rsplit(";", 1)[-1]] += value
+    return result
+
+
+def _allocation_report(snapshot: tracemalloc.Snapshot) -> List[str]:
+    """分配最多的代码行，以及归到本项目源码 (最内层的一帧) 后的排行"""
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        tracemalloc.Filter(False, __file__),
+    ])
+    lines = ["", f"== 分配最多的代码行 (前 {TOP_N}) =="]
+    for stat in snapshot.statistics("lineno")[:TOP_N]:
+        frame = stat.traceback[0]
+        lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} 次  {frame.filename}:{frame.lineno}")
+
+    ours: Counter = Counter()
+    counts: Counter = Counter()
+    for stat in snapshot.statistics("traceback"):
+        # traceback 中最近的调用在后，取最后一个属于本项目的帧
+        for frame in reversed(stat.traceback):
+            if frame.filename.startswith(_SOURCE_DIR):
+                key = f"{Path(frame.filename).name}:{frame.lineno}"
+                ours[key] += stat.size
+                counts[key] += stat.count
+                break
+    lines += ["", f"== 按本项目代码行归并的分配 (前 {TOP_N}) =="]
+    for key, size in ours.most_common(TOP_N):
+        lines.append(f"{size / 1024:10.1f} KiB {counts[key]:8d} 次  {key}")
+    return lines
+
+
+class Session:
+    """分析一段代码：with profiling.Session("analyze", "sample"): ...，退出时写出结果到 result"""
+
+    def __init__(self, action: str, mode: str, memory: bool = True, out_dir: Optional[Path] = None):
+        if mode not in MODES:
+            raise ValueError(f"未知的分析模式: {mode}")
+        self.action = action
+        self.mode = mode
+        self.memory = memory
+        self.out_dir = out_dir
+        self.result: Optional[ProfileResult] = None
+
+    def __enter__(self):
+        self._own_tracing = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+                self._own_tracing = True
+            tracemalloc.reset_peak()
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            # 写线程上另用一个 Profile，由排队的写操作在该线程中开启/关闭
+            self._writer_profile = cProfile.Profile()
+            database.write(lambda cursor: self._writer_profile.enable()).result()
+        else:
+            self._sampler = Sampler(threading.get_ident(), sys._getframe(1))
+            self._sampler.start()
+        self._start = time.perf_counter()
+        if self.mode == "cprofile":
+            self._profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.mode == "cprofile":
+            self._profile.disable()
+            database.write(lambda cursor: self._writer_profile.disable()).result()
+        else:
+            self._sampler.stop()
+        seconds = time.perf_counter() - self._start
+
+        snapshot, peak = None, None
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if self._own_tracing:
+                tracemalloc.stop()
+
+        try:
+            self.result = self._write(seconds, snapshot, peak)
+            logger.info("性能分析 %s (%s, %.2fs) 已写入 %s", self.action, self.mode, seconds, self.result.collapsed_path)
+            if _on_done:
+                _on_done(self.result)
+        except Exception:
+            logger.exception("写入性能分析结果失败")
+        return False
+
+    def _write(self, seconds: float, snapshot, peak) -> ProfileResult:
+        out_dir = Path(self.out_dir or database.DB_PATH.parent / "profiles")
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stem = f"{self.action}-{datetime.now():%Y%m%d-%H%M%S}"
+
+        if self.mode == "cprofile":
+            stacks = collapse_cprofile(self._profile)
+            for stack, value in collapse_cprofile(self._writer_profile).items():
+                stacks["db-writer;" + stack] += value
+            unit = "微秒"
+        else:
+            stacks = self._sampler.stacks
+            unit = f"采样次数 (每 {self._sampler.interval * 1000:.0f}ms 一次)"
+        # 去掉分析器自身退出时的帧
+        own_exit = _label(__file__, Session.__exit__.__code__.co_firstlineno, "__exit__")
+        stacks = Counter({f"{self.action};{stack}": value for stack, value in stacks.items()
+                          if not stack.startswith(own_exit)})
+
+        collapsed_path = out_dir / f"{stem}.collapsed"
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, value in sorted(stacks.items()):
+                f.write(f"{stack} {value}\n")
+
+        lines = [
+            f"操作: {self.action}",
+            f"模式: {self.mode}，数值单位: {unit}",
+            f"耗时: {seconds:.3f}s" + (" (含 tracemalloc 开销)" if peak is not None else ""),
+        ]
+        if peak is not None:
+            lines.append(f"峰值内存 (tracemalloc): {peak / 1024 / 1024:.1f} MiB")
+        own = self_times(stacks)
+        total = sum(own.values()) or 1
+        lines += ["", f"== 自身耗时最多的函数 (前 {TOP_N}) =="]
+        for name, value in own.most_common(TOP_N):
+            lines.append(f"{value:12d} {value / total:7.1%}  {name}")
+        if self.mode == "cprofile":
+            buf = io.StringIO()
+            stats = pstats.Stats(self._profile, stream=buf)
+            stats.add(self._writer_profile)
+            stats.sort_stats("cumulative").print_stats(TOP_N)
+            lines += ["", "== cProfile 累计耗时排行 ==", buf.getvalue()]
+        if snapshot is not None:
+            lines += _allocation_report(snapshot)
+
+        report_path = out_dir / f"{stem}.txt"
+        report_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return ProfileResult(self.action, self.mode, seconds, collapsed_path, report_path, peak)
+
+
+def session(action: str):
+    """按当前模式分析一段代码，未开启时为空的上下文"""
+    if mode is None:
+        return nullcontext()
+    return Session(action, mode, trace_memory)
+
+
+def _run_analyze(args, filters):
+    engine = SqlReportEngine(**filters)
+    report = engine.generate_report(args.threshold, args.freq_window, args.freq_count)
+    insights = engine.get_deep_insights(approximate=args.approximate)
+    params = {"single_threshold": args.threshold, "freq_window": args.freq_window, "freq_count": args.freq_count}
+    return format_report_text(report, insights, params)
+
+
+def _run_suspicious(args, filters):
+    analyzer = DataAnalyzer.from_database(("get_suspicious_records",), **filters)
+    engine = anomaly.RuleEngine.from_specs(anomaly.default_rules(args.threshold, args.freq_window, args.freq_count))
+    suspicious, _ = engine.run(analyzer.df)
+    return f"{len(suspicious)} 条异常交易"
+
+
+def _run_import(args, filters):
+    count, errors = database.import_from_csv(Path(args.csv))
+    return f"导入 {count} 条，{len(errors)} 个错误"
+
+
+ACTIONS = {"analyze": _run_analyze, "suspicious": _run_suspicious, "import": _run_import}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from utils import parse_datetime
+
+    parser = argparse.ArgumentParser(description="分析一次操作的耗时与内存分配，输出折叠调用栈")
+    parser.add_argument("action", choices=list(ACTIONS))
+    parser.add_argument("csv", nargs="?", help="import 操作导入的 CSV 文件")
+    parser.add_argument("--mode", choices=MODES, default="cprofile", help="cProfile 或采样")
+    parser.add_argument("--no-memory", action="store_true", help="不跟踪内存分配 (tracemalloc 会明显拖慢执行)")
+    parser.add_argument("--out", type=Path, default=None, help="输出目录 (默认 data/profiles)")
+    parser.add_argument("--db", type=Path, default=None, help="数据库路径 (默认 data/campus.db)")
+    parser.add_argument("--threshold", type=float, default=200.0, help="大额交易阈值")
+    parser.add_argument("--freq-window", type=int, default=10, help="高频检测时间窗口 (分钟)")
+    parser.add_argument("--freq-count", type=int, default=3, help="高频检测次数阈值")
+    parser.add_argument("--approximate", action="store_true", help="深度分析使用每日草图")
+    for key in ("student_id", "name", "major", "grade", "location"):
+        parser.add_argument(f"--{key.replace('_', '-')}", default="", dest=key)
+    parser.add_argument("--start", default="", help="开始时间 YYYY-MM-DD HH:MM:SS")
+    parser.add_argument("--end", default="", help="结束时间 YYYY-MM-DD HH:MM:SS")
+    args = parser.parse_args()
+
+    if args.action == "import" and not args.csv:
+        parser.error("import 需要指定 CSV 文件")
+    if args.db is not None:
+        database.DB_PATH = args.db
+    database.init_db()
+    filters = {key: getattr(args, key) for key in ("student_id", "name", "major", "grade", "location")}
+    filters["start_date"] = parse_datetime(args.start) if args.start else None
+    filters["end_date"] = parse_datetime(args.end) if args.end else None
+
+    with Session(args.action, args.mode, memory=not args.no_memory, out_dir=args.out) as s:
+        summary = ACTIONS[args.action](args, filters)
+    print(summary if args.action != "analyze" else summary.splitlines()[0])
+    print(f"用时 {s.result.seconds:.2f}s")
+    print(f"折叠栈: {s.result.collapsed_path}")
+    print(f"报告:   {s.result.report_path}")
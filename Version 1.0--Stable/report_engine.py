@@ -0,0 +1,305 @@
+"""
+SQL 下推的报告引擎：generate_report / get_deep_insights 中的各个部分本质上都是
+GROUP BY 聚合，这里把它们编译成 SQLite 聚合查询直接在库内执行，
+返回与 DataAnalyzer 相同结构的字典，全程不把明细行加载到 Python。
+"""
+import sqlite3
+from datetime import date, datetime
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import database
+import sketches
+from utils import money, money_mean
+
+# 近似模式报告的金额分位数
+APPROX_QUANTILES = (0.5, 0.9, 0.99)
+
+# 与 DataAnalyzer.get_deep_insights 的三餐划分保持一致
+MEAL_HOURS = {
+    "breakfast": range(6, 10),
+    "lunch": range(11, 14),
+    "dinner": range(17, 20),
+}
+
+
+class SqlReportEngine:
+    """
+    按过滤条件在数据库内计算报告
+    过滤参数与 database.fetch_records 相同，column_filters 为结果表的列过滤 (与 database.fetch_page 相同)；
+    conn 为调用方持有的连接 (如连接池中的只读连接)，为空时每次查询自行打开并关闭连接
+    """
+
+    def __init__(
+        self,
+        student_id: str = "",
+        name: str = "",
+        major: str = "",
+        grade: str = "",
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        location: str = "",
+        column_filters: Sequence[Tuple[str, str, str]] = (),
+        conn: Optional[sqlite3.Connection] = None
+    ):
+        self.conn = conn
+        self.filters = dict(student_id=student_id, name=name, major=major, grade=grade,
+                            start_date=start_date, end_date=end_date, location=location,
+                            column_filters=tuple(tuple(c) for c in column_filters))
+
+    def _open(self):
+        """打开连接并返回 (连接, FROM 子句, WHERE 子句, 参数)"""
+        conn = self.conn or database.get_connection()
+        where, params, source = database._table_where(conn, **self.filters)
+        return conn, source, where, params
+
+    def _close(self, conn):
+        """关闭 _open 打开的连接，调用方传入的连接保持打开"""
+        if conn is not self.conn:
+            conn.close()
+
+    def _summary_usable(self) -> bool:
+        """
+        只有日期过滤且按整天划分时，可以直接读预聚合的 daily_summary 表
+        (其中包含已归档的数据，与 UNION ALL 数据源一致)
+        """
+        f = self.filters
+        if any(f[k] for k in ("student_id", "name", "major", "grade", "location", "column_filters")):
+            return False
+        start, end = f["start_date"], f["end_date"]
+        if start and start.time() != datetime.min.time():
+            return False
+        if end and end.strftime("%H:%M:%S") != "23:59:59":
+            return False
+        return True
+
+    def _day_range(self):
+        f = self.filters
+        lo = f["start_date"].strftime("%Y-%m-%d") if f["start_date"] else ""
+        hi = f["end_date"].strftime("%Y-%m-%d") if f["end_date"] else "9999-12-31"
+        return lo, hi
+
+    def generate_report(
+        self,
+        single_threshold: float,
+        freq_window_min: int,
+        freq_count: int,
+    ) -> Dict[str, Any]:
+        conn, source, where, params = self._open()
+        try:
+            # 1. 消费汇总
+            if self._summary_usable():
+                day_rows = conn.execute("""
+                    SELECT day, SUM(total_amount) FROM daily_summary
+                    WHERE day BETWEEN ? AND ?
+                    GROUP BY day ORDER BY day
+                """, self._day_range()).fetchall()
+                merchant_rows = conn.execute("""
+                    SELECT merchant_type, SUM(total_amount), SUM(tx_count) FROM daily_summary
+                    WHERE day BETWEEN ? AND ?
+                    GROUP BY merchant_type ORDER BY merchant_type
+                """, self._day_range()).fetchall()
+            else:
+                day_rows = conn.execute(f"""
+                    SELECT substr(timestamp, 1, 10) AS day, SUM(amount) FROM {source}
+                    WHERE {where}
+                    GROUP BY day ORDER BY day
+                """, params).fetchall()
+                merchant_rows = conn.execute(f"""
+                    SELECT merchant_type, SUM(amount), COUNT(*) FROM {source}
+                    WHERE {where}
+                    GROUP BY merchant_type ORDER BY merchant_type
+                """, params).fetchall()
+
+            # 2. 习惯分析 + 大额笔数
+            habits = conn.execute(f"""
+                SELECT COUNT(*), SUM(amount), MAX(amount),
+                       SUM(CASE WHEN amount > ? THEN 1 ELSE 0 END)
+                FROM {source} WHERE {where}
+            """, [single_threshold] + params).fetchone()
+
+            if not habits[0]:
+                return {
+                    "summary": {"daily": {}, "weekly": {}, "monthly": {}},
+                    "habits": {
+                        "count": 0, "total": 0.0, "avg": 0.0, "max": 0.0,
+                        "merchant_breakdown": {}
+                    },
+                    "anomalies": {"large_count": 0, "freq_count": 0}
+                }
+
+            # 3. 高频：每条记录往前 freq_window_min 分钟 (左开右闭) 内同一学生的交易次数
+            # 次数 = 按 (时间, id) 的序号 - 时间不晚于 (当前 - 窗口) 的记录数
+            window_sec = int(freq_window_min) * 60
+            freq_total = conn.execute(f"""
+                SELECT COALESCE(SUM(cnt >= ?), 0) FROM (
+                    SELECT ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY ts, id)
+                         - COUNT(*) OVER (
+                               PARTITION BY student_id ORDER BY ts
+                               RANGE BETWEEN UNBOUNDED PRECEDING AND ? PRECEDING
+                           ) AS cnt
+                    FROM (
+                        SELECT id, student_id, CAST(strftime('%s', timestamp) AS INTEGER) AS ts
+                        FROM {source} WHERE {where}
+                    )
+                )
+            """, [freq_count, window_sec] + params).fetchone()[0]
+        finally:
+            self._close(conn)
+
+        daily_dict = {}
+        by_sunday = {}
+        monthly_dict = {}
+        # 合计规整到分 (utils.money)，与 DataAnalyzer 的结果逐位相同
+        for day, total in day_rows:
+            if not total:
+                continue
+            if money(total) > 0:
+                daily_dict[day] = money(total)
+            # 与 pandas resample('W') 一致：周以周日结束
+            d = date.fromisoformat(day)
+            sunday = date.fromordinal(d.toordinal() + (6 - d.weekday()))
+            by_sunday[sunday] = by_sunday.get(sunday, 0.0) + total
+            monthly_dict[day[:7]] = monthly_dict.get(day[:7], 0.0) + total
+
+        # key 取周日的 "年-ISO周号"，与 DataAnalyzer 完全一致 (包括跨年时同名 key 后者覆盖前者)
+        weekly_dict = {}
+        for sunday in sorted(by_sunday):
+            if money(by_sunday[sunday]) > 0:
+                weekly_dict[f"{sunday.year}-W{sunday.isocalendar()[1]:02d}"] = money(by_sunday[sunday])
+        monthly_dict = {k: money(v) for k, v in monthly_dict.items() if money(v) > 0}
+
+        return {
+            "summary": {
+                "daily": daily_dict,
+                "weekly": weekly_dict,
+                "monthly": monthly_dict
+            },
+            "habits": {
+                "count": habits[0],
+                "total": money(habits[1]),
+                "avg": money_mean(habits[1], habits[0]),
+                "max": float(habits[2]),
+                "merchant_breakdown": {
+                    m: {"total": money(total), "count": count} for m, total, count in merchant_rows
+                }
+            },
+            "anomalies": {
+                "large_count": habits[3],
+                "freq_count": freq_total
+            }
+        }
+
+    def get_deep_insights(self, approximate: bool = False, read_only: bool = False) -> Dict[str, Any]:
+        """
+        与 DataAnalyzer.get_deep_insights 相同的结构，只统计 '消费' 记录
+        approximate=True 且只有整天的日期过滤时，改为合并每日草图 (sketches.py)：
+        学生数与 Top 地点为近似值，结果中额外的 'approx' 给出误差范围和金额分位数；
+        其它过滤条件下仍精确计算
+        read_only=True 时不补齐草图 (补齐由写入方负责)，草图落后时退回精确计算
+        """
+        if approximate and self._summary_usable():
+            if not read_only:
+                return self._approximate_insights()
+            if sketches.is_current():
+                return self._approximate_insights(catch_up=False)
+
+        insights = _empty_insights()
+        conn, source, where, params = self._open()
+        where += " AND tx_type = '消费'"
+        try:
+            weekend = "strftime('%w', timestamp) IN ('0', '6')"
+            row = conn.execute(f"""
+                SELECT COUNT(DISTINCT student_id), SUM(amount), COUNT(*), MAX(amount),
+                       SUM(CASE WHEN {weekend} THEN amount END), SUM({weekend}),
+                       SUM(CASE WHEN NOT {weekend} THEN amount END), SUM(NOT {weekend})
+                FROM {source} WHERE {where}
+            """, params).fetchone()
+            if not row[0]:
+                return insights
+            overall = (row[0], money_mean(row[1], row[2]), row[3],
+                       money_mean(row[4], row[5]), money_mean(row[6], row[7]))
+
+            hours = conn.execute(f"""
+                SELECT CAST(substr(timestamp, 12, 2) AS INTEGER) AS hour, COUNT(*) FROM {source}
+                WHERE {where}
+                GROUP BY hour
+            """, params).fetchall()
+            locations = conn.execute(f"""
+                SELECT location, COUNT(*) AS cnt FROM {source}
+                WHERE {where}
+                GROUP BY location ORDER BY cnt DESC, location LIMIT 5
+            """, params).fetchall()
+        finally:
+            self._close(conn)
+
+        _fill_insights(insights, overall, hours, locations)
+        return insights
+
+    def _approximate_insights(self, catch_up: bool = True) -> Dict[str, Any]:
+        insights = _empty_insights()
+        merged, days = sketches.merged_sketch(*self._day_range(), catch_up=catch_up)
+        if not merged.tx_count:
+            return insights
+
+        weekday_count = merged.tx_count - merged.weekend_count
+        overall = (
+            round(merged.students.count()),
+            money_mean(merged.total_amount, merged.tx_count),
+            merged.max_amount,
+            money_mean(merged.weekend_total, merged.weekend_count),
+            money_mean(merged.total_amount - merged.weekend_total, weekday_count),
+        )
+        hours = [(h, int(c)) for h, c in enumerate(merged.hours) if c]
+        top_locations = merged.locations.top(5)
+        _fill_insights(insights, overall, hours, [(loc, count) for loc, count, _ in top_locations])
+
+        insights['approx'] = {
+            'days': days,
+            'student_count_error': merged.students.relative_error,
+            'top_locations_error': {loc: err for loc, _, err in top_locations},
+            'top_merchants': {m: count for m, count, _ in merged.merchants.top(5)},
+            'amount_quantiles': {q: merged.amounts.quantile(q) for q in APPROX_QUANTILES},
+            'quantile_rank_error': {q: merged.amounts.rank_error(q) for q in APPROX_QUANTILES},
+        }
+        return insights
+
+
+def _empty_insights() -> Dict[str, Any]:
+    return {
+        'peak_hours': [],
+        'peak_hour': 0,
+        'weekend_avg': 0.0,
+        'weekday_avg': 0.0,
+        'top_locations': {},
+        'meal_stats': {'breakfast': 0, 'lunch': 0, 'dinner': 0, 'other': 0},
+        'avg_meal_cost': 0.0,
+        'most_expensive_meal': 0.0,
+        'student_count': 0
+    }
+
+
+def _fill_insights(insights: Dict[str, Any], overall, hours, locations):
+    """
+    overall = (学生数, 笔均, 最高, 周末笔均, 工作日笔均)
+    hours = [(小时, 次数)]，locations = 已排序的 [(地点, 次数)]
+    """
+    insights['student_count'] = overall[0]
+    insights['avg_meal_cost'] = float(overall[1])
+    insights['most_expensive_meal'] = float(overall[2])
+    insights['weekend_avg'] = float(overall[3]) if overall[3] is not None else 0.0
+    insights['weekday_avg'] = float(overall[4]) if overall[4] is not None else 0.0
+
+    # 1. 高峰时段：按次数降序，次数相同取较早的小时
+    top_hours = [h for h, _ in sorted(hours, key=lambda x: (-x[1], x[0]))[:3]]
+    insights['peak_hours'] = top_hours
+    insights['peak_hour'] = top_hours[0] if top_hours else 0
+
+    # 2. 三餐规律
+    meal_stats = {'breakfast': 0, 'lunch': 0, 'dinner': 0, 'other': 0}
+    for hour, count in hours:
+        meal = next((m for m, rng in MEAL_HOURS.items() if hour in rng), 'other')
+        meal_stats[meal] += count
+    insights['meal_stats'] = meal_stats
+
+    # 3. 最受欢迎的地点 (Top 5)
+    insights['top_locations'] = {loc: count for loc, count in locations}
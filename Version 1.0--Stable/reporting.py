@@ -0,0 +1,306 @@
+"""
+报告输出：文本报告、离屏渲染的图表，以及按专业/年级/学生批量生成的报告包。
+
+图表直接用 matplotlib.figure.Figure 和 Agg 画布绘制，不经过 pyplot 和 Tk，
+因此可以放在子进程里执行：界面导出报告时图表交给后台进程生成，不阻塞 Tk 线程；
+批量模式把每个群体的统计和出图分给进程池，各进程独立打开数据库连接，
+每个群体输出一个文本报告和趋势/商户占比图 (PNG 或 SVG)，另写一份 index.csv 汇总。
+"""
+import csv
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import matplotlib
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    HAS_MPL = True
+except ImportError:
+    HAS_MPL = False
+
+import charts
+import database
+from report_engine import SqlReportEngine
+
+logger = logging.getLogger(__name__)
+
+# 支持的图表格式
+FORMATS = ("png", "svg")
+# 可批量导出的分组字段
+BATCH_FIELDS = {"major": "专业", "grade": "年级", "student_id": "学生"}
+# 与界面默认值一致的分析参数
+DEFAULT_PARAMS = {"single_threshold": 200.0, "freq_window": 10, "freq_count": 3}
+# 文件名中不能出现的字符
+_UNSAFE = re.compile(r'[\\/:*?"<>|\s\x00-\x1f]+')
+# Windows 保留的设备名，不能作为文件名 (含扩展名时也不行)
+_RESERVED = {"con", "prn", "aux", "nul", *(f"com{i}" for i in range(1, 10)), *(f"lpt{i}" for i in range(1, 10))}
+
+
+def safe_filename(value: str) -> str:
+    """
+    把群体取值转为文件名主干：替换非法字符，去掉首尾的点和空格，避开设备名
+    保留取值中的点 ("1.5" 不会被当作扩展名截断)，扩展名由调用方直接拼接
+    """
+    name = _UNSAFE.sub("_", value).strip(". ")
+    if not name:
+        return "_"
+    return f"_{name}" if name.lower() in _RESERVED else name
+
+
+def unique_filenames(values: Sequence[str]) -> List[str]:
+    """每个取值对应一个不重复的文件名主干，清洗后相同 (或只差大小写) 的依次加 _2、_3 后缀"""
+    used, names = set(), []
+    for value in values:
+        base = name = safe_filename(value)
+        n = 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}_{n}"
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+def _with_ext(stem: Path, ext: str) -> Path:
+    # 不用 with_suffix：主干中含点时会把点之后的部分当作扩展名替换掉
+    return stem.with_name(f"{stem.name}.{ext}")
+
+
+def format_report_text(report, deep_insights, params):
+    lines = []
+    lines.append("=== 基础统计 ===")
+    lines.append(f"统计天数：{len(report['summary']['daily'])} 天")
+    lines.append(f"统计周数：{len(report['summary']['weekly'])} 周")
+    approx = deep_insights.get('approx')
+    if approx:
+        lines.append(f"涉及学生：约 {deep_insights.get('student_count', 0)} 人 "
+                     f"(±{approx['student_count_error']:.1%})")
+    else:
+        lines.append(f"涉及学生：{deep_insights.get('student_count', 0)} 人")
+    
+    lines.append("\n=== 消费习惯深度分析 ===")
+    h = report["habits"]
+    lines.append(f"总消费额: {h['total']:.2f} 元")
+    lines.append(f"交易笔数: {h['count']} 笔")
+    lines.append(f"笔均消费: {h['avg']:.2f} 元")
+    lines.append(f"单笔最高: {h['max']:.2f} 元")
+    
+    peak = deep_insights.get('peak_hour', 0)
+    lines.append(f"\n高峰时段: {peak}:00 - {peak+1}:00")
+    
+    weekend_avg = deep_insights.get('weekend_avg', 0.0)
+    weekday_avg = deep_insights.get('weekday_avg', 0.0)
+    
+    lines.append(f"周末日均: {weekend_avg:.2f} 元")
+    lines.append(f"工作日日均: {weekday_avg:.2f} 元")
+    
+    if weekend_avg > weekday_avg:
+        lines.append("  -> 周末消费更高")
+    else:
+        lines.append("  -> 工作日消费更高")
+
+    # Meal Stats
+    ms = deep_insights.get('meal_stats', {})
+    lines.append("\n=== 三餐规律 ===")
+    lines.append(f"早餐 (06-09): {ms.get('breakfast', 0)} 次")
+    lines.append(f"午餐 (11-13): {ms.get('lunch', 0)} 次")
+    lines.append(f"晚餐 (17-19): {ms.get('dinner', 0)} 次")
+    lines.append(f"其他时段: {ms.get('other', 0)} 次")
+
+    lines.append("\n=== 热门消费地点 (Top 5) ===")
+    top_locs = deep_insights.get('top_locations', {})
+    for loc, count in top_locs.items():
+        if approx and approx['top_locations_error'].get(loc):
+            lines.append(f"  {loc}: 约 {count} 次 (误差 ≤ {approx['top_locations_error'][loc]})")
+        else:
+            lines.append(f"  {loc}: {count} 次")
+
+    if approx:
+        lines.append(f"\n=== 近似统计 (合并 {approx['days']} 天的草图) ===")
+        lines.append("金额分位数:")
+        for q, value in approx['amount_quantiles'].items():
+            lines.append(f"  P{q * 100:g}: {value:.2f} 元 (秩误差 ±{approx['quantile_rank_error'][q]:.2%})")
+        lines.append("热门商户类型:")
+        for merchant, count in approx['top_merchants'].items():
+            lines.append(f"  {merchant}: {count} 次")
+        
+    lines.append("\n=== 异常检测 ===")
+    lines.append(f"大额交易 (> {params['single_threshold']}元): {report['anomalies']['large_count']} 笔")
+    lines.append(f"高频交易 ({params['freq_window']}min内 > {params['freq_count']}次): {report['anomalies']['freq_count']} 笔")
+    
+    return "\n".join(lines)
+
+
+def render_charts(report: Dict[str, Any], stem: Path, formats: Sequence[str] = ("png",),
+                  dpi: int = 100) -> List[Path]:
+    """
+    把报告的日消费趋势和商户占比画成一张图，按 formats 写出 stem.png / stem.svg
+    只用 Agg 画布，可在任意线程或子进程中调用；未安装 matplotlib 时不输出
+    """
+    if not HAS_MPL:
+        return []
+    # 子进程不会执行界面中的字体配置，这里单独设置
+    matplotlib.rcParams['font.sans-serif'] = ['Microsoft YaHei', 'SimHei', 'Arial Unicode MS']
+    matplotlib.rcParams['axes.unicode_minus'] = False
+
+    fig = Figure(figsize=(10, 3.5), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax1, ax2 = fig.subplots(1, 2)
+    charts.TrendPlot(ax1, "日消费趋势", "日期", "金额").update(report["summary"]["daily"])
+
+    merchants = report["habits"]["merchant_breakdown"]
+    if merchants:
+        ax2.pie([v['total'] for v in merchants.values()], labels=list(merchants.keys()),
+                autopct='%1.1f%%', startangle=90, textprops={'fontsize': 9})
+        ax2.set_title("商户消费占比")
+    else:
+        ax2.set_title("无数据")
+    fig.tight_layout()
+
+    paths = []
+    for fmt in formats:
+        path = _with_ext(stem, fmt)
+        fig.savefig(path, format=fmt)
+        paths.append(path)
+    return paths
+
+
+def write_bundle(report: Dict[str, Any], deep_insights: Dict[str, Any], params: Dict[str, Any],
+                 stem: Path, formats: Sequence[str] = ("png",)) -> List[Path]:
+    """写出一个报告包：stem.txt 与各格式的图表，返回写出的文件"""
+    stem.parent.mkdir(parents=True, exist_ok=True)
+    text_path = _with_ext(stem, "txt")
+    text_path.write_text(format_report_text(report, deep_insights, params), encoding="utf-8")
+    return [text_path] + render_charts(report, stem, formats)
+
+
+@dataclass
+class BatchResult:
+    """批量导出结果，bundles 中每项为 {name, count, total, files} 或 {name, error}"""
+    out_dir: Path
+    bundles: List[Dict[str, Any]] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def failures(self) -> List[Dict[str, Any]]:
+        return [b for b in self.bundles if "error" in b]
+
+
+def cohort_values(field_name: str, **filters) -> List[str]:
+    """filters 范围内 field_name (专业/年级/学号) 的所有取值"""
+    conn, source, where, params = SqlReportEngine(**filters)._open()
+    try:
+        rows = conn.execute(
+            f"SELECT DISTINCT {field_name} FROM {source} WHERE {where} ORDER BY {field_name}", params
+        ).fetchall()
+    finally:
+        conn.close()
+    return [r[0] for r in rows if r[0]]
+
+
+def _bundle_worker(db_path: str, field_name: str, value: str, filename: str, filters: Dict[str, Any],
+                   params: Dict[str, Any], out_dir: str, formats: Sequence[str]) -> Dict[str, Any]:
+    """在进程池中生成一个群体的报告包，文件名主干为 filename (由 unique_filenames 统一分配)"""
+    database.DB_PATH = Path(db_path)
+    try:
+        # 群体按精确值划分 (与 cohort.py 一致)：过滤参数是子串匹配，"物理" 也会匹配 "应用物理"
+        column_filters = [*filters.get("column_filters", ()), (field_name, "=", value)]
+        engine = SqlReportEngine(**{**filters, "column_filters": column_filters})
+        report = engine.generate_report(params["single_threshold"], params["freq_window"], params["freq_count"])
+        if not report["habits"]["count"]:
+            return {"name": value, "count": 0, "total": 0.0, "files": []}
+        stem = Path(out_dir) / filename
+        files = write_bundle(report, engine.get_deep_insights(), params, stem, formats)
+        return {"name": value, "count": report["habits"]["count"], "total": report["habits"]["total"],
+                "files": [str(p) for p in files]}
+    except Exception as e:
+        logger.exception("生成 %s 的报告失败", value)
+        return {"name": value, "error": str(e)}
+
+
+def batch_reports(
+    field_name: str,
+    out_dir: Path,
+    params: Optional[Dict[str, Any]] = None,
+    formats: Sequence[str] = ("png",),
+    workers: Optional[int] = None,
+    values: Optional[Sequence[str]] = None,
+    **filters
+) -> BatchResult:
+    """
+    为 field_name 的每个取值 (默认为 filters 范围内的全部取值) 生成报告包，写入 out_dir
+    各群体在进程池中并行统计和出图，最后在 out_dir/index.csv 中汇总
+    """
+    if field_name not in BATCH_FIELDS:
+        raise ValueError(f"不支持按 {field_name} 批量导出")
+    unknown = set(formats) - set(FORMATS)
+    if unknown:
+        raise ValueError(f"不支持的图表格式: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    values = list(values) if values is not None else cohort_values(field_name, **filters)
+    result = BatchResult(out_dir)
+    if not values:
+        return result
+
+    worker = partial(_bundle_worker, str(database.DB_PATH), field_name, filters=filters, params=params,
+                     out_dir=str(out_dir), formats=tuple(formats))
+    # 文件名在分发前统一分配，各进程并行写出时不会互相覆盖
+    filenames = unique_filenames(values)
+    workers = min(workers or os.cpu_count() or 1, len(values))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # 学生数很多时按块分发，减少进程间往返
+            result.bundles = list(pool.map(worker, values, filenames,
+                                           chunksize=max(1, len(values) // (workers * 8))))
+    else:
+        result.bundles = [worker(v, f) for v, f in zip(values, filenames)]
+
+    with open(out_dir / "index.csv", "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow([BATCH_FIELDS[field_name], "交易笔数", "总金额", "文件"])
+        for b in result.bundles:
+            if "error" in b:
+                writer.writerow([b["name"], "", "", f"失败: {b['error']}"])
+            else:
+                writer.writerow([b["name"], b["count"], f"{b['total']:.2f}",
+                                 ";".join(Path(p).name for p in b["files"])])
+
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="按专业/年级/学生批量生成报告 (文本 + 图表)")
+    parser.add_argument("--by", choices=list(BATCH_FIELDS), default="major", help="分组字段")
+    parser.add_argument("--out", type=Path, default=Path("reports"), help="输出目录")
+    parser.add_argument("--format", nargs="+", choices=FORMATS, default=["png"], help="图表格式")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="并行进程数")
+    parser.add_argument("--value", action="append", default=None, help="只导出指定的取值 (可重复)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_PARAMS["single_threshold"], help="大额交易阈值")
+    parser.add_argument("--freq-window", type=int, default=DEFAULT_PARAMS["freq_window"], help="高频检测时间窗口 (分钟)")
+    parser.add_argument("--freq-count", type=int, default=DEFAULT_PARAMS["freq_count"], help="高频检测次数阈值")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    database.init_db()
+    r = batch_reports(
+        args.by, args.out / args.by,
+        {"single_threshold": args.threshold, "freq_window": args.freq_window, "freq_count": args.freq_count},
+        args.format, args.workers, args.value,
+    )
+    print(f"生成 {len(r.bundles) - len(r.failures)} 个报告包 -> {r.out_dir}，用时 {r.seconds:.1f}s")
+    for b in r.failures:
+        print(f"  {b['name']}: {b['error']}")
@@ -0,0 +1,495 @@
+"""
+近似统计：可合并的概率草图 (sketch)
+
+- HyperLogLog：不同学生数 (相对标准误差 1.04 / sqrt(2^p))
+- Space-Saving：热门地点/商户 Top-N，每个计数带有确定的误差上界
+- t-digest：消费金额分位数，误差以秩 (rank) 表示，两端更精确
+
+每天的 '消费' 记录维护一份草图 (day_sketches 表)，写入时通过变更监听器增量合并，
+查询时把日期范围内的草图合并起来，代价与天数成正比而与交易笔数无关。
+新增行按 id 水位 (meta.sketch_max_id) 合并；修改/删除由触发器把所在日期记入
+sketch_dirty，随后整天重建 (HLL 和 t-digest 都不支持删除元素)。
+"""
+import hashlib
+import json
+import logging
+import math
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import date, datetime, time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# HLL 精度：2^12 个寄存器，每天 4KB，相对标准误差约 1.6%
+HLL_PRECISION = 12
+# Space-Saving 每份草图保留的计数器个数
+TOPK_CAPACITY = 64
+# t-digest 压缩参数：越大越精确，质心数约为其一半
+TDIGEST_COMPRESSION = 100
+
+
+class HyperLogLog:
+    """HyperLogLog 基数估计，合并即寄存器逐位取最大值"""
+
+    def __init__(self, p: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = registers if registers is not None else np.zeros(self.m, dtype=np.uint8)
+
+    @staticmethod
+    def _hash(item: str) -> int:
+        return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def add_many(self, items: Iterable[str]):
+        hashes = [self._hash(x) for x in items]
+        if not hashes:
+            return
+        rest_bits = 64 - self.p
+        mask = (1 << rest_bits) - 1
+        idx = np.fromiter((h >> rest_bits for h in hashes), dtype=np.int64, count=len(hashes))
+        # rho = 剩余位中第一个 1 出现的位置
+        rho = np.fromiter((rest_bits - (h & mask).bit_length() + 1 for h in hashes),
+                          dtype=np.uint8, count=len(hashes))
+        np.maximum.at(self.registers, idx, rho)
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> float:
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # 小基数时用线性计数修正
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return float(estimate)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(self.m)
+
+    def to_bytes(self) -> bytes:
+        return self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        registers = np.frombuffer(data, dtype=np.uint8).copy()
+        return cls(int(math.log2(len(registers))), registers)
+
+
+class SpaceSaving:
+    """
+    Space-Saving 频繁项草图 (可合并版本)
+    对保留的每一项：count - error <= 真实次数 <= count；
+    未保留的项真实次数不超过 floor
+    """
+
+    def __init__(self, k: int = TOPK_CAPACITY):
+        self.k = k
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.floor = 0
+        self.total = 0
+
+    def add_counts(self, counts: Dict[str, int]):
+        """并入一批精确计数"""
+        exact = SpaceSaving(self.k)
+        exact.counts = dict(counts)
+        exact.errors = {x: 0 for x in counts}
+        exact.total = sum(counts.values())
+        self.merge(exact)
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        items = set(self.counts) | set(other.counts)
+        counts, errors = {}, {}
+        for x in items:
+            counts[x] = self.counts.get(x, self.floor) + other.counts.get(x, other.floor)
+            errors[x] = self.errors.get(x, self.floor) + other.errors.get(x, other.floor)
+        floor = self.floor + other.floor
+        if len(counts) > self.k:
+            ranked = sorted(counts, key=lambda x: (-counts[x], x))
+            for x in ranked[self.k:]:
+                floor = max(floor, counts.pop(x))
+                errors.pop(x)
+        self.counts, self.errors, self.floor = counts, errors, floor
+        self.total += other.total
+        return self
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        """前 n 项 [(项, 估计次数, 误差上界)]，次数相同时按名称排序"""
+        ranked = sorted(self.counts, key=lambda x: (-self.counts[x], x))[:n]
+        return [(x, self.counts[x], self.errors[x]) for x in ranked]
+
+    def to_json(self) -> str:
+        return json.dumps({"k": self.k, "floor": self.floor, "total": self.total,
+                           "items": {x: [self.counts[x], self.errors[x]] for x in self.counts}},
+                          ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text: str) -> "SpaceSaving":
+        data = json.loads(text)
+        ss = cls(data["k"])
+        ss.floor, ss.total = data["floor"], data["total"]
+        ss.counts = {x: c for x, (c, _) in data["items"].items()}
+        ss.errors = {x: e for x, (_, e) in data["items"].items()}
+        return ss
+
+
+class TDigest:
+    """合并式 t-digest (k1 尺度函数)，质心 = (均值, 权重)"""
+
+    def __init__(self, compression: float = TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def total(self) -> float:
+        return float(self.weights.sum())
+
+    def add_counts(self, values: Sequence[float], counts: Sequence[float]):
+        """并入 (值, 次数)，金额只有两位小数，按值分组后再压缩代价很小"""
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self._compress(np.concatenate([self.means, values]),
+                       np.concatenate([self.weights, np.asarray(counts, dtype=np.float64)]))
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        return self.merge_all([other])
+
+    def merge_all(self, others: Sequence["TDigest"]) -> "TDigest":
+        """一次性合并多份 (所有质心只压缩一遍)"""
+        others = [o for o in others if len(o.means)]
+        if others:
+            self.min = min([self.min] + [o.min for o in others])
+            self.max = max([self.max] + [o.max for o in others])
+            self._compress(np.concatenate([self.means] + [o.means for o in others]),
+                           np.concatenate([self.weights] + [o.weights for o in others]))
+        return self
+
+    def _q_limit(self, q: float) -> float:
+        # k1(q) = δ/2π · asin(2q-1)，每个质心跨度不超过一个 k 单位
+        k = self.compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order].tolist(), weights[order].tolist()
+        total = sum(weights)
+        out_m, out_w = [], []
+        cur_m, cur_w = means[0], weights[0]
+        so_far = 0.0
+        limit = self._q_limit(0.0) * total
+        for m, w in zip(means[1:], weights[1:]):
+            if so_far + cur_w + w <= limit:
+                cur_w += w
+                cur_m += (m - cur_m) * w / cur_w
+            else:
+                out_m.append(cur_m)
+                out_w.append(cur_w)
+                so_far += cur_w
+                limit = self._q_limit(so_far / total) * total
+                cur_m, cur_w = m, w
+        out_m.append(cur_m)
+        out_w.append(cur_w)
+        self.means, self.weights = np.array(out_m), np.array(out_w)
+
+    def _centers(self) -> np.ndarray:
+        return np.cumsum(self.weights) - self.weights / 2
+
+    def quantile(self, q: float) -> float:
+        if not len(self.means):
+            return math.nan
+        if len(self.means) == 1:
+            return float(self.means[0])
+        target = q * self.total
+        centers = self._centers()
+        if target <= centers[0]:
+            return float(self.min + (self.means[0] - self.min) * target / centers[0])
+        if target >= centers[-1]:
+            tail = self.total - centers[-1]
+            return float(self.max - (self.max - self.means[-1]) * (self.total - target) / tail)
+        i = int(np.searchsorted(centers, target))
+        t = (target - centers[i - 1]) / (centers[i] - centers[i - 1])
+        return float(self.means[i - 1] + t * (self.means[i] - self.means[i - 1]))
+
+    def rank_error(self, q: float) -> float:
+        """q 处的秩误差估计：覆盖该秩的质心权重的一半 / 总数"""
+        if not len(self.means):
+            return 0.0
+        i = min(int(np.searchsorted(np.cumsum(self.weights), q * self.total)), len(self.weights) - 1)
+        return float(self.weights[i] / 2 / self.total)
+
+    def to_bytes(self) -> bytes:
+        return np.concatenate([[self.compression, self.min, self.max], self.means, self.weights]).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TDigest":
+        arr = np.frombuffer(data, dtype=np.float64)
+        td = cls(float(arr[0]))
+        td.min, td.max = float(arr[1]), float(arr[2])
+        n = (len(arr) - 3) // 2
+        td.means, td.weights = arr[3:3 + n].copy(), arr[3 + n:].copy()
+        return td
+
+
+@dataclass
+class DaySketch:
+    """一天 (或合并后的多天) '消费' 记录的草图；计数/金额/小时分布是精确值"""
+    tx_count: int = 0
+    total_amount: float = 0.0
+    max_amount: float = 0.0
+    weekend_count: int = 0
+    weekend_total: float = 0.0
+    hours: np.ndarray = field(default_factory=lambda: np.zeros(24, dtype=np.int64))
+    students: HyperLogLog = field(default_factory=HyperLogLog)
+    locations: SpaceSaving = field(default_factory=SpaceSaving)
+    merchants: SpaceSaving = field(default_factory=SpaceSaving)
+    amounts: TDigest = field(default_factory=TDigest)
+
+    def merge(self, other: "DaySketch") -> "DaySketch":
+        return self.merge_all([other])
+
+    def merge_all(self, others: Sequence["DaySketch"]) -> "DaySketch":
+        others = [o for o in others if o.tx_count]
+        if not others:
+            return self
+        self.max_amount = max(([self.max_amount] if self.tx_count else []) + [o.max_amount for o in others])
+        for o in others:
+            self.tx_count += o.tx_count
+            self.total_amount += o.total_amount
+            self.weekend_count += o.weekend_count
+            self.weekend_total += o.weekend_total
+            self.hours += o.hours
+            self.locations.merge(o.locations)
+            self.merchants.merge(o.merchants)
+        self.students.registers = np.max(
+            np.stack([self.students.registers] + [o.students.registers for o in others]), axis=0)
+        self.amounts.merge_all([o.amounts for o in others])
+        return self
+
+
+def _is_weekend(day: str) -> bool:
+    return date.fromisoformat(day).weekday() >= 5
+
+
+def _build(conn: sqlite3.Connection, source: str, where: str, params: list) -> Dict[str, DaySketch]:
+    """在数据库内分组后为每一天构建草图 (只统计 '消费')"""
+    where = f"({where}) AND tx_type = '消费'"
+    day = "substr(timestamp, 1, 10)"
+    days: Dict[str, DaySketch] = {}
+
+    for d, cnt, total, mx in conn.execute(f"""
+        SELECT {day}, COUNT(*), SUM(amount), MAX(amount) FROM {source} WHERE {where} GROUP BY 1
+    """, params):
+        days[d] = DaySketch(tx_count=cnt, total_amount=total, max_amount=mx)
+
+    for d, hour, cnt in conn.execute(f"""
+        SELECT {day}, CAST(substr(timestamp, 12, 2) AS INTEGER), COUNT(*) FROM {source}
+        WHERE {where} GROUP BY 1, 2
+    """, params):
+        days[d].hours[hour] += cnt
+
+    students: Dict[str, List[str]] = {}
+    for d, sid in conn.execute(f"SELECT DISTINCT {day}, student_id FROM {source} WHERE {where}", params):
+        students.setdefault(d, []).append(sid)
+    for d, sids in students.items():
+        days[d].students.add_many(sids)
+
+    for col, attr in (("location", "locations"), ("merchant_type", "merchants")):
+        groups: Dict[str, Dict[str, int]] = {}
+        for d, item, cnt in conn.execute(f"""
+            SELECT {day}, {col}, COUNT(*) FROM {source} WHERE {where} GROUP BY 1, 2
+        """, params):
+            groups.setdefault(d, {})[item] = cnt
+        for d, counts in groups.items():
+            getattr(days[d], attr).add_counts(counts)
+
+    amounts: Dict[str, Tuple[list, list]] = {}
+    for d, amount, cnt in conn.execute(f"""
+        SELECT {day}, amount, COUNT(*) FROM {source} WHERE {where} GROUP BY 1, 2
+    """, params):
+        values, counts = amounts.setdefault(d, ([], []))
+        values.append(amount)
+        counts.append(cnt)
+    for d, (values, counts) in amounts.items():
+        days[d].amounts.add_counts(values, counts)
+    return days
+
+
+def _load(conn: sqlite3.Connection, where: str = "1", params: Sequence = ()) -> Dict[str, DaySketch]:
+    days = {}
+    for row in conn.execute(f"""
+        SELECT day, tx_count, total_amount, max_amount, hours, students, locations, merchants, amounts
+        FROM day_sketches WHERE {where} ORDER BY day
+    """, params):
+        d = row[0]
+        weekend = _is_weekend(d)
+        days[d] = DaySketch(
+            tx_count=row[1], total_amount=row[2], max_amount=row[3],
+            weekend_count=row[1] if weekend else 0, weekend_total=row[2] if weekend else 0.0,
+            hours=np.frombuffer(row[4], dtype=np.int64).copy(),
+            students=HyperLogLog.from_bytes(row[5]),
+            locations=SpaceSaving.from_json(row[6]),
+            merchants=SpaceSaving.from_json(row[7]),
+            amounts=TDigest.from_bytes(row[8]),
+        )
+    return days
+
+
+def _save(cursor: sqlite3.Cursor, days: Dict[str, DaySketch]):
+    cursor.executemany("""
+        INSERT OR REPLACE INTO day_sketches
+            (day, tx_count, total_amount, max_amount, hours, students, locations, merchants, amounts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(d, s.tx_count, s.total_amount, s.max_amount, s.hours.tobytes(), s.students.to_bytes(),
+           s.locations.to_json(), s.merchants.to_json(), s.amounts.to_bytes())
+          for d, s in days.items()])
+
+
+def _watermark(cursor: sqlite3.Cursor) -> Optional[int]:
+    row = cursor.execute("SELECT value FROM meta WHERE key = 'sketch_max_id'").fetchone()
+    return row[0] if row else None
+
+
+def _set_watermark(cursor: sqlite3.Cursor, max_id: int):
+    cursor.execute("""
+        INSERT INTO meta (key, value) VALUES ('sketch_max_id', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    """, (max_id,))
+
+
+def _archived_month(cursor: sqlite3.Cursor) -> str:
+    return cursor.execute("SELECT MAX(month) FROM archive_partitions").fetchone()[0] or ""
+
+
+def _catch_up(cursor: sqlite3.Cursor):
+    """
+    在写入事务内把水位之后的新增行并入草图，并重建热表月份的脏日期
+    写入事务内无法挂载归档，首次全量构建和已归档月份的脏日期留给 refresh()
+    """
+    conn = cursor.connection
+    watermark = _watermark(cursor)
+    if watermark is None:
+        return
+    max_id = database._max_id(cursor)
+
+    archived = _archived_month(cursor)
+    dirty = [r[0] for r in cursor.execute("SELECT day FROM sketch_dirty WHERE day > ? ORDER BY day",
+                                          (archived + "-99",))]
+
+    if dirty:
+        # 脏日期整天重建 (已包含水位之后的新增行)
+        marks = ", ".join("?" * len(dirty))
+        rebuilt = _build(conn, "consumption", f"substr(timestamp, 1, 10) IN ({marks})", dirty)
+        cursor.execute(f"DELETE FROM day_sketches WHERE day IN ({marks})", dirty)
+        cursor.execute(f"DELETE FROM sketch_dirty WHERE day IN ({marks})", dirty)
+        _save(cursor, rebuilt)
+
+    if max_id > watermark:
+        added = _build(conn, "consumption", "id > ? AND id <= ?", [watermark, max_id])
+        for d in dirty:
+            added.pop(d, None)
+        if added:
+            marks = ", ".join("?" * len(added))
+            existing = _load(conn, f"day IN ({marks})", list(added))
+            for d, sketch in added.items():
+                if d in existing:
+                    added[d] = existing[d].merge(sketch)
+            _save(cursor, added)
+        _set_watermark(cursor, max_id)
+
+
+def _update_day_sketches(cursor: sqlite3.Cursor, inserted, removed):
+    """变更监听器：在写入事务内增量维护每日草图"""
+    _catch_up(cursor)
+
+
+def _read_archived(conn: sqlite3.Connection):
+    """refresh 的读取阶段：首次全量构建，或重建已归档月份的脏日期 (需要挂载归档)"""
+    cursor = conn.cursor()
+    if _watermark(cursor) is None:
+        source, _ = database._source_sql(conn, None, None)
+        return _build(conn, source, "1", []), None, database._max_id(cursor)
+    dirty = [r[0] for r in cursor.execute("SELECT day FROM sketch_dirty WHERE day <= ? ORDER BY day",
+                                          (_archived_month(cursor) + "-99",))]
+    if not dirty:
+        return {}, [], None
+    start = datetime.combine(date.fromisoformat(dirty[0]), time.min)
+    end = datetime.combine(date.fromisoformat(dirty[-1]), time.max)
+    source, _ = database._source_sql(conn, start, end)
+    marks = ", ".join("?" * len(dirty))
+    return _build(conn, source, f"substr(timestamp, 1, 10) IN ({marks})", dirty), dirty, None
+
+
+def _apply_archived(cursor: sqlite3.Cursor, result):
+    """refresh 的写回阶段 (写线程)：写入读取阶段的结果，再合并热表中的新增行"""
+    days, dirty, max_id = result
+    if dirty is None:
+        cursor.execute("DELETE FROM day_sketches")
+        cursor.execute("DELETE FROM sketch_dirty")
+        _set_watermark(cursor, max_id)
+    elif dirty:
+        marks = ", ".join("?" * len(dirty))
+        cursor.execute(f"DELETE FROM day_sketches WHERE day IN ({marks})", dirty)
+        cursor.execute(f"DELETE FROM sketch_dirty WHERE day IN ({marks})", dirty)
+    _save(cursor, days)
+    _catch_up(cursor)
+
+
+def refresh() -> bool:
+    """
+    补齐未经监听器写入的数据 (首次构建、归档后的脏日期等)，写入经写线程完成
+    返回草图是否已是最新；数据持续变化导致未能写回时记录警告，返回 False
+    """
+    if is_current():
+        return True
+    try:
+        database.rebuild_derived(_read_archived, _apply_archived)
+    except database.StaleRebuild as e:
+        logger.warning("草图补齐未完成: %s", e)
+        return False
+    return True
+
+
+def is_current() -> bool:
+    """草图是否已覆盖全部数据 (已首次构建、水位不落后、没有待重建的脏日期)，只读检查"""
+    conn = database.get_connection()
+    try:
+        cursor = conn.cursor()
+        watermark = _watermark(cursor)
+        if watermark is None or watermark < database._max_id(cursor):
+            return False
+        return cursor.execute("SELECT 1 FROM sketch_dirty LIMIT 1").fetchone() is None
+    finally:
+        conn.close()
+
+
+def merged_sketch(start_day: str = "", end_day: str = "9999-12-31",
+                  catch_up: bool = True) -> Tuple[DaySketch, int]:
+    """
+    合并 [start_day, end_day] 内每天的草图，返回 (合并结果, 天数)
+    catch_up=False 时不做补齐写入 (只读调用方先用 is_current 判断草图是否可用)
+    """
+    if catch_up:
+        refresh()
+    conn = database.get_connection()
+    try:
+        days = _load(conn, "day BETWEEN ? AND ?", (start_day, end_day))
+    finally:
+        conn.close()
+    return DaySketch().merge_all(list(days.values())), len(days)
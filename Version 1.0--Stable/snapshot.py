@@ -0,0 +1,355 @@
+"""
+分析快照：把全部交易 (热表 + 归档分区) 按列存成 .npy 文件，打开应用后的分析直接内存映射读取。
+
+快照放在数据库旁的 <库名>.snapshot/v<写版本号>/ 目录下：
+- 数值列和 timestamp 各一个 .npy (float64 / int64 / datetime64[s])，np.load(mmap_mode="r") 零拷贝映射
+- 文本列做字典编码：<列>.codes.npy 存整数编码，<列>.categories.json 存去重后的取值
+- meta.json 最后写入，记录写版本号和行数；没有 meta.json 的目录视为未完成
+快照在一个读事务内构建，写版本号与数据来自同一时刻。读取时若当前写版本号没有对应的快照
+则回退到 database.fetch_columns，结果 (列、类型、过滤语义) 与之相同，只是行的顺序不保证一致。
+
+auto_refresh(True) 后 (界面启动时开启)，每次数据变更和每次读到过期快照都会在后台
+去抖重建，旧版本目录在新快照完成后删除。
+"""
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import database
+from utils import DATE_FMT
+
+logger = logging.getLogger(__name__)
+
+# 快照包含的列 (fingerprint 只用于去重，不参与分析)
+SNAPSHOT_COLUMNS = tuple(c for c in database.RECORD_COLUMNS if c != "fingerprint")
+# 构建时每次从数据库取出的行数
+CHUNK_ROWS = 200_000
+# 数据变更后等待这么多秒没有新写入再重建，避免连续导入时反复构建
+REFRESH_DELAY = 5.0
+# 可过滤的文本列 (与 database.fetch_columns 的过滤参数对应)
+FILTER_COLUMNS = ("student_id", "name", "major", "grade", "location")
+
+# 已映射的快照：(快照目录, 写版本号) -> {列名: 数组}，文本列为 (编码, 取值) 二元组
+_cache: Dict[Tuple[str, int], Dict[str, object]] = {}
+_lock = threading.Lock()
+_auto = False
+_timer: Optional[threading.Timer] = None
+_building = threading.Lock()
+
+
+def snapshot_dir() -> Path:
+    """当前数据库的快照根目录"""
+    return database.DB_PATH.parent / f"{database.DB_PATH.stem}.snapshot"
+
+
+def _version_dir(version: int) -> Path:
+    return snapshot_dir() / f"v{version}"
+
+
+def _read_version(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'write_version'").fetchone()
+    return row[0] if row else 0
+
+
+def is_current(conn: Optional[sqlite3.Connection] = None) -> bool:
+    """当前写版本号的快照是否已经建好"""
+    own = conn is None
+    conn = conn or database.get_connection()
+    try:
+        version = _read_version(conn)
+    finally:
+        if own:
+            conn.close()
+    return (_version_dir(version) / "meta.json").exists()
+
+
+# ---------- 构建 ----------
+
+def _encoder():
+    """文本列的增量字典编码：每块先 pd.factorize，再把块内取值映射到全局编码"""
+    lookup: Dict[Optional[str], int] = {}
+
+    def encode(values: Sequence[Optional[str]]) -> np.ndarray:
+        local, uniques = pd.factorize(np.array(values, dtype=object), use_na_sentinel=False)
+        mapping = np.array([lookup.setdefault(u, len(lookup)) for u in uniques], dtype=np.int32)
+        return mapping[local]
+
+    return encode, lookup
+
+
+def build(conn: Optional[sqlite3.Connection] = None) -> Path:
+    """
+    在一个读事务内把全部交易写成列式快照，返回快照目录 (当前版本已有快照时直接返回)
+    先写到临时目录，完成后改名，读取方不会看到写了一半的快照
+    """
+    own = conn is None
+    conn = conn or database.get_disk_connection()
+    tmp = None
+    try:
+        conn.execute("BEGIN")
+        version = _read_version(conn)
+        target = _version_dir(version)
+        if (target / "meta.json").exists():
+            return target
+
+        tmp = snapshot_dir() / f".build-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+
+        source, _ = database._source_sql(conn)
+        rows = conn.execute(f"SELECT COUNT(*) FROM {source}").fetchone()[0]
+        text_cols = [c for c in SNAPSHOT_COLUMNS if c not in database.COLUMN_DTYPES]
+        arrays = {
+            col: np.lib.format.open_memmap(
+                tmp / (f"{col}.codes.npy" if col in text_cols else f"{col}.npy"),
+                mode="w+", dtype=np.int32 if col in text_cols else database.COLUMN_DTYPES[col],
+                shape=(rows,))
+            for col in SNAPSHOT_COLUMNS
+        }
+        encoders = {col: _encoder() for col in text_cols}
+
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM {source}")
+        pos = 0
+        while True:
+            chunk = cursor.fetchmany(CHUNK_ROWS)
+            if not chunk:
+                break
+            end = pos + len(chunk)
+            for col, vals in zip(SNAPSHOT_COLUMNS, zip(*chunk)):
+                if col in encoders:
+                    arrays[col][pos:end] = encoders[col][0](vals)
+                else:
+                    arrays[col][pos:end] = np.array(vals, dtype=database.COLUMN_DTYPES[col])
+            pos = end
+        conn.rollback()
+
+        for col in SNAPSHOT_COLUMNS:
+            arrays[col].flush()
+        arrays.clear()
+        for col, (_, lookup) in encoders.items():
+            # 取值不多时 (绝大多数列) 改存 int16，文件小一半
+            if len(lookup) <= np.iinfo(np.int16).max:
+                path = tmp / f"{col}.codes.npy"
+                codes = np.load(path).astype(np.int16)
+                np.save(path, codes)
+            (tmp / f"{col}.categories.json").write_text(
+                json.dumps(list(lookup), ensure_ascii=False), encoding="utf-8")
+        (tmp / "meta.json").write_text(json.dumps({
+            "write_version": version,
+            "rows": pos,
+            "columns": list(SNAPSHOT_COLUMNS),
+            "built_at": datetime.now().strftime(DATE_FMT),
+        }, ensure_ascii=False, indent=2), encoding="utf-8")
+
+        if target.exists():
+            shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+        tmp = None
+        logger.info("分析快照已更新：写版本 %d，%d 行", version, pos)
+        _prune(version)
+        return target
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+        if own:
+            conn.close()
+
+
+def _prune(keep: int):
+    """删除其他版本的快照 (仍被映射而删不掉的文件下次再删)"""
+    root = snapshot_dir()
+    with _lock:
+        for key in [k for k in _cache if k[0] == str(root) and k[1] != keep]:
+            del _cache[key]
+    for path in root.glob("v*"):
+        if path.name != f"v{keep}":
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# ---------- 后台刷新 ----------
+
+def _refresh():
+    global _timer
+    _timer = None
+    if not _building.acquire(blocking=False):
+        # 正在构建：构建完成后快照仍可能过期，稍后再检查一次
+        schedule()
+        return
+    try:
+        build()
+    except (sqlite3.Error, OSError, ValueError) as e:
+        logger.warning("分析快照构建失败: %s", e)
+    finally:
+        _building.release()
+
+
+def schedule(delay: float = REFRESH_DELAY):
+    """delay 秒后在后台线程重建快照 (重复调用会推迟到最后一次之后)"""
+    global _timer
+    with _lock:
+        if _timer is not None:
+            _timer.cancel()
+        _timer = threading.Timer(delay, _refresh)
+        _timer.daemon = True
+        _timer.name = "snapshot-build"
+        _timer.start()
+
+
+def auto_refresh(enabled: bool = True):
+    """开启后数据变更和读到过期快照时自动在后台重建"""
+    global _auto
+    _auto = enabled
+    if not enabled and _timer is not None:
+        _timer.cancel()
+
+
+def _on_change(cursor: sqlite3.Cursor, inserted, removed):
+    if _auto:
+        schedule()
+
+
+# ---------- 读取 ----------
+
+def _open(version: int) -> Optional[Dict[str, object]]:
+    """映射指定版本的快照，不存在或不完整时返回 None"""
+    path = _version_dir(version)
+    key = (str(snapshot_dir()), version)
+    with _lock:
+        cached = _cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        arrays: Dict[str, object] = {}
+        for col in meta["columns"]:
+            numeric = path / f"{col}.npy"
+            if numeric.exists():
+                arrays[col] = np.load(numeric, mmap_mode="r")
+            else:
+                categories = json.loads((path / f"{col}.categories.json").read_text(encoding="utf-8"))
+                cats = np.empty(len(categories), dtype=object)
+                cats[:] = categories
+                arrays[col] = (np.load(path / f"{col}.codes.npy", mmap_mode="r"), cats)
+    except (OSError, ValueError, KeyError):
+        return None
+    with _lock:
+        _cache[key] = arrays
+    return arrays
+
+
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def _like_matcher(value: str):
+    """与 database._filter_clause 相同的子串判断：按字面匹配，只对 ASCII 字母不区分大小写"""
+    pattern = value.translate(_ASCII_LOWER)
+    return lambda s: s is not None and pattern in s.translate(_ASCII_LOWER)
+
+
+def _select(arrays: Dict[str, object], start_date: Optional[datetime], end_date: Optional[datetime],
+            text_filters: Dict[str, str]) -> Optional[np.ndarray]:
+    """满足过滤条件的行号，没有任何过滤时返回 None (全部行)"""
+    mask = None
+
+    def narrow(m: np.ndarray):
+        nonlocal mask
+        mask = m if mask is None else mask & m
+
+    for col, value in text_filters.items():
+        codes, cats = arrays[col]
+        match = _like_matcher(value)
+        # 先在去重后的取值上匹配，再按编码查表展开到每一行
+        table = np.fromiter((match(c) for c in cats), dtype=bool, count=len(cats))
+        narrow(table[codes])
+    ts = arrays["timestamp"]
+    if start_date:
+        narrow(ts >= np.datetime64(start_date.strftime(DATE_FMT).replace(" ", "T"), "s"))
+    if end_date:
+        narrow(ts <= np.datetime64(end_date.strftime(DATE_FMT).replace(" ", "T"), "s"))
+    return None if mask is None else np.flatnonzero(mask)
+
+
+def load(
+    columns: Sequence[str],
+    student_id: str = "",
+    name: str = "",
+    major: str = "",
+    grade: str = "",
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    location: str = "",
+    conn: Optional[sqlite3.Connection] = None
+) -> Optional[Dict[str, np.ndarray]]:
+    """
+    从快照读取列，参数与 database.fetch_columns 相同
+    没有过滤时数值列直接返回只读的内存映射；快照不存在或已过期时返回 None
+    """
+    columns = list(dict.fromkeys(columns))
+    if any(c not in SNAPSHOT_COLUMNS for c in columns):
+        return None
+    own = conn is None
+    conn = conn or database.get_connection()
+    try:
+        version = _read_version(conn)
+    finally:
+        if own:
+            conn.close()
+    arrays = _open(version)
+    if arrays is None:
+        if _auto:
+            schedule(0)
+        return None
+
+    text_filters = {col: value for col, value in zip(FILTER_COLUMNS, (student_id, name, major, grade, location))
+                    if value}
+    rows = _select(arrays, start_date, end_date, text_filters)
+    result = {}
+    for col in columns:
+        data = arrays[col]
+        if isinstance(data, tuple):
+            codes, cats = data
+            result[col] = cats[codes if rows is None else codes[rows]]
+        else:
+            result[col] = data if rows is None else data[rows]
+    return result
+
+
+def fetch_columns(columns: Sequence[str], conn: Optional[sqlite3.Connection] = None,
+                  **filters) -> Dict[str, np.ndarray]:
+    """优先从快照读取，没有当前快照或带列过滤 (column_filters) 时回退到 database.fetch_columns"""
+    column_filters = filters.pop("column_filters", ())
+    result = None if column_filters else load(columns, conn=conn, **filters)
+    if result is None:
+        result = database.fetch_columns(columns, column_filters=column_filters, conn=conn, **filters)
+    return result
+
+
+def clear_cache():
+    """释放已映射的快照"""
+    with _lock:
+        _cache.clear()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="构建分析快照")
+    parser.add_argument("--db", type=Path, default=None, help="数据库路径 (默认 data/campus.db)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.db is not None:
+        database.DB_PATH = args.db
+    print(build())
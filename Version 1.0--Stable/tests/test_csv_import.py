@@ -0,0 +1,110 @@
+"""
+CSV 导入的幂等与续传：同一文件重复导入不增加行数；多块导入中途失败后续传，
+最终余额应与按累计收支整体重算 (recalculate_balances) 的结果完全相同。
+
+在 Version 1.0--Stable 目录下运行: python -m pytest tests 或 python -m unittest discover tests
+"""
+import csv
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import database  # noqa: E402
+from utils import DATE_FMT  # noqa: E402
+
+FIELDS = ["student_id", "name", "major", "grade", "balance", "timestamp", "amount",
+          "merchant_type", "location", "tx_type"]
+CHUNK_ROWS = 10
+
+
+def write_csv(path: Path, rows: int = 60):
+    """几名学生的交易，时间打乱顺序：后面的块里有更早的交易，余额必须从块内最早的交易处重算"""
+    rng = random.Random(27)
+    start = datetime(2024, 3, 1, 8, 0, 0)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for i in rng.sample(range(rows), rows):
+            sid = f"S{i % 4:04d}"
+            tx_type = "充值" if i % 7 == 0 else "消费"
+            ts = (start + timedelta(hours=i * 5)).strftime(DATE_FMT)
+            writer.writerow([sid, "张三", "计算机", "2021", 0.0, ts, f"{rng.uniform(1, 40):.2f}",
+                             "餐饮美食", "一食堂", tx_type])
+
+
+class CsvImportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.old_path = database.DB_PATH
+        database.DB_PATH = self.tmp / "campus.db"
+        database.init_db()
+        self.csv = self.tmp / "import.csv"
+        write_csv(self.csv)
+
+    def tearDown(self):
+        database.close_writer()
+        database.DB_PATH = self.old_path
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def row_count(self):
+        conn = database.get_connection()
+        count = conn.execute("SELECT COUNT(*) FROM consumption").fetchone()[0]
+        conn.close()
+        return count
+
+    def balances(self):
+        conn = database.get_connection()
+        rows = dict(conn.execute("SELECT id, balance FROM consumption").fetchall())
+        conn.close()
+        return rows
+
+    def test_reimport_is_idempotent(self):
+        count, errors = database.import_from_csv(self.csv, chunk_rows=CHUNK_ROWS)
+        self.assertEqual((count, errors), (60, []))
+        self.assertEqual(self.row_count(), 60)
+
+        self.assertEqual(database.import_from_csv(self.csv, chunk_rows=CHUNK_ROWS), (0, []))
+        # 内容相同但字节不同的文件不命中台账，逐行按交易指纹去重
+        shutil.copy(self.csv, self.tmp / "copy.csv")
+        with open(self.tmp / "copy.csv", "a", encoding="utf-8") as f:
+            f.write("\n")
+        self.assertEqual(database.import_from_csv(self.tmp / "copy.csv", chunk_rows=CHUNK_ROWS), (0, []))
+        self.assertEqual(self.row_count(), 60)
+
+    def test_resume_after_abort_rebalances(self):
+        real_chunks = database.iter_csv_chunks
+
+        def interrupted(*args, **kwargs):
+            # 读到第 4 块时进程被中断 (KeyboardInterrupt 不会被导入流程捕获，模拟进程退出)
+            for i, chunk in enumerate(real_chunks(*args, **kwargs)):
+                if i == 3:
+                    raise KeyboardInterrupt
+                yield chunk
+
+        with mock.patch.object(database, "iter_csv_chunks", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                database.import_from_csv(self.csv, chunk_rows=CHUNK_ROWS)
+        database.write(lambda cursor: None).result()  # 等已提交给写线程的块写完
+        entry = database.get_ledger_entry(database.file_sha1(self.csv))
+        self.assertEqual(entry["status"], "running")
+        self.assertEqual(self.row_count(), 3 * CHUNK_ROWS)
+
+        count, errors = database.import_from_csv(self.csv, chunk_rows=CHUNK_ROWS)
+        self.assertEqual((count, errors), (60 - 3 * CHUNK_ROWS, []))
+        self.assertEqual(self.row_count(), 60)
+        imported = self.balances()
+
+        database.recalculate_balances([f"S{i:04d}" for i in range(4)])
+        self.assertEqual(imported, self.balances())
+
+
+if __name__ == "__main__":
+    unittest.main()
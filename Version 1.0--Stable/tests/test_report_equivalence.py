@@ -0,0 +1,92 @@
+"""
+SqlReportEngine 与 DataAnalyzer 的报告等价性：同一过滤条件下 generate_report / get_deep_insights
+的结果 (键、取值和类型) 应完全相同，金额合计两边都规整到分 (utils.money)。
+
+在 Version 1.0--Stable 目录下运行: python -m pytest tests 或 python -m unittest discover tests
+"""
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import database  # noqa: E402
+import snapshot  # noqa: E402
+from analyzer import DataAnalyzer  # noqa: E402
+from report_engine import SqlReportEngine  # noqa: E402
+
+MAJORS = ("计算机", "数学", "应用数学")
+LOCATIONS = (("一食堂", "餐饮美食"), ("二食堂", "餐饮美食"), ("超市", "购物超市"), ("体育馆", "休闲娱乐"))
+CASES = [
+    {},
+    {"start_date": datetime(2024, 3, 1), "end_date": datetime(2024, 4, 30, 23, 59, 59)},
+    {"start_date": datetime(2024, 3, 3, 12, 0, 0)},
+    {"major": "数学"},
+    {"student_id": "S0003"},
+    {"location": "食堂", "column_filters": [("amount", ">", "15")]},
+    {"location": "不存在"},
+]
+
+
+def _types(value):
+    """结果的类型结构 (dict/list 递归展开)"""
+    if isinstance(value, dict):
+        return {k: _types(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_types(v) for v in value]
+    return type(value)
+
+
+class ReportEquivalenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.old_path = database.DB_PATH
+        database.DB_PATH = self.tmp / "campus.db"
+        database.init_db()
+        rng = random.Random(7)
+        start = datetime(2024, 1, 1)
+        rows = []
+        for i in range(3000):
+            sid = f"S{rng.randrange(40):04d}"
+            ts = (start + timedelta(seconds=rng.randrange(150 * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+            if rng.random() < 0.05:
+                location, merchant, tx_type, amount = "学生活动中心", "充值", "充值", float(rng.choice((50, 100)))
+            else:
+                location, merchant = rng.choice(LOCATIONS)
+                tx_type, amount = "消费", round(rng.uniform(1, 300), 2)
+            rows.append((sid, "张三", MAJORS[int(sid[1:]) % len(MAJORS)], "2022", 0.0, ts, amount, merchant,
+                         location, tx_type, database.tx_fingerprint(sid, ts, amount, location)))
+        conn = database.get_disk_connection()
+        conn.executemany(f"""
+            INSERT OR IGNORE INTO consumption ({', '.join(database.INSERT_COLUMNS)})
+            VALUES ({', '.join('?' * len(database.INSERT_COLUMNS))})
+        """, rows)
+        database._rebuild_daily_summary(conn.cursor())
+        conn.commit()
+        conn.close()
+        snapshot.clear_cache()
+
+    def tearDown(self):
+        snapshot.clear_cache()
+        database.DB_PATH = self.old_path
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_reports_are_identical(self):
+        analyses = ("generate_report", "get_deep_insights")
+        for filters in CASES:
+            with self.subTest(filters=filters):
+                analyzer = DataAnalyzer.from_database(analyses, **filters)
+                engine = SqlReportEngine(**filters)
+                expected = (analyzer.generate_report(200.0, 10, 3), analyzer.get_deep_insights())
+                actual = (engine.generate_report(200.0, 10, 3), engine.get_deep_insights())
+                self.assertEqual(actual, expected)
+                self.assertEqual(_types(actual), _types(expected))
+
+
+if __name__ == "__main__":
+    unittest.main()
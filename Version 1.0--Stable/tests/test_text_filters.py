@@ -0,0 +1,90 @@
+"""
+文本子串过滤的一致性：同一个关键字分别走 FTS5 trigram 索引、LIKE 和分析快照三条路径，
+结果都应与统一语义 (按字面匹配，只对 ASCII 字母不区分大小写) 的参考实现相同。
+
+在 Version 1.0--Stable 目录下运行: python -m pytest tests 或 python -m unittest discover tests
+"""
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import database  # noqa: E402
+import snapshot  # noqa: E402
+
+LOCATIONS = [
+    "Cafe_A", "Cafe%B", "CAFEXB", "cafe", "café", "CAFÉ", "Ü-Bahn", "ü-bahn",
+    "a\\b", "ab", "一食堂", "二食堂", "图书馆",
+]
+QUERIES = [
+    "cafe", "CAFE", "e_a", "e%b", "e_", "%", "_", "café", "CAFÉ", "fé", "ü-b", "Ü-B",
+    "a\\b", "\\", "食堂", "一食", "xb", "XB", "图书馆",
+]
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def expected_ids(value):
+    key = value.translate(_ASCII_LOWER)
+    return {i + 1 for i, loc in enumerate(LOCATIONS) if key in loc.translate(_ASCII_LOWER)}
+
+
+class TextFilterConsistencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.old_path = database.DB_PATH
+        database.DB_PATH = self.tmp / "campus.db"
+        database.init_db()
+        conn = database.get_disk_connection()
+        rows = []
+        for i, location in enumerate(LOCATIONS):
+            ts = f"2024-03-01 12:{i:02d}:00"
+            rows.append(("S001", "张三", "计算机", "2021", 0.0, ts, 10.0, "餐饮", location, "消费",
+                         database.tx_fingerprint("S001", ts, 10.0, location)))
+        conn.executemany(f"""
+            INSERT INTO consumption ({', '.join(database.INSERT_COLUMNS)})
+            VALUES ({', '.join('?' * len(database.INSERT_COLUMNS))})
+        """, rows)
+        conn.commit()
+        self.has_fts = database._has_fts(conn)
+        conn.close()
+        snapshot.clear_cache()
+        snapshot.build()
+
+    def tearDown(self):
+        snapshot.clear_cache()
+        database.DB_PATH = self.old_path
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def sql_ids(self, value):
+        return set(database.fetch_columns(("id",), location=value)["id"].tolist())
+
+    def test_fts_like_and_snapshot_agree(self):
+        for value in QUERIES:
+            with self.subTest(value=value):
+                expected = expected_ids(value)
+                if self.has_fts and len(value) >= database.FTS_MIN_CHARS:
+                    conn = database.get_connection()
+                    where, _ = database._filter_clause(conn, location=value)
+                    conn.close()
+                    self.assertIn("MATCH", where)
+                self.assertEqual(self.sql_ids(value), expected, "FTS5")
+                with mock.patch.object(database, "FTS_MIN_CHARS", 1_000):
+                    self.assertEqual(self.sql_ids(value), expected, "LIKE")
+                result = snapshot.load(("id",), location=value)
+                self.assertIsNotNone(result)
+                self.assertEqual(set(result["id"].tolist()), expected, "snapshot")
+
+    def test_column_filter_contains_is_literal(self):
+        for value in ("e_a", "%", "_", "a\\b"):
+            with self.subTest(value=value):
+                records, _ = database.fetch_page(limit=None, column_filters=[("location", "包含", value)])
+                self.assertEqual({r.id for r in records}, expected_ids(value))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,9 @@
+import time
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox
+from tkinter import ttk, filedialog, messagebox, simpledialog
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Callable, Optional
-from datetime import datetime
+from typing import List, Callable, Optional, Tuple
 
 # 尝试加载 matplotlib
 try:
@@ -32,14 +33,36 @@ except Exception as e:
     HAS_MPL = False
 
 from models import ConsumptionRecord
+import anomaly
+import archive
+import charts
+import clustering
+import cohort
 import database
+import forecast
+import ingest
+import integrity
+import livequery
+import metrics
+import profiling
+import reporting
+import snapshot
 from analyzer import DataAnalyzer
+from report_engine import SqlReportEngine
+from reporting import format_report_text
 from utils import DATE_FMT, parse_datetime
 
+# 停止输入多少毫秒后开始查询
+FILTER_DEBOUNCE_MS = 300
+# 后台查询结果的轮询间隔 (毫秒)
+LIVE_POLL_MS = 30
+# 性能指标窗口的自动刷新间隔 (毫秒)
+METRICS_REFRESH_MS = 1000
+
 
 class ControlPanel(ttk.LabelFrame):
     """顶部控制面板：包含过滤条件和操作按钮"""
-    def __init__(self, parent, on_load, on_filter, on_analyze, on_export_report, on_export_clean, on_poverty_check, on_suspicious_check, on_add, on_edit, on_delete):
+    def __init__(self, parent, on_load, on_filter, on_analyze, on_export_report, on_export_clean, on_poverty_check, on_suspicious_check, on_baseline_check, on_add, on_edit, on_delete, on_change=None):
         super().__init__(parent, text="过滤与阈值")
         self.on_load = on_load
         self.on_filter = on_filter
@@ -48,9 +71,11 @@ class ControlPanel(ttk.LabelFrame):
         self.on_export_clean = on_export_clean
         self.on_poverty_check = on_poverty_check
         self.on_suspicious_check = on_suspicious_check
+        self.on_baseline_check = on_baseline_check
         self.on_add = on_add
         self.on_edit = on_edit
         self.on_delete = on_delete
+        self.on_change = on_change  # 过滤条件被修改 (边输入边查询)
 
         # 变量绑定
         self.single_threshold = tk.DoubleVar(value=200.0)
@@ -82,6 +107,10 @@ class ControlPanel(ttk.LabelFrame):
         ttk.Label(row1, text="年级:").pack(side="left", padx=2)
         self.ent_grade = ttk.Entry(row1, width=6)
         self.ent_grade.pack(side="left", padx=2)
+
+        ttk.Label(row1, text="地点:").pack(side="left", padx=2)
+        self.ent_location = ttk.Entry(row1, width=10)
+        self.ent_location.pack(side="left", padx=2)
         
         ttk.Label(row1, text="时间:").pack(side="left", padx=2)
         self.ent_start = ttk.Entry(row1, width=10)
@@ -91,10 +120,18 @@ class ControlPanel(ttk.LabelFrame):
         self.ent_end.pack(side="left", padx=1)
         
         ttk.Label(row1, text="排序:").pack(side="left", padx=5)
-        ttk.Combobox(row1, textvariable=self.sort_var, values=["时间倒序", "时间正序"], width=8, state="readonly").pack(side="left", padx=2)
+        sort_box = ttk.Combobox(row1, textvariable=self.sort_var, values=["时间倒序", "时间正序"], width=8, state="readonly")
+        sort_box.pack(side="left", padx=2)
 
         ttk.Button(row1, text="查询", command=self.on_filter).pack(side="left", padx=10)
 
+        # 边输入边查询：任一过滤条件变化都通知外部 (由外部去抖)
+        if self.on_change:
+            for entry in (self.ent_sid, self.ent_name, self.ent_major, self.ent_grade,
+                          self.ent_location, self.ent_start, self.ent_end):
+                entry.bind("<KeyRelease>", lambda e: self.on_change(), add="+")
+            sort_box.bind("<<ComboboxSelected>>", lambda e: self.on_change())
+
         # 第二行：分析参数 + 功能按钮
         row2 = ttk.Frame(self)
         row2.pack(fill="x", padx=5, pady=5)
@@ -115,6 +152,7 @@ class ControlPanel(ttk.LabelFrame):
         ttk.Button(param_frame, text="开始分析", command=self.on_analyze).pack(side="left", padx=5)
         ttk.Button(param_frame, text="贫困筛查", command=self.on_poverty_check).pack(side="left", padx=2)
         ttk.Button(param_frame, text="异常检测", command=self.on_suspicious_check).pack(side="left", padx=2)
+        ttk.Button(param_frame, text="基线异常", command=self.on_baseline_check).pack(side="left", padx=2)
 
         # 右侧：操作按钮
         op_frame = ttk.Frame(row2)
@@ -129,6 +167,11 @@ class ControlPanel(ttk.LabelFrame):
         ttk.Button(op_frame, text="导出CSV", command=self.on_export_clean).pack(side="left", padx=2)
 
 
+    def dates_complete(self) -> bool:
+        """日期输入框为空或是完整的日期 (输入到一半时不查询)"""
+        return all(not text or parse_datetime(text + " 00:00:00")
+                   for text in (self.ent_start.get().strip(), self.ent_end.get().strip()))
+
     def get_filter_params(self):
         """获取当前的过滤参数"""
         start_str = self.ent_start.get().strip()
@@ -139,6 +182,7 @@ class ControlPanel(ttk.LabelFrame):
             "name": self.ent_name.get().strip(),
             "major": self.ent_major.get().strip(),
             "grade": self.ent_grade.get().strip(),
+            "location": self.ent_location.get().strip(),
             "start": parse_datetime(start_str + " 00:00:00") if start_str else None,
             "end": parse_datetime(end_str + " 23:59:59") if end_str else None,
             "time_asc": self.sort_var.get() == "时间正序"
@@ -154,22 +198,36 @@ class ControlPanel(ttk.LabelFrame):
 
 
 class DataTableView(ttk.Frame):
-    """数据表格视图"""
-    def __init__(self, parent):
+    """
+    数据表格视图
+    点击表头按该列排序 (再次点击反向)，列过滤条件与排序一起下推到数据库；
+    结果按页 (keyset 游标) 加载，滚动到底部时再取下一页，不一次性加载全部记录
+    """
+    # 列名映射
+    COL_NAMES = {
+        "student_id": "学号", "name": "姓名", "major": "专业", "grade": "年级",
+        "balance": "余额(元)", "timestamp": "时间", "amount": "金额(元)",
+        "merchant_type": "商户类型", "location": "地点", "tx_type": "交易类型"
+    }
+
+    def __init__(self, parent, page_loader: Optional[Callable] = None):
         super().__init__(parent)
+        # page_loader(排序列, 是否降序, 游标, 列过滤) -> (记录, 下一页游标)
+        self.page_loader = page_loader
+        self.records: List[ConsumptionRecord] = []
+        self.sort_by = "timestamp"
+        self.descending = True
+        self.column_filters: List[Tuple[str, str, str]] = []
+        self._cursor = None
+        self._loading = False
+        self.on_page: Optional[Callable[[], None]] = None  # 每加载一页后回调
+        # 提供时第一页由它在后台查询，完成后调用 show_first_page；否则用 page_loader 同步加载
+        self.reloader: Optional[Callable[[], None]] = None
         self._init_table()
 
     def _init_table(self):
-        cols = [
-            "student_id", "name", "major", "grade", "balance",
-            "timestamp", "amount", "merchant_type", "location", "tx_type"
-        ]
-        # 定义列名映射
-        col_names = {
-            "student_id": "学号", "name": "姓名", "major": "专业", "grade": "年级",
-            "balance": "余额(元)", "timestamp": "时间", "amount": "金额(元)",
-            "merchant_type": "商户类型", "location": "地点", "tx_type": "交易类型"
-        }
+        cols = list(database.TABLE_COLUMNS)
+        col_names = self.COL_NAMES
         
         # 定义列宽配置 (列名: 宽度)
         col_widths = {
@@ -177,31 +235,137 @@ class DataTableView(ttk.Frame):
             "balance": 80, "timestamp": 140, "amount": 80,
             "merchant_type": 100, "location": 120, "tx_type": 80
         }
+
+        # 列过滤栏
+        bar = ttk.Frame(self)
+        bar.grid(row=0, column=0, columnspan=2, sticky="ew", pady=2)
+        ttk.Label(bar, text="列过滤:").pack(side="left", padx=2)
+        self.filter_col = tk.StringVar(value=col_names["amount"])
+        self.filter_op = tk.StringVar(value=">=")
+        self.filter_value = tk.StringVar()
+        ttk.Combobox(bar, textvariable=self.filter_col, values=[col_names[c] for c in cols],
+                     width=8, state="readonly").pack(side="left", padx=2)
+        ttk.Combobox(bar, textvariable=self.filter_op, values=database.COLUMN_OPERATORS,
+                     width=4, state="readonly").pack(side="left", padx=2)
+        value_entry = ttk.Entry(bar, textvariable=self.filter_value, width=14)
+        value_entry.pack(side="left", padx=2)
+        value_entry.bind("<Return>", lambda e: self.add_filter())
+        ttk.Button(bar, text="添加", command=self.add_filter, width=5).pack(side="left", padx=2)
+        ttk.Button(bar, text="清除", command=self.clear_filters, width=5).pack(side="left", padx=2)
+        self.filter_label = ttk.Label(bar, text="")
+        self.filter_label.pack(side="left", padx=8)
         
         self.tree = ttk.Treeview(self, columns=cols, show="headings", height=10)
         
         for c in cols:
-            self.tree.heading(c, text=col_names.get(c, c))
+            self.tree.heading(c, text=col_names.get(c, c), command=lambda c=c: self.sort(c))
             self.tree.column(c, width=col_widths.get(c, 90), anchor="center")
             
         vsb = ttk.Scrollbar(self, orient="vertical", command=self.tree.yview)
         hsb = ttk.Scrollbar(self, orient="horizontal", command=self.tree.xview)
+
+        def on_scroll(first, last):
+            vsb.set(first, last)
+            # 接近底部时加载下一页
+            if float(last) > 0.95:
+                self.load_more()
+
+        self.tree.configure(yscrollcommand=on_scroll, xscrollcommand=hsb.set)
         
-        self.tree.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set)
-        
-        self.tree.grid(row=0, column=0, sticky="nsew")
-        vsb.grid(row=0, column=1, sticky="ns")
-        hsb.grid(row=1, column=0, sticky="ew")
+        self.tree.grid(row=1, column=0, sticky="nsew")
+        vsb.grid(row=1, column=1, sticky="ns")
+        hsb.grid(row=2, column=0, sticky="ew")
         
-        self.grid_rowconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
         self.grid_columnconfigure(0, weight=1)
+        self._update_headings()
 
-    def update_data(self, rows: List[ConsumptionRecord]):
-        # 清空旧数据
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-            
-        # 插入新数据
+    @property
+    def has_more(self) -> bool:
+        return self._cursor is not None
+
+    def sort(self, column: str):
+        """按 column 排序，已按该列排序时反向"""
+        if column == self.sort_by:
+            self.descending = not self.descending
+        else:
+            self.sort_by, self.descending = column, column in ("timestamp", "amount", "balance")
+        self.reload()
+
+    def add_filter(self):
+        value = self.filter_value.get().strip()
+        if not value:
+            return
+        col = next(c for c, n in self.COL_NAMES.items() if n == self.filter_col.get())
+        op = self.filter_op.get()
+        if col in database.NUMERIC_COLUMNS and op != "包含":
+            try:
+                float(value)
+            except ValueError:
+                messagebox.showwarning("提示", f"{self.COL_NAMES[col]} 需要数值")
+                return
+        self.column_filters.append((col, op, value))
+        self.filter_value.set("")
+        self.reload()
+
+    def clear_filters(self):
+        if self.column_filters:
+            self.column_filters = []
+            self.reload()
+
+    def _update_headings(self):
+        for c, n in self.COL_NAMES.items():
+            mark = (" ▼" if self.descending else " ▲") if c == self.sort_by else ""
+            self.tree.heading(c, text=n + mark)
+        self.filter_label.config(text="  且  ".join(
+            f"{self.COL_NAMES[c]} {op} {v}" for c, op, v in self.column_filters
+        ))
+
+    def reload(self):
+        """按当前排序与列过滤重新加载第一页"""
+        self._cursor = None
+        self._update_headings()
+        if self.reloader is not None:
+            # 新结果到达前保留旧的行，避免输入时表格闪烁；其间不再翻页
+            self.reloader()
+            return
+        self.tree.delete(*self.tree.get_children())
+        self.records = []
+        if self.page_loader is not None:
+            self._fetch(None)
+
+    @metrics.timed("ui.table.show_first_page")
+    def show_first_page(self, records: List[ConsumptionRecord], cursor):
+        """用后台查询到的第一页替换表格内容"""
+        self.tree.delete(*self.tree.get_children())
+        self.records = list(records)
+        self._cursor = cursor
+        self._insert(self.records)
+        if self.on_page:
+            self.on_page()
+
+    @metrics.timed("ui.table.load_more")
+    def load_more(self):
+        if self._cursor is not None and not self._loading:
+            self._fetch(self._cursor)
+
+    def fetch_all(self) -> List[ConsumptionRecord]:
+        """当前排序与过滤下的全部记录 (不分页，用于导出)"""
+        records, _ = self.page_loader(self.sort_by, self.descending, None, self.column_filters, limit=None)
+        return records
+
+    def _fetch(self, cursor):
+        self._loading = True
+        try:
+            records, self._cursor = self.page_loader(self.sort_by, self.descending, cursor, self.column_filters)
+        finally:
+            self._loading = False
+        self.records.extend(records)
+        self._insert(records)
+        if self.on_page:
+            self.on_page()
+
+    def _insert(self, rows: List[ConsumptionRecord]):
         for r in rows:
             self.tree.insert(
                 "",
@@ -211,7 +375,7 @@ class DataTableView(ttk.Frame):
                     r.name,
                     r.major,
                     r.grade,
-                    f"{r.balance:.2f}",
+                    f"{r.balance:.2f}" if r.balance is not None else "-",
                     r.timestamp.strftime(DATE_FMT),
                     f"{r.amount:.2f}",
                     r.merchant_type,
@@ -235,13 +399,27 @@ class ResultPanel(ttk.LabelFrame):
 
 
 class ChartPanel(ttk.LabelFrame):
-    """图表可视化面板"""
-    def __init__(self, parent):
+    """
+    图表可视化面板
+    提供 load_provider (返回 database.fetch_location_load 的结果) 时，可切换到地点负载热力图，
+    热力图只读预聚合的负载立方体，不加载明细
+    """
+    WEEKDAYS = ("一", "二", "三", "四", "五", "六", "日")
+
+    def __init__(self, parent, load_provider: Optional[Callable[[], dict]] = None):
         super().__init__(parent, text="可视化")
         self.fig = None
         self.ax1 = None
         self.ax2 = None
         self.canvas = None
+        self.load_provider = load_provider
+        self.view_var = tk.StringVar(value="趋势")
+        self.location_var = tk.StringVar(value="全部地点")
+        self.metric_var = tk.StringVar(value="笔数")
+        self._trend = None  # 最近一次趋势图的数据，切回时重画
+        self._trend_plot = None  # 趋势折线 (charts.TrendPlot)，子图重建时置空
+        self._pie_data = None    # 饼图当前显示的数据
+        self._load = None
         self._init_chart()
 
     def _init_chart(self):
@@ -249,6 +427,19 @@ class ChartPanel(ttk.LabelFrame):
             ttk.Label(self, text="未安装 matplotlib，无法绘图").pack(padx=20, pady=20)
             return
 
+        if self.load_provider:
+            bar = ttk.Frame(self)
+            bar.pack(fill="x", padx=5)
+            view = ttk.Combobox(bar, textvariable=self.view_var, values=("趋势", "地点负载"), width=8, state="readonly")
+            view.pack(side="left")
+            view.bind("<<ComboboxSelected>>", lambda e: self.refresh())
+            self.location_box = ttk.Combobox(bar, textvariable=self.location_var, width=14, state="readonly")
+            self.location_box.pack(side="left", padx=5)
+            self.location_box.bind("<<ComboboxSelected>>", lambda e: self._draw_heatmap())
+            metric = ttk.Combobox(bar, textvariable=self.metric_var, values=("笔数", "金额"), width=6, state="readonly")
+            metric.pack(side="left")
+            metric.bind("<<ComboboxSelected>>", lambda e: self._draw_heatmap())
+
         # 改为 1 行 2 列的布局
         self.fig, (self.ax1, self.ax2) = plt.subplots(1, 2, figsize=(10, 3.5))
         # 调整布局以适应小窗口
@@ -257,46 +448,87 @@ class ChartPanel(ttk.LabelFrame):
         self.canvas = FigureCanvasTkAgg(self.fig, master=self)
         self.canvas.get_tk_widget().pack(fill="both", expand=True, padx=5, pady=5)
 
+    @metrics.timed("ui.chart.refresh")
+    def refresh(self):
+        """按当前视图重画 (过滤条件变化后由外部调用)"""
+        if not HAS_MPL:
+            return
+        if self.view_var.get() == "地点负载":
+            self._load = self.load_provider()
+            self.location_box["values"] = ("全部地点",) + tuple(self._load["locations"])
+            if self.location_var.get() not in self.location_box["values"]:
+                self.location_var.set("全部地点")
+            self._draw_heatmap()
+        elif self._trend is not None:
+            self.update_charts(*self._trend)
+
+    def _draw_heatmap(self):
+        """星期 × 15 分钟时段的热力图，选中单个地点或全部地点之和"""
+        if self._load is None or self.view_var.get() != "地点负载":
+            return
+        self.fig.clear()
+        self.ax1 = self.ax2 = None
+        self._trend_plot = None
+        ax = self.fig.add_subplot(111)
+        cube = self._load["count"] if self.metric_var.get() == "笔数" else self._load["amount"]
+        locations = list(self._load["locations"])
+        selected = self.location_var.get()
+        if not locations:
+            ax.set_title("无数据")
+        else:
+            grid = cube[locations.index(selected)] if selected in locations else cube.sum(axis=0)
+            image = ax.imshow(grid, aspect="auto", cmap="YlOrRd", interpolation="nearest")
+            per_hour = 60 // database.LOAD_BUCKET_MINUTES
+            ax.set_xticks(range(0, database.LOAD_BUCKETS, 2 * per_hour))
+            ax.set_xticklabels([f"{h:02d}:00" for h in range(0, 24, 2)], fontsize=8)
+            ax.set_yticks(range(7))
+            ax.set_yticklabels([f"周{d}" for d in self.WEEKDAYS])
+            ax.set_title(f"{selected} 每 {database.LOAD_BUCKET_MINUTES} 分钟{self.metric_var.get()}")
+            self.fig.colorbar(image, ax=ax)
+        self.fig.tight_layout()
+        self.canvas.draw_idle()
+
+    @metrics.timed("ui.chart.update")
     def update_charts(self, daily_data: dict, merchant_data: dict):
         if not HAS_MPL:
             return
-        
+        self._trend = (daily_data, merchant_data)
+        if self.view_var.get() == "地点负载":
+            return
+        rebuilt = False
+        if self.ax1 is None:
+            # 从热力图切回，重建左右两个子图
+            self.fig.clear()
+            self.ax1, self.ax2 = self.fig.subplots(1, 2)
+            self._trend_plot = None
+            self._pie_data = None
+        if self._trend_plot is None:
+            self._trend_plot = charts.TrendPlot(self.ax1, "日消费趋势", "日期", "金额")
+            rebuilt = True
+
         try:
-            # 图表1: 日消费趋势
-            self.ax1.clear()
-            if not daily_data:
-                self.ax1.set_title("无数据")
-            else:
-                # 将日期字符串转换为 datetime 对象，消除 matplotlib 的警告
-                xs = [datetime.strptime(k, '%Y-%m-%d') for k in daily_data.keys()]
-                ys = list(daily_data.values())
-                
-                # 使用 plot_date 或者直接 plot datetime 对象
-                self.ax1.plot(xs, ys, marker="o", linestyle='-', markersize=4)
-                self.ax1.set_title("日消费趋势")
-                self.ax1.set_xlabel("日期")
-                self.ax1.set_ylabel("金额")
-                
-                # 优化 X 轴标签显示
-                import matplotlib.dates as mdates
-                self.ax1.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
-                self.ax1.xaxis.set_major_locator(mdates.AutoDateLocator())
-                self.ax1.tick_params(axis="x", rotation=30)
-                self.ax1.grid(True, linestyle='--', alpha=0.7)
-                
-            # 图表2: 商户分布饼图
-            self.ax2.clear()
-            if not merchant_data:
-                self.ax2.set_title("无数据")
-            else:
-                labels = list(merchant_data.keys())
-                sizes = [v['total'] for v in merchant_data.values()]
-                # 简单的饼图
-                self.ax2.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, textprops={'fontsize': 9})
-                self.ax2.set_title("商户消费占比")
-
-            self.fig.tight_layout()
-            self.canvas.draw()
+            # 图表1: 日消费趋势 (长序列降采样到坐标轴的像素宽度，只替换折线数据)
+            changed = self._trend_plot.update(daily_data)
+
+            # 图表2: 商户分布饼图，数据没变时保留原有扇区
+            if merchant_data != self._pie_data:
+                self._pie_data = merchant_data
+                self.ax2.clear()
+                if not merchant_data:
+                    self.ax2.set_title("无数据")
+                else:
+                    labels = list(merchant_data.keys())
+                    sizes = [v['total'] for v in merchant_data.values()]
+                    # 简单的饼图
+                    self.ax2.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, textprops={'fontsize': 9})
+                    self.ax2.set_title("商户消费占比")
+                changed = True
+
+            # 只在子图重建后重新布局；重绘交给 Tk 空闲时合并执行
+            if rebuilt:
+                self.fig.tight_layout()
+            if changed or rebuilt:
+                self.canvas.draw_idle()
         except Exception as e:
             print(f"Chart update error: {e}")
             import traceback
@@ -312,14 +544,41 @@ class App:
         
         # 初始化数据库
         database.init_db()
+        # 分析快照：过期时在后台重建，分析直接映射快照文件而不是查询整张表
+        snapshot.auto_refresh(True)
+        snapshot.schedule(0)
         
         # 数据状态
         self.filtered: List[ConsumptionRecord] = []
+        self.filter_kwargs = {}  # 当前列表对应的过滤条件，分析时按此从数据库加载
+        # 目录监听 (增量导入) 服务
+        self.ingest_service: Optional[ingest.IngestService] = None
+        self._ingested_rows = 0
+        # 近似统计模式：深度分析改为合并每日草图 (仅日期过滤时生效)
+        self.approximate = tk.BooleanVar(value=False)
+        # 后台任务：图表在子进程中用 Agg 渲染，批量导出在后台线程中调度进程池
+        self._render_pool: Optional[ProcessPoolExecutor] = None
+        self._batch_pool: Optional[ThreadPoolExecutor] = None
+        # 边输入边查询：后台查询线程 (新查询会中断旧查询)、去抖定时器和最近一次的条数估计
+        self.live_query = livequery.LiveQuery()
+        self._debounce_id = None
+        self._count = None
+        # 性能指标 (诊断菜单)，启动时可由环境变量 CAMPUS_METRICS=1 开启
+        self.metrics_enabled = tk.BooleanVar(value=metrics.enabled())
+        # 性能分析模式：开启后统计分析、异常检测和导入会写出折叠调用栈 (data/profiles)
+        self.profile_mode = tk.StringVar(value="")
+        self.profile_memory = tk.BooleanVar(value=False)
+        # 存储模式 (磁盘 / 内存映射 / 内存库)，启动时可由环境变量 CAMPUS_STORAGE 指定
+        self.storage_mode = tk.StringVar(value=database.storage_mode)
+        self._storage_pool: Optional[ThreadPoolExecutor] = None
         
         self._setup_ui()
         self.apply_filter() # 初始加载
 
     def _setup_ui(self):
+        # 0. 菜单栏
+        self._setup_menu()
+
         # 1. 顶部控制面板
         self.control_panel = ControlPanel(
             self.root,
@@ -330,14 +589,18 @@ class App:
             on_export_clean=self.export_clean,
             on_poverty_check=self.check_poverty,
             on_suspicious_check=self.check_suspicious,
+            on_baseline_check=self.check_baseline,
             on_add=self.add_record,
             on_edit=self.edit_record,
-            on_delete=self.delete_record
+            on_delete=self.delete_record,
+            on_change=self.on_filter_input
         )
         self.control_panel.pack(fill="x", padx=10, pady=5)
 
         # 2. 中间数据表格
-        self.table_view = DataTableView(self.root)
+        self.table_view = DataTableView(self.root, page_loader=self._load_page)
+        self.table_view.on_page = self._on_table_page
+        self.table_view.reloader = self._refresh_table
         self.table_view.pack(fill="both", expand=True, padx=10, pady=5)
         
         # 右键菜单绑定
@@ -350,9 +613,64 @@ class App:
         self.result_panel = ResultPanel(bottom_frame)
         self.result_panel.pack(side="left", fill="both", expand=True, padx=(0, 5))
 
-        self.chart_panel = ChartPanel(bottom_frame)
+        self.chart_panel = ChartPanel(bottom_frame, load_provider=lambda: database.fetch_location_load(
+            self.filter_kwargs.get("start_date"), self.filter_kwargs.get("end_date"),
+            self.filter_kwargs.get("location", "")
+        ))
         self.chart_panel.pack(side="right", fill="both", expand=True, padx=(5, 0))
 
+        # 4. 状态栏
+        self.status_var = tk.StringVar(value="就绪")
+        ttk.Label(self.root, textvariable=self.status_var, anchor="w", relief="sunken").pack(fill="x", side="bottom")
+
+    def _setup_menu(self):
+        menubar = tk.Menu(self.root)
+
+        data_menu = tk.Menu(menubar, tearoff=0)
+        data_menu.add_command(label="导入CSV...", command=self.load_file)
+        data_menu.add_command(label="批量导入目录...", command=self.load_directory)
+        data_menu.add_separator()
+        data_menu.add_command(label="开始监听目录...", command=self.start_watch)
+        data_menu.add_command(label="停止监听", command=self.stop_watch)
+        data_menu.add_separator()
+        data_menu.add_command(label="归档历史月份...", command=self.archive_history)
+        data_menu.add_command(label="校验余额...", command=self.verify_balances)
+        data_menu.add_separator()
+        data_menu.add_checkbutton(label="近似统计 (草图)", variable=self.approximate)
+        data_menu.add_separator()
+        data_menu.add_command(label="查看入库基线告警", command=self.show_baseline_alerts)
+        data_menu.add_command(label="重建学生基线", command=self.rebuild_baselines)
+        data_menu.add_separator()
+        data_menu.add_command(label="余额预警...", command=self.check_low_balance)
+        data_menu.add_command(label="学生消费画像聚类...", command=self.cluster_students)
+        data_menu.add_command(label="专业/年级对比", command=self.compare_cohorts)
+        batch_menu = tk.Menu(data_menu, tearoff=0)
+        for field_name, label in reporting.BATCH_FIELDS.items():
+            batch_menu.add_command(label=f"按{label}...", command=lambda f=field_name: self.batch_export(f))
+        data_menu.add_cascade(label="批量导出报告", menu=batch_menu)
+        menubar.add_cascade(label="数据", menu=data_menu)
+
+        diag_menu = tk.Menu(menubar, tearoff=0)
+        diag_menu.add_checkbutton(label="收集性能指标", variable=self.metrics_enabled, command=self.toggle_metrics)
+        diag_menu.add_command(label="性能指标...", command=self.show_metrics)
+        diag_menu.add_separator()
+        profile_menu = tk.Menu(diag_menu, tearoff=0)
+        for value, label in (("", "关闭"), ("cprofile", "cProfile"), ("sample", "采样")):
+            profile_menu.add_radiobutton(label=label, value=value, variable=self.profile_mode,
+                                         command=self.configure_profiling)
+        profile_menu.add_separator()
+        profile_menu.add_checkbutton(label="跟踪内存分配 (较慢)", variable=self.profile_memory,
+                                     command=self.configure_profiling)
+        diag_menu.add_cascade(label="性能分析 (统计/异常检测/导入)", menu=profile_menu)
+        storage_menu = tk.Menu(diag_menu, tearoff=0)
+        for value, label in (("disk", "磁盘"), ("mmap", "内存映射 (mmap)"), ("memory", "整库载入内存")):
+            storage_menu.add_radiobutton(label=label, value=value, variable=self.storage_mode,
+                                         command=self.switch_storage)
+        diag_menu.add_cascade(label="存储模式", menu=storage_menu)
+        menubar.add_cascade(label="诊断", menu=diag_menu)
+
+        self.root.config(menu=menubar)
+
     def show_context_menu(self, event):
         item = self.table_view.tree.identify_row(event.y)
         if not item:
@@ -373,23 +691,26 @@ class App:
         menu.post(event.x_root, event.y_root)
 
     def analyze_subset(self, field, value, title):
-        # 从数据库获取完整数据进行分析
-        kwargs = {field: value}
-        records = database.fetch_records(**kwargs)
-        
-        if not records:
-            messagebox.showinfo("提示", "无相关数据")
-            return
-            
+        # 报告在数据库内聚合，不加载明细
         params = self.control_panel.get_analysis_params()
-        AnalysisWindow(self.root, title, records, params)
+        AnalysisWindow(self.root, title, SqlReportEngine(**{field: value}), params)
+
+    @property
+    def analysis_filters(self) -> dict:
+        """分析使用的过滤条件：当前列表的过滤条件加结果表上的列过滤，与表格显示的范围一致"""
+        return dict(self.filter_kwargs, column_filters=list(self.table_view.column_filters))
+
+    def _load_analyzer(self, *analyses) -> DataAnalyzer:
+        """按当前列表的过滤条件加载分析器，只查询 analyses 需要的列"""
+        return DataAnalyzer.from_database(analyses, **self.analysis_filters)
 
     def load_file(self):
         path = filedialog.askopenfilename(filetypes=[("CSV files", "*.csv")])
         if not path:
             return
         
-        count, errs = database.import_from_csv(Path(path))
+        with profiling.session("import"):
+            count, errs = database.import_from_csv(Path(path))
         msg = f"成功导入 {count} 条记录"
         if errs:
             msg += f"\n\n出现 {len(errs)} 个错误:\n" + "\n".join(errs[:5])
@@ -398,21 +719,208 @@ class App:
         messagebox.showinfo("导入结果", msg)
         self.apply_filter()
 
+    def load_directory(self):
+        directory = filedialog.askdirectory(title="选择 CSV 所在目录")
+        if not directory:
+            return
+
+        paths = ingest.expand_sources(directory)
+        if not paths:
+            messagebox.showinfo("导入结果", "该目录下没有 CSV 文件")
+            return
+
+        self.root.config(cursor="watch")
+        self.root.update_idletasks()
+        try:
+            summary = ingest.import_paths(paths)
+        finally:
+            self.root.config(cursor="")
+
+        lines = [
+            f"共 {len(summary.files)} 个文件，写入 {summary.inserted} 条，跳过重复 {summary.duplicates} 条",
+            f"重算余额 {len(summary.students)} 名学生，用时 {summary.seconds:.2f} 秒",
+            "",
+        ]
+        for f in summary.files:
+            lines.append(f"{Path(f.path).name}: {f.inserted}/{f.rows} 条, {f.rows_per_sec:.0f} 行/秒"
+                         + (f", {len(f.errors)} 个错误" if f.errors else ""))
+        errs = summary.errors
+        if errs:
+            lines.append(f"\n出现 {len(errs)} 个错误:")
+            lines.extend(errs[:5])
+            if len(errs) > 5:
+                lines.append("...")
+        messagebox.showinfo("导入结果", "\n".join(lines))
+        self.apply_filter()
+
+    def start_watch(self):
+        if self.ingest_service and self.ingest_service.running:
+            messagebox.showinfo("提示", f"正在监听 {self.ingest_service.source}")
+            return
+        directory = filedialog.askdirectory(title="选择投递目录")
+        if not directory:
+            return
+        self.ingest_service = ingest.IngestService(directory)
+        self.ingest_service.start()
+        self._ingested_rows = 0
+        self._poll_ingest()
+
+    def stop_watch(self):
+        if self.ingest_service:
+            self.ingest_service.stop(timeout=5)
+            self.ingest_service = None
+        self.status_var.set("已停止监听")
+
+    def _poll_ingest(self):
+        """定时刷新增量导入的计数；有新数据时刷新列表"""
+        service = self.ingest_service
+        if not service or not service.running:
+            return
+        st = service.snapshot()
+        lag = "-" if st["lag_seconds"] is None else f"{st['lag_seconds']:.0f}s"
+        self.status_var.set(
+            f"监听 {service.source} | 已导入 {st['rows']} 条 (重复 {st['duplicates']}) | "
+            f"批次 {st['batches']} | {st['rows_per_sec']:.0f} 行/秒 | 待读 {st['pending_bytes']} 字节 | "
+            f"数据延迟 {lag} | 错误 {st['errors']}"
+        )
+        if st["rows"] != self._ingested_rows:
+            self._ingested_rows = st["rows"]
+            self.apply_filter()
+        self.root.after(2000, self._poll_ingest)
+
+    def archive_history(self):
+        months = archive.hot_months()
+        if len(months) < 2:
+            messagebox.showinfo("提示", "当前数据不足两个月，无需归档")
+            return
+        month = simpledialog.askstring(
+            "归档历史月份",
+            f"归档早于哪个月份 (YYYY-MM，不含该月) 的数据？\n热数据范围: {months[0]} ~ {months[-1]}",
+            parent=self.root
+        )
+        if not month:
+            return
+        try:
+            parts = archive.archive_before(month.strip())
+        except Exception as e:
+            messagebox.showerror("归档失败", f"错误信息: {e}")
+            return
+        total = sum(p["row_count"] for p in parts)
+        messagebox.showinfo("归档完成", f"已归档 {len(parts)} 个月份，共 {total} 条记录")
+        self.apply_filter()
+
+    def verify_balances(self):
+        """校验所有余额，有不一致时询问是否修复"""
+        self.status_var.set("正在校验余额...")
+        self.root.update_idletasks()
+        report = integrity.verify_balances()
+        self.status_var.set(f"余额校验: {report.rows} 行，用时 {report.seconds:.1f}s")
+        if not report.divergent:
+            messagebox.showinfo("余额校验", f"{report.students} 名学生的 {report.rows} 条记录余额全部一致")
+            return
+
+        lines = [f"#{s['id']} {s['student_id']} {s['timestamp']}  记录 {s['balance']}  应为 {s['expected']:.2f}"
+                 for s in report.samples[:5]]
+        if not messagebox.askyesno("余额校验", (
+            f"{report.divergent_students} 名学生的 {report.divergent} 条记录余额不一致 "
+            f"(最大差额 {report.max_diff:.2f})，例如:\n" + "\n".join(lines) + "\n\n是否按累计收支修复？"
+        )):
+            return
+        report = integrity.verify_balances(repair=True)
+        messagebox.showinfo("余额校验", f"已修复 {report.repaired} 条记录")
+        self.apply_filter()
+
+    @metrics.timed("ui.apply_filter")
     def apply_filter(self):
         params = self.control_panel.get_filter_params()
         
-        self.filtered = database.fetch_records(
+        self.filter_kwargs = dict(
             student_id=params["sid"],
             name=params["name"],
             major=params["major"],
             grade=params["grade"],
             start_date=params["start"],
             end_date=params["end"],
-            time_asc=params.get("time_asc", False)
+            location=params["location"]
         )
-        
-        self.table_view.update_data(self.filtered)
-        self.result_panel.show_text(f"查询结果：{len(self.filtered)} 条记录")
+        # 按时间排序时沿用 "排序" 下拉框的方向，其它列的排序由表头点击决定
+        if self.table_view.sort_by == "timestamp":
+            self.table_view.descending = not params.get("time_asc", False)
+        self.table_view.reload()
+        if self.chart_panel.view_var.get() == "地点负载":
+            self.chart_panel.refresh()
+
+    def on_filter_input(self):
+        """过滤条件变化：立即中断进行中的查询，停止输入 FILTER_DEBOUNCE_MS 毫秒后再查询"""
+        self.live_query.cancel()
+        if self._debounce_id is not None:
+            self.root.after_cancel(self._debounce_id)
+        self._debounce_id = self.root.after(FILTER_DEBOUNCE_MS, self._apply_live_filter)
+
+    def _apply_live_filter(self):
+        self._debounce_id = None
+        if self.control_panel.dates_complete():
+            self.apply_filter()
+
+    def _refresh_table(self):
+        """
+        在后台线程中先估计条数、再查询第一页，两者完成后分别更新界面
+        期间有新的查询时，这一轮的结果被丢弃
+        """
+        tv = self.table_view
+        kwargs = dict(self.filter_kwargs)
+        column_filters = list(tv.column_filters)
+        sort_by, descending = tv.sort_by, tv.descending
+        count = self.live_query.submit(
+            lambda conn: database.estimate_count(column_filters, conn=conn, **kwargs))
+        page = self.live_query.submit(
+            lambda conn: database.fetch_page(sort_by, descending, None, database.PAGE_SIZE, column_filters,
+                                             conn=conn, **kwargs),
+            replace=False)
+        generation = self.live_query.generation
+        self._count = None
+        self.status_var.set("查询中...")
+        started = time.perf_counter()
+
+        def current(f: Future) -> bool:
+            if generation != self.live_query.generation or isinstance(f.exception(), livequery.QueryCancelled):
+                return False
+            if f.exception():
+                self.status_var.set(f"查询失败: {f.exception()}")
+                return False
+            return True
+
+        def on_count(f: Future):
+            if current(f):
+                self._count = f.result()
+                if not page.done():
+                    self.result_panel.show_text(f"查询结果：{self._count_text()}正在加载...")
+
+        def on_page(f: Future):
+            if current(f):
+                tv.show_first_page(*f.result())
+                self.status_var.set("")
+                # 从提交查询到第一页显示的总耗时 (含排队和轮询)
+                metrics.record("ui.live_query", time.perf_counter() - started)
+
+        self._when_done(count, on_count, LIVE_POLL_MS)
+        self._when_done(page, on_page, LIVE_POLL_MS)
+
+    def _load_page(self, sort_by, descending, after, column_filters, limit=database.PAGE_SIZE):
+        """表格分页加载：当前过滤条件 + 表格自身的排序与列过滤"""
+        return database.fetch_page(sort_by, descending, after, limit, column_filters, **self.filter_kwargs)
+
+    def _on_table_page(self):
+        # 已加载的记录 (右键菜单、修改、删除按表格行号取记录)
+        self.filtered = self.table_view.records
+        more = "，滚动到底部加载更多" if self.table_view.has_more else ""
+        self.result_panel.show_text(f"查询结果：{self._count_text()}已加载 {len(self.filtered)} 条记录{more}")
+
+    def _count_text(self) -> str:
+        if self._count is None:
+            return ""
+        n, exact = self._count
+        return f"共 {n} 条，" if exact else f"超过 {n} 条，"
 
     def add_record(self):
         RecordDialog(self.root, "新增记录", on_save=self._on_record_saved)
@@ -463,7 +971,7 @@ class App:
             messagebox.showinfo("提示", "当前无数据")
             return
             
-        analyzer = DataAnalyzer(self.filtered)
+        analyzer = self._load_analyzer("detect_poverty_students")
         # 默认阈值140
         poverty_students = analyzer.detect_poverty_students(threshold=140)
         
@@ -508,28 +1016,197 @@ class App:
                 s['weeks_count']
             ))
 
+    def check_low_balance(self):
+        """全校余额预测：列出预计 N 天内余额用完的学生"""
+        days = simpledialog.askinteger(
+            "余额预警", "列出预计多少天内余额用完的学生？",
+            initialvalue=forecast.WARN_DAYS, minvalue=0, parent=self.root
+        )
+        if days is None:
+            return
+        students = forecast.low_balance_students(days)
+        if not students:
+            messagebox.showinfo("结果", f"没有预计 {days} 天内余额用完的学生")
+            return
+
+        top = tk.Toplevel(self.root)
+        top.title(f"余额预警 (预计 {days} 天内用完，共 {len(students)} 人)")
+        top.geometry("900x400")
+
+        columns = ("sid", "name", "major", "balance", "weekday", "weekend", "days", "date")
+        headers = ("学号", "姓名", "专业", "当前余额", "工作日日均", "周末日均", "剩余天数", "预计用完")
+        tree = ttk.Treeview(top, columns=columns, show="headings")
+        col_widths = [100, 80, 100, 80, 80, 80, 70, 100]
+        for col, hdr, width in zip(columns, headers, col_widths):
+            tree.heading(col, text=hdr)
+            tree.column(col, width=width, anchor="center")
+
+        scrollbar = ttk.Scrollbar(top, orient=tk.VERTICAL, command=tree.yview)
+        tree.configure(yscroll=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        for s in students:
+            tree.insert("", "end", values=(
+                s['student_id'],
+                s['name'],
+                s['major'],
+                f"{s['balance']:.2f}",
+                f"{s['weekday_rate']:.2f}",
+                f"{s['weekend_rate']:.2f}",
+                f"{s['days_to_empty']:.0f}",
+                s['empty_date'].strftime("%Y-%m-%d")
+            ))
+
+    def cluster_students(self):
+        """按消费画像把全校学生分群，显示每类的人数、特点和特征均值"""
+        k = simpledialog.askinteger("学生消费画像聚类", "分成几类？", initialvalue=5, minvalue=2, maxvalue=20,
+                                    parent=self.root)
+        if k is None:
+            return
+        result = clustering.cluster_students(k)
+        if not result.summaries:
+            messagebox.showinfo("结果", f"没有消费笔数达到 {clustering.MIN_TX} 的学生")
+            return
+
+        top = tk.Toplevel(self.root)
+        top.title(f"学生消费画像聚类 ({len(result.features)} 名学生, {len(result.summaries)} 类)")
+        top.geometry("1100x300")
+
+        feature_cols = clustering.SUMMARY_COLUMNS
+        columns = ("cluster", "size", "share", "traits") + feature_cols
+        headers = ("类", "人数", "占比", "主要特点") + tuple(clustering.FEATURE_LABELS[c] for c in feature_cols)
+        tree = ttk.Treeview(top, columns=columns, show="headings")
+        col_widths = [40, 60, 60, 260] + [80] * len(feature_cols)
+        for col, hdr, width in zip(columns, headers, col_widths):
+            tree.heading(col, text=hdr)
+            tree.column(col, width=width, anchor="w" if col == "traits" else "center")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        for row in clustering.format_summary(result, feature_cols):
+            tree.insert("", "end", values=row)
+
+    def compare_cohorts(self):
+        """在当前过滤范围内并排对比各专业、年级的报告指标 (一次分组扫描)，双击一行打开该群体的分析窗口"""
+        params = self.control_panel.get_analysis_params()
+        result = cohort.compare_cohorts(
+            params["single_threshold"],
+            params["freq_window"],
+            params["freq_count"],
+            **self.analysis_filters
+        )
+        if not result.overall.habits["count"]:
+            messagebox.showinfo("提示", "当前无数据")
+            return
+        self.status_var.set(f"群体对比用时 {result.seconds:.2f}s")
+
+        top = tk.Toplevel(self.root)
+        top.title("专业/年级对比")
+        top.geometry("1300x400")
+        notebook = ttk.Notebook(top)
+        notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        columns = ("cohort",) + tuple(cohort.COLUMN_LABELS)
+        col_widths = [120] + [75] * len(cohort.COLUMN_LABELS)
+        for level, tab in (("major", "按专业"), ("grade", "按年级"), ("major_grade", "专业×年级")):
+            frame = ttk.Frame(notebook)
+            notebook.add(frame, text=tab)
+            tree = ttk.Treeview(frame, columns=columns, show="headings")
+            cohorts = list(result.levels[level])  # 排序不改动缓存的结果
+
+            def fill(tree=tree, cohorts=cohorts):
+                tree.delete(*tree.get_children())
+                for c in cohorts:
+                    tree.insert("", "end", iid=c.label, values=cohort.format_row(c))
+                tree.insert("", "end", iid="全体", values=cohort.format_row(result.overall))
+
+            def sort_by(col, tree=tree, cohorts=cohorts, fill=fill):
+                # 点击表头按该列降序，再次点击升序 (全体一行始终在最后)
+                descending = getattr(tree, "_sort", None) != (col, True)
+                key = (lambda c: c.label) if col == "cohort" else (lambda c: c.metrics[col])
+                cohorts.sort(key=key, reverse=descending)
+                tree._sort = (col, descending)
+                fill()
+
+            for col, hdr, width in zip(columns, ("群体",) + tuple(cohort.COLUMN_LABELS.values()), col_widths):
+                tree.heading(col, text=hdr, command=lambda col=col, sort_by=sort_by: sort_by(col))
+                tree.column(col, width=width, anchor="center")
+            fill()
+
+            if level != "major_grade":
+                def open_cohort(event, tree=tree, field=level):
+                    value = tree.focus()
+                    if value and value != "全体":
+                        label = "专业" if field == "major" else "年级"
+                        self.analyze_subset(field, value, f"{label}分析: {value}")
+                tree.bind("<Double-1>", open_cohort)
+
+            scrollbar = ttk.Scrollbar(frame, orient=tk.VERTICAL, command=tree.yview)
+            tree.configure(yscroll=scrollbar.set)
+            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+            tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+    @metrics.timed("ui.check_suspicious")
     def check_suspicious(self):
         if not self.filtered:
             messagebox.showinfo("提示", "当前无数据")
             return
             
         params = self.control_panel.get_analysis_params()
-        analyzer = DataAnalyzer(self.filtered)
-        
-        suspicious = analyzer.get_suspicious_records(
-            params["single_threshold"],
-            params["freq_window"],
-            params["freq_count"]
-        )
-        
+        # 阈值规则 + 附加规则 (data/anomaly_rules.json，不存在时用默认规则)
+        try:
+            engine = anomaly.RuleEngine.from_specs(anomaly.default_rules(
+                params["single_threshold"],
+                params["freq_window"],
+                params["freq_count"]
+            ))
+        except (ValueError, OSError) as e:
+            messagebox.showerror("错误", f"规则配置无效: {e}")
+            return
+        with profiling.session("check_suspicious"):
+            analyzer = self._load_analyzer("get_suspicious_records")
+            suspicious, stats = engine.run(analyzer.df)
+
+        summary = f"排序 {engine.prepare_millis:.1f}ms | " + " | ".join(
+            f"{s.label} {s.hits} 条 {s.millis:.1f}ms" for s in stats)
+        self.status_var.set(summary)
         if not suspicious:
             messagebox.showinfo("结果", "未发现异常交易")
             return
-            
-        # 弹窗显示结果
+
+        self._show_suspicious(f"异常交易检测 (大额 > {params['single_threshold']} 等 {len(stats)} 条规则)",
+                              suspicious, summary)
+
+    def check_baseline(self):
+        """按学生自身的消费基线检测异常 (日期条件只限制输出范围)"""
+        if not self.filtered:
+            messagebox.showinfo("提示", "当前无数据")
+            return
+
+        suspicious = anomaly.BaselineDetector().detect_from_database(**self.analysis_filters)
+        if not suspicious:
+            messagebox.showinfo("结果", "未发现偏离基线的交易")
+            return
+        self._show_suspicious("基线异常检测 (偏离基线 / 非常规时段 / 新地点)", suspicious)
+
+    def show_baseline_alerts(self):
+        alerts = anomaly.get_alerts()
+        if not alerts:
+            messagebox.showinfo("结果", "暂无入库告警")
+            return
+        self._show_suspicious(f"入库基线告警 (最近 {len(alerts)} 条)", alerts)
+
+    def rebuild_baselines(self):
+        count = anomaly.rebuild_baselines()
+        self.status_var.set(f"已重建 {count} 名学生的消费基线")
+
+    def _show_suspicious(self, title, suspicious, summary=""):
+        # 弹窗显示结果，summary 为各规则的命中数与耗时
         top = tk.Toplevel(self.root)
-        top.title(f"异常交易检测 (大额 > {params['single_threshold']} 或 高频)")
+        top.title(title)
         top.geometry("1000x500")
+        if summary:
+            ttk.Label(top, text=summary, anchor="w").pack(side=tk.BOTTOM, fill=tk.X, padx=10)
         
         columns = ("type", "sid", "name", "major", "time", "amount", "tx_type", "location", "desc")
         headers = ("异常类型", "学号", "姓名", "专业", "时间", "金额", "交易类型", "地点", "说明")
@@ -561,29 +1238,31 @@ class App:
                 s['desc']
             ))
 
+    @metrics.timed("ui.analyze")
     def analyze(self):
         if not self.filtered:
             messagebox.showinfo("提示", "请先筛选数据")
             return
             
         params = self.control_panel.get_analysis_params()
-        analyzer = DataAnalyzer(self.filtered)
-        
-        report = analyzer.generate_report(
-            params["single_threshold"],
-            params["freq_window"],
-            params["freq_count"]
-        )
-        
-        # 获取深度分析
-        deep_insights = analyzer.get_deep_insights()
-        
-        # 生成文本报告
-        text_report = format_report_text(report, deep_insights, params)
-        self.result_panel.show_text(text_report)
-        
-        # 更新图表
-        self.chart_panel.update_charts(report["summary"]["daily"], report["habits"]["merchant_breakdown"])
+        with profiling.session("analyze"):
+            engine = SqlReportEngine(**self.analysis_filters)
+
+            report = engine.generate_report(
+                params["single_threshold"],
+                params["freq_window"],
+                params["freq_count"]
+            )
+
+            # 获取深度分析
+            deep_insights = engine.get_deep_insights(approximate=self.approximate.get())
+
+            # 生成文本报告
+            text_report = format_report_text(report, deep_insights, params)
+            self.result_panel.show_text(text_report)
+
+            # 更新图表
+            self.chart_panel.update_charts(report["summary"]["daily"], report["habits"]["merchant_breakdown"])
 
     def export_report(self):
         if not self.filtered:
@@ -591,13 +1270,13 @@ class App:
             return
             
         params = self.control_panel.get_analysis_params()
-        analyzer = DataAnalyzer(self.filtered)
-        report = analyzer.generate_report(
+        engine = SqlReportEngine(**self.analysis_filters)
+        report = engine.generate_report(
             params["single_threshold"],
             params["freq_window"],
             params["freq_count"]
         )
-        deep_insights = analyzer.get_deep_insights()
+        deep_insights = engine.get_deep_insights(approximate=self.approximate.get())
         
         save_path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text", "*.txt")])
         if not save_path:
@@ -607,8 +1286,158 @@ class App:
         
         with open(save_path, "w", encoding="utf-8") as f:
             f.write(text_report)
+
+        # 图表在子进程中渲染为同名 PNG，不阻塞界面
+        if reporting.HAS_MPL:
+            if self._render_pool is None:
+                self._render_pool = ProcessPoolExecutor(max_workers=1)
+            future = self._render_pool.submit(reporting.render_charts, report, Path(save_path).with_suffix(""))
+            self.status_var.set("正在后台生成图表...")
+            self._when_done(future, lambda f: self.status_var.set(
+                f"图表导出失败: {f.exception()}" if f.exception()
+                else "图表已导出: " + ", ".join(str(p) for p in f.result())
+            ))
         messagebox.showinfo("成功", f"报告已导出到 {save_path}")
 
+    def batch_export(self, field_name):
+        """为当前过滤范围内的每个专业/年级/学生生成报告包 (文本 + 图表)，在后台并行执行"""
+        directory = filedialog.askdirectory(title=f"选择按{reporting.BATCH_FIELDS[field_name]}导出报告的目录")
+        if not directory:
+            return
+        if self._batch_pool is None:
+            self._batch_pool = ThreadPoolExecutor(max_workers=1)
+        params = self.control_panel.get_analysis_params()
+        future = self._batch_pool.submit(reporting.batch_reports, field_name, Path(directory), params,
+                                         **self.analysis_filters)
+        self.status_var.set(f"正在按{reporting.BATCH_FIELDS[field_name]}批量导出报告...")
+
+        def done(f: Future):
+            if f.exception():
+                messagebox.showerror("导出失败", f"错误信息: {f.exception()}")
+                return
+            r = f.result()
+            msg = f"已生成 {len(r.bundles) - len(r.failures)} 个报告包到 {r.out_dir}，用时 {r.seconds:.1f}s"
+            self.status_var.set(msg)
+            if r.failures:
+                msg += f"\n\n{len(r.failures)} 个失败:\n" + "\n".join(f"{b['name']}: {b['error']}" for b in r.failures[:5])
+            messagebox.showinfo("批量导出", msg)
+        self._when_done(future, done)
+
+    def toggle_metrics(self):
+        if self.metrics_enabled.get():
+            metrics.enable()
+        else:
+            metrics.disable()
+        self.status_var.set("性能指标已开启" if metrics.enabled() else "性能指标已关闭")
+
+    def configure_profiling(self):
+        mode = self.profile_mode.get() or None
+        profiling.configure(mode, self.profile_memory.get(), on_done=self._on_profile)
+        self.status_var.set(f"性能分析已开启 ({mode})" if mode else "性能分析已关闭")
+
+    def switch_storage(self):
+        """切换存储模式；整库载入内存可能需要数秒，在后台线程执行"""
+        mode = self.storage_mode.get()
+        if mode == database.storage_mode:
+            return
+        if self._storage_pool is None:
+            self._storage_pool = ThreadPoolExecutor(max_workers=1)
+        start = time.perf_counter()
+        future = self._storage_pool.submit(database.set_storage_mode, mode)
+        self.status_var.set("正在切换存储模式...")
+
+        def done(f: Future):
+            if f.exception():
+                self.storage_mode.set(database.storage_mode)
+                messagebox.showerror("切换失败", f"错误信息: {f.exception()}")
+                return
+            self.status_var.set(f"存储模式: {mode} (用时 {time.perf_counter() - start:.1f}s)")
+            self.apply_filter()
+        self._when_done(future, done)
+
+    def _on_profile(self, result: profiling.ProfileResult):
+        self.status_var.set(f"性能分析 {result.action} 用时 {result.seconds:.2f}s，"
+                            f"结果已写入 {result.collapsed_path} 和 {result.report_path.name}")
+
+    def show_metrics(self):
+        """性能指标窗口：各计时器/计数器和最近的慢查询 (选中查看查询计划)，每秒自动刷新"""
+        top = tk.Toplevel(self.root)
+        top.title("性能指标")
+        top.geometry("900x600")
+
+        bar = ttk.Frame(top)
+        bar.pack(fill=tk.X, padx=10, pady=(10, 0))
+        ttk.Checkbutton(bar, text="收集性能指标", variable=self.metrics_enabled,
+                        command=self.toggle_metrics).pack(side=tk.LEFT)
+        summary = tk.StringVar()
+        ttk.Label(bar, textvariable=summary).pack(side=tk.LEFT, padx=10)
+
+        def export():
+            path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+            if path:
+                metrics.dump_json(Path(path))
+                self.status_var.set(f"性能指标已导出到 {path}")
+
+        ttk.Button(bar, text="导出 JSON...", command=export).pack(side=tk.RIGHT)
+        ttk.Button(bar, text="清零", command=lambda: (metrics.reset(), fill())).pack(side=tk.RIGHT, padx=5)
+
+        pane = ttk.PanedWindow(top, orient=tk.VERTICAL)
+        pane.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        columns = ("name", "count", "total_ms", "avg_ms", "max_ms")
+        timers = ttk.Treeview(pane, columns=columns, show="headings", height=12)
+        for col, hdr, width in zip(columns, ("名称", "次数", "总耗时(ms)", "平均(ms)", "最大(ms)"), (420, 70, 100, 90, 90)):
+            timers.heading(col, text=hdr)
+            timers.column(col, width=width, anchor="w" if col == "name" else "e")
+        pane.add(timers, weight=3)
+
+        slow = ttk.Treeview(pane, columns=("at", "ms", "sql"), show="headings", height=6)
+        for col, hdr, width in (("at", "时间", 140), ("ms", "耗时(ms)", 80), ("sql", "慢查询", 640)):
+            slow.heading(col, text=hdr)
+            slow.column(col, width=width, anchor="e" if col == "ms" else "w")
+        pane.add(slow, weight=2)
+
+        plan = tk.Text(pane, height=6, wrap="word")
+        pane.add(plan, weight=1)
+        slow_entries = []
+
+        def show_plan(event=None):
+            selected = slow.focus()
+            plan.delete("1.0", tk.END)
+            if selected:
+                entry = slow_entries[int(selected)]
+                plan.insert(tk.END, f"{entry['sql']}\n参数: {entry['params']}\n\n查询计划:\n{entry['plan']}")
+        slow.bind("<<TreeviewSelect>>", show_plan)
+
+        def fill():
+            snap = metrics.snapshot()
+            state = "收集中" if snap["enabled"] else "未开启"
+            summary.set(f"{state}，慢查询阈值 {snap['slow_query_ms']:.0f}ms，更新于 {snap['at'][11:]}")
+            timers.delete(*timers.get_children())
+            for name, t in snap["timers"].items():
+                timers.insert("", "end", values=(name, t["count"], f"{t['total_ms']:.1f}", f"{t['avg_ms']:.2f}", f"{t['max_ms']:.1f}"))
+            for name, n in snap["counters"].items():
+                timers.insert("", "end", values=(name, n, "", "", ""))
+            if len(snap["slow_queries"]) != len(slow_entries) or snap["slow_queries"][-1:] != slow_entries[-1:]:
+                slow_entries[:] = snap["slow_queries"]
+                slow.delete(*slow.get_children())
+                for i, entry in reversed(list(enumerate(slow_entries))):
+                    slow.insert("", "end", iid=str(i), values=(entry["at"], f"{entry['ms']:.0f}", entry["sql"]))
+
+        def tick():
+            if top.winfo_exists():
+                fill()
+                top.after(METRICS_REFRESH_MS, tick)
+
+        tick()
+
+    def _when_done(self, future: Future, callback: Callable[[Future], None], interval: int = 200):
+        """轮询后台任务，完成后在 Tk 线程中回调"""
+        if future.done():
+            callback(future)
+        else:
+            self.root.after(interval, self._when_done, future, callback, interval)
+
     def export_clean(self):
         if not self.filtered:
             messagebox.showinfo("提示", "无数据")
@@ -619,18 +1448,18 @@ class App:
         records_to_export = []
         
         if selected:
-            if messagebox.askyesno("导出选项", f"检测到选中了 {len(selected)} 条记录。\n是否仅导出选中的记录？\n(选择'否'将导出当前列表所有 {len(self.filtered)} 条记录)"):
+            if messagebox.askyesno("导出选项", f"检测到选中了 {len(selected)} 条记录。\n是否仅导出选中的记录？\n(选择'否'将导出当前查询的全部记录)"):
                 # 导出选中
                 for item_id in selected:
                     idx = self.table_view.tree.index(item_id)
                     if idx < len(self.filtered):
                         records_to_export.append(self.filtered[idx])
             else:
-                # 导出所有
-                records_to_export = self.filtered
+                # 导出所有 (包括尚未加载到表格中的页)
+                records_to_export = self.table_view.fetch_all()
         else:
             # 默认导出所有
-            records_to_export = self.filtered
+            records_to_export = self.table_view.fetch_all()
 
         save_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", "*.csv")])
         if not save_path:
@@ -663,63 +1492,13 @@ class App:
             messagebox.showerror("导出失败", f"错误信息: {e}")
 
 
-
-
-def format_report_text(report, deep_insights, params):
-    lines = []
-    lines.append("=== 基础统计 ===")
-    lines.append(f"统计天数：{len(report['summary']['daily'])} 天")
-    lines.append(f"统计周数：{len(report['summary']['weekly'])} 周")
-    lines.append(f"涉及学生：{deep_insights.get('student_count', 0)} 人")
-    
-    lines.append("\n=== 消费习惯深度分析 ===")
-    h = report["habits"]
-    lines.append(f"总消费额: {h['total']:.2f} 元")
-    lines.append(f"交易笔数: {h['count']} 笔")
-    lines.append(f"笔均消费: {h['avg']:.2f} 元")
-    lines.append(f"单笔最高: {h['max']:.2f} 元")
-    
-    peak = deep_insights.get('peak_hour', 0)
-    lines.append(f"\n高峰时段: {peak}:00 - {peak+1}:00")
-    
-    weekend_avg = deep_insights.get('weekend_avg', 0.0)
-    weekday_avg = deep_insights.get('weekday_avg', 0.0)
-    
-    lines.append(f"周末日均: {weekend_avg:.2f} 元")
-    lines.append(f"工作日日均: {weekday_avg:.2f} 元")
-    
-    if weekend_avg > weekday_avg:
-        lines.append("  -> 周末消费更高")
-    else:
-        lines.append("  -> 工作日消费更高")
-
-    # Meal Stats
-    ms = deep_insights.get('meal_stats', {})
-    lines.append("\n=== 三餐规律 ===")
-    lines.append(f"早餐 (06-09): {ms.get('breakfast', 0)} 次")
-    lines.append(f"午餐 (11-13): {ms.get('lunch', 0)} 次")
-    lines.append(f"晚餐 (17-19): {ms.get('dinner', 0)} 次")
-    lines.append(f"其他时段: {ms.get('other', 0)} 次")
-
-    lines.append("\n=== 热门消费地点 (Top 5) ===")
-    top_locs = deep_insights.get('top_locations', {})
-    for loc, count in top_locs.items():
-        lines.append(f"  {loc}: {count} 次")
-        
-    lines.append("\n=== 异常检测 ===")
-    lines.append(f"大额交易 (> {params['single_threshold']}元): {report['anomalies']['large_count']} 笔")
-    lines.append(f"高频交易 ({params['freq_window']}min内 > {params['freq_count']}次): {report['anomalies']['freq_count']} 笔")
-    
-    return "\n".join(lines)
-
-
 class AnalysisWindow(tk.Toplevel):
     """独立分析窗口"""
-    def __init__(self, parent, title, records, params):
+    def __init__(self, parent, title, engine: SqlReportEngine, params):
         super().__init__(parent)
         self.title(title)
         self.geometry("1000x700")
-        self.records = records
+        self.engine = engine
         self.params = params
         
         self._init_ui()
@@ -730,21 +1509,22 @@ class AnalysisWindow(tk.Toplevel):
         self.result_panel = ResultPanel(self)
         self.result_panel.pack(side="left", fill="both", expand=True, padx=5, pady=5)
         
-        self.chart_panel = ChartPanel(self)
+        f = self.engine.filters
+        self.chart_panel = ChartPanel(self, load_provider=lambda: database.fetch_location_load(
+            f["start_date"], f["end_date"], f["location"]
+        ))
         self.chart_panel.pack(side="right", fill="both", expand=True, padx=5, pady=5)
         
     def _run_analysis(self):
-        if not self.records:
-            self.result_panel.show_text("无数据")
-            return
-            
-        analyzer = DataAnalyzer(self.records)
-        report = analyzer.generate_report(
+        report = self.engine.generate_report(
             self.params["single_threshold"],
             self.params["freq_window"],
             self.params["freq_count"]
         )
-        deep_insights = analyzer.get_deep_insights()
+        if report["habits"]["count"] == 0:
+            self.result_panel.show_text("无数据")
+            return
+        deep_insights = self.engine.get_deep_insights()
         
         text = format_report_text(report, deep_insights, self.params)
         self.result_panel.show_text(text)
@@ -835,5 +1615,7 @@ def launch():
     style.configure('.', font=('Microsoft YaHei', 9))
     style.configure('Treeview', rowheight=25)
     
+    metrics.enable_from_env()
+    database.storage_from_env()
     App(root)
     root.mainloop()
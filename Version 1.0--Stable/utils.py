@@ -8,6 +8,19 @@ logging.basicConfig(
 )
 
 DATE_FMT = "%Y-%m-%d %H:%M:%S"
+# 金额合计保留到分：DataAnalyzer 与 SqlReportEngine 的求和顺序不同，误差只在分以下，
+# 规整后两者的报告逐位相同
+MONEY_DIGITS = 2
+
+
+def money(value) -> float:
+    """金额合计规整为保留两位小数的 float"""
+    return round(float(value), MONEY_DIGITS)
+
+
+def money_mean(total, count) -> float:
+    """笔均金额：规整后的合计除以笔数，没有记录时为 0.0"""
+    return money(total) / count if count else 0.0
 
 
 def parse_datetime(dt_str: str) -> Optional[datetime]: